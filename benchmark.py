@@ -0,0 +1,287 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import post_data
+import naive_bayes
+import post_getters
+import synthetic
+import hhapi
+import fake_hypnohub
+
+"""
+Benchmarks for the slow parts of the code, run against a synthetic dataset.
+Prints the results as JSON, so they can be saved and compared between
+commits to catch performance regressions.
+
+python benchmark.py --posts 100000 --good 500 --bad 1000 > bench_output.txt
+"""
+
+# [(name, function), ...] in the order they were defined. See @benchmark.
+BENCHMARKS = []
+
+# The classifier that the nbc_ and post_getter_ benchmarks use. Set by
+# --classifier, from post_getters.CLASSIFIERS.
+CLASSIFIER = naive_bayes.NaiveBayesClassifier
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The function is called like f(dataset) and returns
+    (seconds, number_of_operations).
+    """
+    def decorator(f):
+        BENCHMARKS.append((name, f))
+        return f
+
+    return decorator
+
+
+@contextlib.contextmanager
+def timer():
+    """
+    with timer() as t:
+        do_stuff()
+    print(t.seconds)
+    """
+    class Timer(object):
+        seconds = None
+
+    t = Timer()
+    start = time.perf_counter()
+    yield t
+    t.seconds = time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def in_temp_dir():
+    """ Dataset saves to the current directory, so give it an empty one. """
+    old_dir = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+
+        try:
+            yield
+        finally:
+            os.chdir(old_dir)
+
+
+@benchmark('dataset_save')
+def bench_dataset_save(dataset):
+    with in_temp_dir(), timer() as t:
+        dataset.save()
+
+    return t.seconds, len(dataset.cache)
+
+
+@benchmark('dataset_load')
+def bench_dataset_load(dataset):
+    with in_temp_dir():
+        dataset.save()
+
+        with timer() as t:
+            post_data.Dataset()
+
+    return t.seconds, len(dataset.cache)
+
+
+@benchmark('simple_post_construction')
+def bench_simple_post(dataset):
+    posts = list(synthetic.generate_posts(10000, seed=0))
+
+    with timer() as t:
+        for post in posts:
+            post_data.SimplePost(post)
+
+    return t.seconds, len(posts)
+
+
+@benchmark('post_view_access')
+def bench_post_view(dataset):
+    with timer() as t:
+        for post in dataset.get_all():
+            post.tags
+
+    return t.seconds, len(dataset.cache)
+
+
+@benchmark('nbc_train')
+def bench_nbc_train(dataset):
+    with timer() as t:
+        CLASSIFIER.from_dataset(dataset)
+
+    return t.seconds, len(dataset.good) + len(dataset.bad)
+
+
+@benchmark('nbc_predict')
+def bench_nbc_predict(dataset):
+    nbc = CLASSIFIER.from_dataset(dataset)
+    posts = [post.features
+             for _, post in zip(range(10000), dataset.get_all())]
+
+    with timer() as t:
+        for tags in posts:
+            nbc.predict(tags)
+
+    return t.seconds, len(posts)
+
+
+@benchmark('nbc_predict_table')
+def bench_nbc_predict_table(dataset):
+    nbc = CLASSIFIER.from_dataset(dataset)
+
+    with timer() as t:
+        nbc.predict_many(dataset.cache)
+
+    return t.seconds, len(dataset.cache)
+
+
+@benchmark('post_getter_get_best_first')
+def bench_get_best_first(dataset):
+    """ The first /best after startup, which has to find the top posts. """
+    pg = post_getters.PostGetter(dataset, CLASSIFIER.from_dataset(dataset))
+
+    with timer() as t:
+        pg.get_best()
+
+    return t.seconds, 1
+
+
+@benchmark('post_getter_get_best')
+def bench_get_best(dataset):
+    pg = post_getters.PostGetter(dataset, CLASSIFIER.from_dataset(dataset))
+    pg.get_best()
+
+    with timer() as t:
+        for _ in range(100):
+            pg.get_best()
+
+    return t.seconds, 100
+
+
+@benchmark('post_getter_get_hot')
+def bench_get_hot(dataset):
+    pg = post_getters.PostGetter(dataset, CLASSIFIER.from_dataset(dataset))
+
+    with timer() as t:
+        for _ in range(20):
+            pg.get_hot()
+
+    return t.seconds, 20
+
+
+@benchmark('post_getter_get_random')
+def bench_get_random(dataset):
+    pg = post_getters.PostGetter(dataset, CLASSIFIER.from_dataset(dataset))
+
+    with timer() as t:
+        for _ in range(1000):
+            pg.get_random()
+
+    return t.seconds, 1000
+
+
+@benchmark('html_rating_page')
+def bench_html(dataset):
+    import http_server.html_generator as html_generator
+
+    posts = [post for _, post in zip(range(1000), dataset.get_all())]
+
+    with timer() as t:
+        for post in posts:
+            html_generator.rating_page_for_post(post, "score: 12.34%")
+
+    return t.seconds, len(posts)
+
+
+@benchmark('crawl_update_cache')
+def bench_crawl(dataset):
+    """ A full update_cache crawl against a local fake Hypnohub. """
+    posts = list(synthetic.generate_posts(min(len(dataset.cache), 20000),
+                                          seed=0))
+    old_url, old_delay = hhapi.BASE_URL, hhapi.DELAY_BETWEEN_REQUESTS
+
+    with fake_hypnohub.FakeHypnohub(posts) as fake:
+        hhapi.BASE_URL, hhapi.DELAY_BETWEEN_REQUESTS = fake.url, 0
+
+        try:
+            with timer() as t:
+                post_data.Dataset(load=False).update_cache(
+                    print_progress=False)
+        finally:
+            hhapi.BASE_URL, hhapi.DELAY_BETWEEN_REQUESTS = old_url, old_delay
+
+    return t.seconds, len(posts)
+
+
+def run(dataset, only=None):
+    """ Returns a list of result dicts, one per benchmark. """
+    results = []
+
+    for name, f in BENCHMARKS:
+        if only is not None and name not in only:
+            continue
+
+        seconds, ops = f(dataset)
+        results.append({
+            'name':           name,
+            'seconds':        seconds,
+            'ops':            ops,
+            'ops_per_second': ops / seconds if seconds > 0 else None,
+        })
+
+        print(f"{name}: {seconds:.4f}s", file=sys.stderr)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark against a synthetic dataset.")
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--good', type=int, default=500)
+    parser.add_argument('--bad', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*',
+                        help="Names of benchmarks to run. Default: all.")
+    parser.add_argument('--output', help="Write JSON here, not stdout.")
+    parser.add_argument('--classifier', default='naive_bayes',
+                        choices=sorted(post_getters.CLASSIFIERS))
+    args = parser.parse_args(argv)
+
+    global CLASSIFIER
+    CLASSIFIER = post_getters.CLASSIFIERS[args.classifier]
+
+    with timer() as t:
+        dataset = synthetic.generate_dataset(args.posts, args.good, args.bad,
+                                             seed=args.seed)
+
+    print(f"generated {args.posts} posts: {t.seconds:.2f}s", file=sys.stderr)
+
+    output = {
+        'python':     platform.python_version(),
+        'platform':   platform.platform(),
+        'posts':      args.posts,
+        'good':       args.good,
+        'bad':        args.bad,
+        'seed':       args.seed,
+        'classifier': args.classifier,
+        'benchmarks': run(dataset, args.only),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
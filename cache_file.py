@@ -0,0 +1,868 @@
+import bisect
+import collections
+import json
+import os
+import struct
+import zlib
+from array import array
+from itertools import accumulate
+from typing import (Iterable, Iterator, List, Optional, Sequence, Set,
+                    Tuple)
+
+import post_data
+import tag_index
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+"""
+The on-disk format for Dataset.cache, which is a lot smaller than pickling the
+PostTable, and a lot faster to load than bz2.
+
+The tag vocabulary is stored once, and each post's tags are their ids, sorted
+and delta-encoded as varints, so most tags only take one byte. Posts are
+written in blocks of BLOCK_SIZE rows, with one compressed chunk per column
+per block, using zstd or lz4 if they're installed and zlib otherwise. The
+tag index is saved too, since its posting lists are varint bytes already,
+and that saves rebuilding it on every load.
+
+The file is:
+
+MAGIC       Followed by VERSION, as one byte.
+header      Uncompressed JSON. The codec, row count and so on.
+chunks      Each one is a little-endian u64 length and then that many bytes.
+"""
+
+MAGIC = b'HHCACHE'
+VERSION = 2
+
+BLOCK_SIZE = 10000
+
+_LENGTH = struct.Struct('<Q')
+
+# {name: (compress, decompress), ...}
+CODECS = {'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress)}
+
+if lz4 is not None:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+
+if zstandard is not None:
+    CODECS['zstd'] = (zstandard.ZstdCompressor(level=3).compress,
+                      zstandard.ZstdDecompressor().decompress)
+
+# The best codec we have.
+DEFAULT_CODEC = next(name for name in ['zstd', 'lz4', 'zlib']
+                     if name in CODECS)
+
+
+def encode_varints(values: Iterable[int]) -> bytes:
+    """ Non-negative ints, 7 bits per byte, high bit set on every byte but
+    the last of each. The same as tag_index.PostingList.
+    """
+    out = bytearray()
+
+    for value in values:
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+
+        out.append(value)
+
+    return bytes(out)
+
+
+def decode_varints(data: bytes) -> List[int]:
+    out = []
+    value = shift = 0
+
+    for byte in data:
+        if byte < 0x80:
+            out.append(value | (byte << shift))
+            value = shift = 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+
+    return out
+
+
+def _zigzag(n):
+    """ Signed to unsigned, so that small negative numbers stay small. """
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def _unzigzag(n):
+    return n // 2 if n % 2 == 0 else -(n + 1) // 2
+
+
+def _deltas(values):
+    """ Differences between sorted values, starting from 0. """
+    previous = 0
+
+    for value in values:
+        yield value - previous
+        previous = value
+
+
+class _Writer(object):
+    def __init__(self, f, codec):
+        self.f = f
+        self.compress = CODECS[codec][0]
+
+    def raw(self, data: bytes):
+        self.f.write(_LENGTH.pack(len(data)))
+        self.f.write(data)
+
+    def chunk(self, data: bytes):
+        self.raw(self.compress(data))
+
+    def json(self, value):
+        self.chunk(json.dumps(value).encode('utf8'))
+
+    def varints(self, values):
+        self.chunk(encode_varints(values))
+
+
+class _Reader(object):
+    def __init__(self, f, path):
+        self.f = f
+        self.path = path
+        self.decompress = None
+
+    def raw(self) -> bytes:
+        length = self.f.read(_LENGTH.size)
+
+        if len(length) < _LENGTH.size:
+            raise ValueError(f"Cache file is cut short: {self.path}")
+
+        data = self.f.read(_LENGTH.unpack(length)[0])
+
+        if len(data) < _LENGTH.unpack(length)[0]:
+            raise ValueError(f"Cache file is cut short: {self.path}")
+
+        return data
+
+    def chunk(self) -> bytes:
+        return self.decompress(self.raw())
+
+    def json(self):
+        return json.loads(self.chunk().decode('utf8'))
+
+    def varints(self) -> List[int]:
+        return decode_varints(self.chunk())
+
+
+def _write_header(f, codec, **header) -> _Writer:
+    f.write(MAGIC + bytes([VERSION]))
+    writer = _Writer(f, codec)
+    writer.raw(json.dumps(dict(header, codec=codec)).encode('utf8'))
+    return writer
+
+
+def _read_header(f, path) -> Tuple[_Reader, int, dict]:
+    """ Returns (reader, version, header). """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"Not a cache file: {path}")
+
+    version = int.from_bytes(f.read(1), 'little')
+
+    if not 1 <= version <= VERSION:
+        raise ValueError(f"Unknown cache file version ({path}): {version}")
+
+    reader = _Reader(f, path)
+    header = json.loads(reader.raw().decode('utf8'))
+
+    if header['codec'] not in CODECS:
+        raise ValueError(f"{path} needs {header['codec']}, which isn't "
+                         f"installed.")
+
+    reader.decompress = CODECS[header['codec']][1]
+    return (reader, version, header)
+
+
+def _write_vocabulary(writer, table):
+    writer.json(table.tag_names)
+    writer.json(table.authors)
+
+
+def _read_vocabulary(reader, table):
+    table.tag_names = reader.json()
+    table.tag_index = {tag: i for i, tag in enumerate(table.tag_names)}
+    table.authors = reader.json()
+    table.author_index = {author: i for i, author in enumerate(table.authors)}
+
+
+def _write_block(writer, table, start, end):
+    """ Rows start to end of the table, one chunk per column. """
+    nfeatures = table.nfeatures
+    offsets, tag_ids = table.tag_offsets, table.tag_ids
+    rows = range(start, end)
+
+    writer.varints(_deltas(table.ids[start:end]))
+    writer.varints(map(_zigzag, table.scores[start:end]))
+    writer.chunk(table.ratings[start:end].tobytes())
+    writer.varints(table.author_ids[start:end])
+    writer.chunk(bytes(table.md5s[start*16:end*16]))
+
+    # Tags are sorted, so only their deltas are stored. Extra features
+    # aren't, and go separately.
+    writer.varints(offsets[row+1] - offsets[row] - nfeatures for row in rows)
+    writer.varints(delta for row in rows
+                   for delta in _deltas(tag_ids[
+                       offsets[row]:offsets[row+1] - nfeatures]))
+    writer.varints(tag_id for row in rows
+                   for tag_id in tag_ids[offsets[row+1] - nfeatures:
+                                         offsets[row+1]])
+
+    writer.chunk(bytes(table.url_exts[start*3:end*3]))
+
+
+def _read_block(reader, table, version):
+    """ Add the rows that _write_block wrote to the end of the table. """
+    nfeatures = table.nfeatures
+    tag_ids = table.tag_ids
+
+    table.ids.extend(accumulate(reader.varints()))
+    table.scores.extend(map(_unzigzag, reader.varints()))
+    table.ratings.frombytes(reader.chunk())
+    table.author_ids.extend(reader.varints())
+    table.md5s += reader.chunk()
+
+    counts, deltas, features = (reader.varints(), reader.varints(),
+                                reader.varints())
+    position = 0
+
+    for i, count in enumerate(counts):
+        tag_ids.extend(accumulate(deltas[position:position+count]))
+        tag_ids.extend(features[i*nfeatures:(i+1)*nfeatures])
+        position += count
+
+    end = table.tag_offsets[-1]
+    table.tag_offsets.extend(end + offset for offset in accumulate(
+        count + nfeatures for count in counts))
+
+    if version >= 2:
+        table.url_exts += reader.chunk()
+    else:
+        # Version 1 had the URLs themselves.
+        for urls in reader.json():
+            table.url_exts += table.encode_urls(len(table.url_exts) // 3,
+                                                urls)
+
+
+def _write_index(writer, index):
+    postings = index.postings + index.rating_postings
+
+    for p in postings:
+        p.compact()
+
+    writer.varints(len(p) for p in postings)
+    writer.varints(p.last for p in postings)
+    writer.varints(len(p.data) for p in postings)
+    writer.chunk(b''.join(p.data for p in postings))
+
+
+def _read_index(reader, table) -> tag_index.TagIndex:
+    counts, lasts, sizes = (reader.varints(), reader.varints(),
+                            reader.varints())
+    data = reader.chunk()
+    postings = []
+    position = 0
+
+    for count, last, size in zip(counts, lasts, sizes):
+        postings.append(tag_index.PostingList.from_data(
+            data[position:position+size], count, last))
+        position += size
+
+    nratings = len(table.RATINGS)
+    return tag_index.TagIndex.from_postings(
+        table, postings[:-nratings], postings[-nratings:])
+
+
+def save(path, table, index: Optional[tag_index.TagIndex] = None,
+         codec=DEFAULT_CODEC):
+    """
+    Write a PostTable, and optionally its TagIndex, to path. The old file is
+    only replaced once the new one has been completely written.
+    """
+    temp_path = path + '.tmp'
+
+    with open(temp_path, 'wb') as f:
+        writer = _write_header(f, codec, rows=len(table),
+                               block_size=BLOCK_SIZE,
+                               nfeatures=table.nfeatures,
+                               last_change=table.last_change,
+                               index=index is not None)
+
+        _write_vocabulary(writer, table)
+        writer.json(table.odd_md5s)
+        writer.json(table.odd_urls)
+
+        for start in range(0, len(table), BLOCK_SIZE):
+            _write_block(writer, table, start,
+                         min(start + BLOCK_SIZE, len(table)))
+
+        if index is not None:
+            _write_index(writer, index)
+
+    os.replace(temp_path, path)
+
+
+def load(path, table) -> Optional[tag_index.TagIndex]:
+    """
+    Read back what save wrote, into table, which should be a new, empty
+    post_data.PostTable. Returns the tag index, or None if it wasn't saved.
+
+    Raises ValueError if the file isn't a cache file, or needs a codec that
+    isn't installed.
+    """
+    with open(path, 'rb') as f:
+        reader, version, header = _read_header(f, path)
+
+        table.nfeatures = header['nfeatures']
+        table.last_change = header.get('last_change')
+        _read_vocabulary(reader, table)
+        table.odd_md5s = {int(id_): md5
+                          for id_, md5 in reader.json().items()}
+
+        if version >= 2:
+            table.odd_urls = {int(id_): tuple(urls)
+                              for id_, urls in reader.json().items()}
+
+        for _ in range(0, header['rows'], header['block_size']):
+            _read_block(reader, table, version)
+
+        if header['index']:
+            return _read_index(reader, table)
+
+        return None
+
+
+class ShardedCache(object):
+    """
+    The cache on disk as a directory, so that it never has to be read or
+    written all at once. Every shard file holds the posts with ids in one
+    SHARD_SIZE range, as a single block. META holds everything else: the
+    vocabulary, the tag index and which shards there are.
+
+    save only rewrites the shards that have changed, plus META. get and
+    posts read shards on demand, keeping at most max_resident of them in
+    memory, for when the whole cache isn't needed.
+
+    Tag and author ids in every shard refer to META's vocabulary, which only
+    ever grows, so old shards stay valid when new tags come along. META is
+    written before the shards, and records which save wrote each shard last.
+    If saving is interrupted, load notices that the shards don't match, and
+    the tag index is rebuilt instead of trusted.
+    """
+    SHARD_SIZE = 10000
+    META = 'meta.hhc'
+
+    def __init__(self, path, max_resident=4):
+        self.path = path
+        self.max_resident = max_resident
+
+        # {shard: PostTable, ...}, least recently used first. See get.
+        self._resident = collections.OrderedDict()
+
+        # An empty PostTable with META's vocabulary, for the shards in
+        # self._resident to share.
+        self._vocabulary = None
+
+    @classmethod
+    def shard_of(cls, id_) -> int:
+        return id_ // cls.SHARD_SIZE
+
+    def _shard_path(self, shard):
+        return os.path.join(self.path, f"shard-{shard:06d}.hhc")
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.path, self.META)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self._meta_path)
+
+    def _read_meta(self, table=None):
+        """
+        Returns META's header. If table is given, META's vocabulary is read
+        into it, and the tag index is returned too, or None if there isn't
+        one.
+        """
+        with open(self._meta_path, 'rb') as f:
+            reader, _, header = _read_header(f, self._meta_path)
+
+            if table is None:
+                return header
+
+            table.nfeatures = header['nfeatures']
+            table.last_change = header.get('last_change')
+            _read_vocabulary(reader, table)
+
+            if header['index']:
+                return header, _read_index(reader, table)
+
+            return header, None
+
+    def shards(self) -> List[int]:
+        """ Every shard there is, in order. """
+        return sorted(map(int, self._read_meta()['shards']))
+
+    def _read_shard(self, shard, table) -> Optional[int]:
+        """ Add a shard's rows to the end of table. Returns the save that
+        wrote it, or None if it's missing.
+        """
+        path = self._shard_path(shard)
+
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+        with f:
+            reader, version, header = _read_header(f, path)
+            table.odd_md5s.update((int(id_), md5)
+                                  for id_, md5 in reader.json().items())
+            table.odd_urls.update((int(id_), tuple(urls))
+                                  for id_, urls in reader.json().items())
+            _read_block(reader, table, version)
+
+        return header['save']
+
+    def load(self, table) -> Optional[tag_index.TagIndex]:
+        """
+        Read every shard into table, which should be a new, empty PostTable.
+        Returns the tag index, or None if there isn't one that matches.
+        """
+        header, index = self._read_meta(table)
+        matches = True
+
+        for shard in sorted(map(int, header['shards'])):
+            save = self._read_shard(shard, table)
+            matches = matches and save == header['shards'][str(shard)]
+
+        return index if matches else None
+
+    def save(self, table, index: Optional[tag_index.TagIndex] = None,
+             clean: Set[int] = frozenset(), codec=DEFAULT_CODEC) -> Set[int]:
+        """
+        Write table to the directory. Shards in clean haven't changed since
+        they were last loaded or saved, so they aren't rewritten. Returns
+        every shard that's now on disk, which are all clean.
+        """
+        os.makedirs(self.path, exist_ok=True)
+
+        # {shard: the save that wrote it, ...}
+        old = {}
+        if self.exists():
+            old = {int(shard): save for shard, save
+                   in self._read_meta()['shards'].items()}
+
+        this_save = max(old.values(), default=0) + 1
+
+        # {shard: (first row, end row), ...}
+        ranges = {}
+        row = 0
+
+        while row < len(table):
+            shard = self.shard_of(table.ids[row])
+            end = bisect.bisect_left(table.ids,
+                                     (shard + 1) * self.SHARD_SIZE, row)
+            ranges[shard] = (row, end)
+            row = end
+
+        saves = {shard: old[shard] if shard in clean and shard in old
+                 else this_save
+                 for shard in ranges}
+
+        self._write_meta(table, index, saves, codec)
+        self._vocabulary = None
+
+        for shard, (start, end) in ranges.items():
+            if saves[shard] == this_save:
+                self._write_shard(shard, table, start, end, this_save, codec)
+
+        self._remove_shards(old.keys() - ranges.keys())
+        return set(ranges)
+
+    def save_shards(self, vocabulary, tables, index=None,
+                    codec=DEFAULT_CODEC):
+        """
+        Like save, but only writes the shards in tables, which is {shard:
+        PostTable of just that shard, ...}. Every other shard on disk is left
+        as it is. vocabulary is a PostTable that they all share their tags and
+        authors with. See ShardedTable.
+        """
+        os.makedirs(self.path, exist_ok=True)
+
+        saves = {}
+        if self.exists():
+            saves = {int(shard): save for shard, save
+                     in self._read_meta()['shards'].items()}
+
+        this_save = max(saves.values(), default=0) + 1
+        empty = {shard for shard, table in tables.items() if len(table) == 0}
+
+        for shard in tables.keys() - empty:
+            saves[shard] = this_save
+
+        for shard in empty:
+            saves.pop(shard, None)
+
+        self._write_meta(vocabulary, index, saves, codec)
+
+        for shard in tables.keys() - empty:
+            self._write_shard(shard, tables[shard], 0, len(tables[shard]),
+                              this_save, codec)
+
+        self._remove_shards(empty)
+
+    def _write_meta(self, table, index, saves, codec):
+        """ META, with table's vocabulary and {shard: save, ...}. """
+        with open(self._meta_path + '.tmp', 'wb') as f:
+            writer = _write_header(
+                f, codec, nfeatures=table.nfeatures,
+                last_change=table.last_change,
+                shard_size=self.SHARD_SIZE, index=index is not None,
+                shards={str(shard): save for shard, save in saves.items()})
+            _write_vocabulary(writer, table)
+
+            if index is not None:
+                _write_index(writer, index)
+
+        os.replace(self._meta_path + '.tmp', self._meta_path)
+
+    def _write_shard(self, shard, table, start, end, save, codec):
+        """ Rows start to end of table, which all belong in shard. """
+        ids = table.ids[start:end]
+        path = self._shard_path(shard)
+
+        with open(path + '.tmp', 'wb') as f:
+            writer = _write_header(f, codec, rows=end - start, save=save)
+            writer.json({id_: table.odd_md5s[id_] for id_ in ids
+                         if id_ in table.odd_md5s})
+            writer.json({id_: table.odd_urls[id_] for id_ in ids
+                         if id_ in table.odd_urls})
+            _write_block(writer, table, start, end)
+
+        os.replace(path + '.tmp', path)
+        self._resident.pop(shard, None)
+
+    def _remove_shards(self, shards):
+        for shard in shards:
+            try:
+                os.remove(self._shard_path(shard))
+            except FileNotFoundError:
+                pass
+
+            self._resident.pop(shard, None)
+
+    def new_shard_table(self) -> 'post_data.PostTable':
+        """ An empty PostTable that shares META's vocabulary with every
+        other shard read from here.
+        """
+        if self._vocabulary is None:
+            self._vocabulary = post_data.PostTable()
+            self._read_meta(self._vocabulary)
+
+        table = post_data.PostTable()
+        for name in ('nfeatures', 'tag_names', 'tag_index', 'authors',
+                     'author_index'):
+            setattr(table, name, getattr(self._vocabulary, name))
+
+        return table
+
+    def _shard_table(self, shard) -> 'post_data.PostTable':
+        """ A PostTable of just one shard, from the LRU cache if it's there.
+        """
+        if shard in self._resident:
+            self._resident.move_to_end(shard)
+            return self._resident[shard]
+
+        table = self.new_shard_table()
+        self._read_shard(shard, table)
+        self._remember(shard, table)
+        return table
+
+    def _remember(self, shard, table):
+        """ Put a shard in the LRU cache, forgetting the oldest if it's full.
+        """
+        self._resident[shard] = table
+        self._resident.move_to_end(shard)
+
+        while len(self._resident) > self.max_resident:
+            self._resident.popitem(last=False)
+
+    def get(self, id_) -> 'post_data.PostView':
+        """ A PostView of one post, reading its shard if it isn't resident.
+        Raises KeyError if the post isn't there.
+        """
+        return self._shard_table(self.shard_of(id_)).get(id_)
+
+    def posts(self) -> Iterator['post_data.PostView']:
+        """ PostViews of every post, in order, one shard at a time. """
+        for shard in self.shards():
+            yield from self._shard_table(shard)
+
+
+class _ShardColumn(object):
+    """ table.ratings[row] and so on for a ShardedTable, for the few places
+    that read one row of a column at a time.
+    """
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    def __getitem__(self, row):
+        block, block_row = self.table._locate(row)
+        return getattr(block, self.name)[block_row]
+
+
+class ShardedTable(object):
+    """
+    Stands in for a PostTable that's kept in a ShardedCache, so that the
+    server can run on a cache that doesn't fit in memory. Only the id of
+    every post is kept, and the tag index, which is a lot smaller than the
+    posts themselves. Everything else is read from the shards as it's
+    needed, and only shards.max_resident of them are kept around. Shards
+    that posts have been added to or removed from stay in memory until save.
+
+    Rows are numbered across the whole cache, like in a PostTable, and
+    everything that looks at one row at a time works the same. Loops over
+    the columns themselves have to go through blocks(), one shard at a time.
+    """
+
+    # Rows that are far apart can mean reading a shard back in.
+    random_access = False
+
+    def __init__(self, shards: ShardedCache):
+        """ Use load instead. """
+        self.shards = shards
+        self.ids = array('l')
+        self.generation = 0
+
+        # {shard: PostTable, ...} for shards that have changed since they
+        # were loaded or saved.
+        self._dirty = {}
+
+        # Shares its tags and authors with every shard, and holds the rest
+        # of META.
+        self._vocabulary = post_data.PostTable()
+
+        self.ratings = _ShardColumn(self, 'ratings')
+        self.scores = _ShardColumn(self, 'scores')
+        self.author_ids = _ShardColumn(self, 'author_ids')
+
+    @classmethod
+    def load(cls, shards: ShardedCache
+             ) -> Tuple['ShardedTable', Optional[tag_index.TagIndex]]:
+        """
+        Returns (table, its tag index). Every shard is read once, to get the
+        ids, but only the last few are kept. The index is None if it doesn't
+        match the shards, like ShardedCache.load.
+        """
+        table = cls(shards)
+        header, index = shards._read_meta(table._vocabulary)
+        shards._vocabulary = table._vocabulary
+        matches = True
+
+        for shard in sorted(map(int, header['shards'])):
+            block = shards.new_shard_table()
+            save = shards._read_shard(shard, block)
+            matches = matches and save == header['shards'][str(shard)]
+
+            table.ids.extend(block.ids)
+            shards._remember(shard, block)
+
+        if index is None or not matches:
+            return table, None
+
+        index.table = table
+        return table, index
+
+    @property
+    def RATINGS(self):
+        return post_data.PostTable.RATINGS
+
+    @property
+    def nfeatures(self):
+        return self._vocabulary.nfeatures
+
+    @property
+    def last_change(self):
+        return self._vocabulary.last_change
+
+    @last_change.setter
+    def last_change(self, value):
+        self._vocabulary.last_change = value
+
+    @property
+    def tag_names(self):
+        return self._vocabulary.tag_names
+
+    @property
+    def tag_index(self):
+        return self._vocabulary.tag_index
+
+    @property
+    def authors(self):
+        return self._vocabulary.authors
+
+    @property
+    def author_index(self):
+        return self._vocabulary.author_index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id_):
+        try:
+            self.row(id_)
+        except KeyError:
+            return False
+
+        return True
+
+    def __iter__(self):
+        for block, _ in self.blocks():
+            yield from block
+
+    @property
+    def highest_id(self):
+        return self.ids[-1] if len(self.ids) > 0 else 0
+
+    def row(self, id_):
+        """ Raises KeyError if the post isn't in the table. """
+        row = bisect.bisect_left(self.ids, id_)
+
+        if row == len(self.ids) or self.ids[row] != id_:
+            raise KeyError(id_)
+
+        return row
+
+    def _range(self, shard) -> Tuple[int, int]:
+        """ (first row, end row) of a shard. """
+        start = bisect.bisect_left(self.ids, shard * self.shards.SHARD_SIZE)
+        end = bisect.bisect_left(self.ids,
+                                 (shard + 1) * self.shards.SHARD_SIZE, start)
+        return start, end
+
+    def _block(self, shard) -> 'post_data.PostTable':
+        if shard in self._dirty:
+            return self._dirty[shard]
+
+        return self.shards._shard_table(shard)
+
+    def _locate(self, row) -> Tuple['post_data.PostTable', int]:
+        """ (the row's shard, its row in that shard) """
+        id_ = self.ids[row]
+        block = self._block(self.shards.shard_of(id_))
+        return block, block.row(id_)
+
+    def blocks(self, rows=None
+               ) -> Iterator[Tuple['post_data.PostTable', Sequence]]:
+        """ Like PostTable.blocks, but one block per shard, or per run of
+        rows in the same shard.
+        """
+        if rows is None:
+            row = 0
+
+            while row < len(self.ids):
+                shard = self.shards.shard_of(self.ids[row])
+                start, end = self._range(shard)
+                yield self._block(shard), range(end - start)
+                row = end
+
+            return
+
+        block, block_rows, start, end = None, [], 0, 0
+
+        for row in rows:
+            if not start <= row < end:
+                if len(block_rows) > 0:
+                    yield block, block_rows
+
+                shard = self.shards.shard_of(self.ids[row])
+                start, end = self._range(shard)
+                block, block_rows = self._block(shard), []
+
+            block_rows.append(row - start)
+
+        if len(block_rows) > 0:
+            yield block, block_rows
+
+    def get(self, id_):
+        return self.view(self.row(id_))
+
+    def view(self, row):
+        block, block_row = self._locate(row)
+        return block.view(block_row)
+
+    def row_tag_ids(self, row):
+        block, block_row = self._locate(row)
+        return block.row_tag_ids(block_row)
+
+    def row_feature_ids(self, row):
+        block, block_row = self._locate(row)
+        return block.row_feature_ids(block_row)
+
+    def row_md5(self, row) -> Optional[bytes]:
+        block, block_row = self._locate(row)
+        return block.row_md5(block_row)
+
+    def _writable_block(self, id_) -> 'post_data.PostTable':
+        """ The shard for id_, kept in memory until the next save. """
+        shard = self.shards.shard_of(id_)
+
+        if shard not in self._dirty:
+            start, end = self._range(shard)
+
+            if start < end:
+                self._dirty[shard] = self.shards._shard_table(shard)
+                self.shards._resident.pop(shard, None)
+            else:
+                self._dirty[shard] = self.shards.new_shard_table()
+
+        return self._dirty[shard]
+
+    def add(self, data):
+        """ Like PostTable.add. """
+        id_ = int(data['id'])
+        block = self._writable_block(id_)
+        was_there = id_ in block
+
+        block.add(data)
+
+        if was_there and id_ not in block:
+            del self.ids[self.row(id_)]
+        elif id_ in block and not was_there:
+            self.ids.insert(bisect.bisect_left(self.ids, id_), id_)
+
+        self.generation += 1
+
+    def remove(self, id_):
+        """ Like PostTable.remove. """
+        if id_ in self:
+            self._writable_block(id_).remove(id_)
+            del self.ids[self.row(id_)]
+            self.generation += 1
+
+    # tag_index is a property in here, so this has to be a string.
+    def save(self, index: Optional['tag_index.TagIndex'] = None,
+             codec=DEFAULT_CODEC):
+        """ Write the shards that have changed, and META. """
+        self.shards.save_shards(self._vocabulary, self._dirty, index, codec)
+
+        for shard, block in self._dirty.items():
+            if len(block) > 0:
+                self.shards._remember(shard, block)
+
+        self._dirty = {}
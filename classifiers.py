@@ -0,0 +1,390 @@
+import math
+import random
+from array import array
+from typing import Dict, List, Tuple
+
+import post_data
+
+"""
+What PostGetter, the HTTP server and evaluation.py need from a classifier,
+and a logistic regression model to go with naive_bayes.NaiveBayesClassifier.
+post_getters.CLASSIFIERS has both, by name.
+
+Every classifier here scores a post linearly, in some space of its own:
+
+prediction = from_linear(bias + sum(tag_weight(tag) for tag in post))
+
+For naive Bayes that's log space and from_linear is exp. For logistic
+regression it's log-odds and from_linear is the sigmoid. Either way, a post's
+rank only depends on the sum, which is what lets TagIndex.top_k find the best
+posts without scoring all of them.
+"""
+
+
+class Classifier(object):
+    """
+    The interface:
+
+    fit(good_posts, bad_posts)      Train from scratch. A classmethod.
+    from_dataset(dataset)           The same, on a Dataset's votes.
+    partial_fit(post, is_good)      Train on one more vote. Also add_post.
+    remove_post(post, is_good)      Take a vote back out, if can_remove.
+    refit(dataset)                  Train from scratch, in place.
+    predict(post)                   Score one post's tags.
+    predict_many(table, rows)       Score rows of a PostTable.
+    explain(post)                   [(tag, tag_weight), ...], biggest first.
+    tag_weights(tag_names), bias, from_linear(x)   See the module docstring.
+
+    Posts are lists (or sets) of tag names, usually SimplePost.features, so
+    the extra features are just more tags as far as classifiers know.
+    Subclasses implement _train,
+    _compute_tag_weights, bias and from_linear, and can override anything
+    else to make it faster.
+
+    Classifiers that can't exactly undo add_post set can_remove to False.
+    For those, votes are taken back out by taking them out of the dataset
+    and calling refit.
+
+    Every classifier also counts votes per tag, for /stats and
+    mysteriousness:
+
+    self.tag_history = {'tag_name': [n_good_posts, n_total_posts], ...}
+    self.ngood, self.total, self.p_g
+    """
+
+    can_remove = True
+
+    def __init__(self, good_posts: List[List[str]],
+                 bad_posts: List[List[str]]):
+        good_posts, bad_posts = list(good_posts), list(bad_posts)
+
+        self.ngood = len(good_posts)
+        self.total = len(bad_posts) + len(good_posts)
+        self._update_p_g()
+
+        self.tag_history = dict()
+
+        # Bumped whenever the model changes, so cached weights know they're
+        # out of date. See _weight_cache.
+        self.version = 0
+        self._cached_version = None
+
+        for post in good_posts:
+            self._add_tags(post, True)
+
+        for post in bad_posts:
+            self._add_tags(post, False)
+
+    @classmethod
+    def fit(cls, good_posts, bad_posts, **kwargs):
+        return cls(good_posts, bad_posts, **kwargs)
+
+    @classmethod
+    def from_dataset(cls, dataset: post_data.Dataset, *args, workers=None,
+                     **kwargs):
+        """ Alternative constructor. All * and ** args passed to __init__
+
+        workers is ignored by classifiers that can't train in parallel.
+        """
+        good_posts = [i.features for i in dataset.get_good() if not i.deleted]
+        bad_posts  = [i.features for i in dataset.get_bad()  if not i.deleted]
+
+        return cls(good_posts, bad_posts, *args, **kwargs)
+
+    def _update_p_g(self):
+        try:
+            self.p_g = self.ngood / self.total
+        except ZeroDivisionError:
+            self.p_g = None
+
+    def _add_tags(self, post: List[str], is_good: bool, count=1):
+        """ count=-1 takes the post back out again. """
+        for tag in post:
+            if tag not in self.tag_history:
+                self.tag_history[tag] = [0, 0]
+
+            if is_good:
+                self.tag_history[tag][0] += count
+
+            self.tag_history[tag][1] += count
+
+            # A tag with no posts would make p_t() zero.
+            if self.tag_history[tag][1] <= 0:
+                del self.tag_history[tag]
+
+    def _train(self, post: List[str], is_good: bool, count: int):
+        """ Update the model itself for add_post (count=1) or remove_post
+        (count=-1). The counts are already up to date.
+        """
+        raise NotImplementedError
+
+    def add_post(self, post: List[str], is_good: bool):
+        """ Train on one more post, without starting over. """
+        self._add_tags(post, is_good)
+        self.ngood += is_good
+        self.total += 1
+        self._update_p_g()
+        self._train(post, is_good, 1)
+        self.version += 1
+
+    def remove_post(self, post: List[str], is_good: bool):
+        """ Undo add_post. """
+        self._add_tags(post, is_good, -1)
+        self.ngood -= is_good
+        self.total -= 1
+        self._update_p_g()
+        self._train(post, is_good, -1)
+        self.version += 1
+
+    def partial_fit(self, post: List[str], is_good: bool):
+        self.add_post(post, is_good)
+
+    def _options(self) -> Dict:
+        """ The keyword arguments that __init__ was given, for refit. """
+        return {}
+
+    def refit(self, dataset: post_data.Dataset):
+        """
+        Train from scratch on the dataset's votes, but in place, so that
+        everything that holds on to this classifier sees the new model.
+        """
+        version = self.version
+        fresh = type(self).from_dataset(dataset, **self._options())
+        self.__dict__ = fresh.__dict__
+        self.version = version + 1
+
+    @property
+    def bias(self) -> float:
+        raise NotImplementedError
+
+    @staticmethod
+    def from_linear(x: float) -> float:
+        raise NotImplementedError
+
+    def _compute_tag_weights(self, tag_names: List[str]) -> List[float]:
+        raise NotImplementedError
+
+    def _weight_cache(self):
+        """ Throws out the cached weights if the model has changed since
+        they were worked out.
+        """
+        if self._cached_version != self.version:
+            # {'tag_name': weight, ...}
+            self._tag_weights = {}
+
+            # (tag_names, array of weights), for tag_weights.
+            self._table_weights = (None, None)
+
+            self._cached_version = self.version
+
+    def __getstate__(self):
+        """ The cached weights aren't pickled. They're quick to work out
+        again, and tag_weights' cache is tied to one tag_names list anyway.
+        """
+        state = self.__dict__.copy()
+
+        for name in ('_tag_weights', '_table_weights'):
+            state.pop(name, None)
+
+        state['_cached_version'] = None
+        return state
+
+    def tag_weight(self, tag) -> float:
+        """
+        How much this tag adds to a post's score, before from_linear. 0 for
+        tags the model knows nothing about.
+
+        Cached until the next add_post or remove_post.
+        """
+        self._weight_cache()
+
+        try:
+            return self._tag_weights[tag]
+        except KeyError:
+            weight = self._compute_tag_weights([tag])[0]
+            self._tag_weights[tag] = weight
+            return weight
+
+    def tag_weights(self, tag_names: List[str]) -> array:
+        """
+        tag_weight for every tag in tag_names, in the same order.
+
+        Cached until the next add_post or remove_post. If tag_names is a
+        PostTable's vocabulary and it only grew since last time, only the new
+        tags are worked out. Don't change the array you get back.
+        """
+        self._weight_cache()
+        cached_names, weights = self._table_weights
+
+        if cached_names is not tag_names:
+            weights = array('d')
+            self._table_weights = (tag_names, weights)
+
+        if len(weights) < len(tag_names):
+            weights.extend(self._compute_tag_weights(
+                tag_names[len(weights):]))
+
+        return weights
+
+    def predict(self, post: List[str]) -> float:
+        return self.from_linear(self.bias + sum(map(self.tag_weight, post)))
+
+    def predict_many(self, table: post_data.PostTable, rows=None,
+                     workers=None) -> array:
+        """
+        predict for many rows of a PostTable at once, in the same order as
+        rows (every row by default). workers is ignored by classifiers that
+        can't score in parallel.
+        """
+        weights = self.tag_weights(table.tag_names)
+        bias, from_linear = self.bias, self.from_linear
+        predictions = array('d')
+
+        for block, block_rows in table.blocks(rows):
+            offsets, tag_ids = block.tag_offsets, block.tag_ids
+            predictions.extend(
+                from_linear(bias + sum(weights[tag_ids[j]]
+                                       for j in range(offsets[row],
+                                                      offsets[row+1])))
+                for row in block_rows)
+
+        return predictions
+
+    def explain(self, post: List[str]) -> List[Tuple[str, float]]:
+        """
+        Why did this post get the prediction it did? Returns each tag's
+        tag_weight, biggest first. Adding them all to bias, and then calling
+        from_linear, gives predict(post).
+        """
+        return sorted(((tag, self.tag_weight(tag)) for tag in post),
+                      key=lambda i: i[1], reverse=True)
+
+    def tag_mysteriousness(self, tag) -> float:
+        """ 1 / (1 + the number of votes on posts with this tag). 1.0 for a
+        tag we've never seen, and closer to 0 the more we know about it.
+        """
+        return 1 / (1 + self.tag_history.get(tag, (0, 0))[1])
+
+    def mysteriousness(self, post: List[str]) -> float:
+        """
+        How mysterious is this post? How little do we know about its tags?
+
+        The sum of tag_mysteriousness over its tags, so a vote on a post with
+        lots of tags we know little about teaches us the most. Voting can
+        only ever make posts less mysterious, never more. Only taking votes
+        back out (remove_post without a matching add_post) does that.
+        """
+        return sum(map(self.tag_mysteriousness, post))
+
+    def mysteriousness_table(self, table: post_data.PostTable,
+                             rows=None) -> array:
+        """ Like predict_many, but for mysteriousness. """
+        weights = array('d', map(self.tag_mysteriousness, table.tag_names))
+        mysteriousness = array('d')
+
+        for block, block_rows in table.blocks(rows):
+            offsets, tag_ids = block.tag_offsets, block.tag_ids
+            mysteriousness.extend(
+                sum(weights[tag_ids[j]]
+                    for j in range(offsets[row], offsets[row+1]))
+                for row in block_rows)
+
+        return mysteriousness
+
+
+def sigmoid(x: float) -> float:
+    """ 1 / (1 + e^-x), without overflowing for big negative x. """
+    if x >= 0:
+        return 1 / (1 + math.exp(-x))
+
+    z = math.exp(x)
+    return z / (1 + z)
+
+
+class LogisticClassifier(Classifier):
+    """
+    Logistic regression on which tags a post has, trained with stochastic
+    gradient descent and L2 regularisation:
+
+    P(G | tags) = sigmoid(bias + sum(weights[tag] for tag in tags))
+
+    Unlike naive Bayes, it doesn't assume that tags are independent, so tags
+    that always come together don't count twice. Its predictions are real
+    probabilities, too.
+
+    Every gradient step only touches the weights of the post's own tags, so
+    an epoch costs about as much as counting the tags once. New votes are
+    learned with a few extra steps on just that post. Those steps depend on
+    the weights at the time, so stepping the other way wouldn't undo them,
+    and remove_post isn't supported. Use refit instead.
+    """
+
+    can_remove = False
+
+    def __init__(self, good_posts: List[List[str]],
+                 bad_posts: List[List[str]], epochs=10, learning_rate=0.1,
+                 l2=1e-4, seed=0):
+        good_posts, bad_posts = list(good_posts), list(bad_posts)
+        super().__init__(good_posts, bad_posts)
+
+        self.epochs = epochs
+        self.learning_rate = learning_rate
+        self.l2 = l2
+        self.seed = seed
+
+        # {'tag_name': weight, ...}
+        self.weights: Dict[str, float] = {}
+
+        # Start from the base rate, so that unknown posts get P(G).
+        p_g = min(max(self.p_g or 0.5, 1e-6), 1 - 1e-6)
+        self.intercept = math.log(p_g / (1 - p_g))
+
+        examples = ([(list(post), True) for post in good_posts]
+                    + [(list(post), False) for post in bad_posts])
+        rand = random.Random(seed)
+
+        for epoch in range(epochs):
+            rand.shuffle(examples)
+
+            # Smaller steps as we go, so it settles down.
+            rate = learning_rate / (1 + epoch)
+
+            for post, is_good in examples:
+                self._step(post, is_good, rate)
+
+    def _step(self, post, is_good, rate):
+        weights = self.weights
+        z = self.intercept + sum(weights.get(tag, 0.0) for tag in post)
+        gradient = sigmoid(z) - is_good
+
+        for tag in post:
+            weight = weights.get(tag, 0.0)
+            weights[tag] = weight - rate * (gradient + self.l2 * weight)
+
+        self.intercept -= rate * gradient
+
+    # How many steps to take on a single new vote.
+    PARTIAL_FIT_STEPS = 3
+
+    def _train(self, post, is_good, count):
+        post = list(post)
+
+        for _ in range(self.PARTIAL_FIT_STEPS):
+            self._step(post, is_good, self.learning_rate)
+
+    def remove_post(self, post: List[str], is_good: bool):
+        raise NotImplementedError(
+            "LogisticClassifier can't take votes back out. Use refit.")
+
+    def _options(self) -> Dict:
+        return {'epochs': self.epochs, 'learning_rate': self.learning_rate,
+                'l2': self.l2, 'seed': self.seed}
+
+    @property
+    def bias(self) -> float:
+        return self.intercept
+
+    from_linear = staticmethod(sigmoid)
+
+    def _compute_tag_weights(self, tag_names: List[str]) -> List[float]:
+        return [self.weights.get(tag, 0.0) for tag in tag_names]
@@ -3,6 +3,10 @@ import sys
 import post_data
 import ahto_lib
 import hhapi
+import evaluation
+import post_getters
+import portable
+import profiling
 
 """
 Takes a command from sys.argv. Basically a low-level CLI frontend to the rest
@@ -32,6 +36,10 @@ of my code, for doing things that you can't yet do from HTTP.
 
 class CommandHandler(object):
     def __call__(self, args):
+        # --profile can go anywhere. See profiling.py.
+        profile = '--profile' in args
+        args = [i for i in args if i != '--profile']
+
         try:
             script_name, command, *args = args
         except ValueError:
@@ -44,12 +52,19 @@ class CommandHandler(object):
             self.usage(script_name)
             exit(1)
 
-        getattr(self, f'do_{command}')(args)
+        if profile:
+            with profiling.profiled(command) as result:
+                getattr(self, f'do_{command}')(args)
+
+            print(profiling.report(result.name, limit=30))
+            print("Profile saved to:", result.path)
+        else:
+            getattr(self, f'do_{command}')(args)
 
     def usage(self, script_name):
         """ Print a simple help message, based on the docstrings of every do_*
         method. """
-        print("Usage:", script_name, "<command>")
+        print("Usage:", script_name, "[--profile] <command>")
         print()
         print("Possible commands:")
 
@@ -67,11 +82,17 @@ class CommandHandler(object):
         self.dataset.update_cache(print_progress=True)
         self.dataset.save()
 
+    def do_refresh(self, args):
+        '''refresh: Fetch cached posts that have changed on Hypnohub.'''
+        changes = self.dataset.refresh_cache(print_progress=True)
+        print(len(changes), "posts changed.")
+        self.dataset.save()
+
     def do_reset(self, args):
         '''reset: Clear the Hypnohub cache.'''
         if ahto_lib.yes_no(False, "Reset cache? Are you sure?"):
             print("Erasing cache...")
-            self.dataset.cache = {}
+            self.dataset.reset_cache()
             self.dataset.save()
         else:
             print("Your cache is safe!")
@@ -125,6 +146,49 @@ class CommandHandler(object):
         with ahto_lib.LoadingDone('Saving...'):
             self.dataset.save()
 
+    def do_export(self, args):
+        '''export <file>: Save votes and cache to a portable .jsonl.gz.'''
+        # Straight from the shards on disk, without loading the whole cache,
+        # unless it's still in an older format.
+        dataset = post_data.Dataset(load_cache=False)
+
+        if dataset.shards.exists():
+            posts = dataset.shards.posts()
+        else:
+            dataset, posts = self.dataset, None
+
+        with ahto_lib.LoadingDone(f"Exporting to {args[0]}..."):
+            count = portable.export_dataset(dataset, args[0], posts=posts)
+
+        print("Exported", count, "posts,", len(dataset.good), "good and",
+              len(dataset.bad), "bad votes.")
+
+    def do_import(self, args):
+        '''import <file>: Add votes and posts from an export.'''
+        with ahto_lib.LoadingDone(f"Importing {args[0]}..."):
+            posts, votes = portable.import_dataset(self.dataset, args[0])
+
+        print("Imported", posts, "posts and", votes, "votes.")
+
+        with ahto_lib.LoadingDone("Saving..."):
+            self.dataset.save()
+
+    def do_evaluate(self, args):
+        '''evaluate [folds] [classifier]: Cross-validate on your votes.'''
+        folds = int(args[0]) if len(args) >= 1 else 5
+        classifier = args[1] if len(args) >= 2 else 'naive_bayes'
+
+        if classifier not in post_getters.CLASSIFIERS:
+            print("Classifiers:", ', '.join(post_getters.CLASSIFIERS))
+            return
+
+        with ahto_lib.LoadingDone("Evaluating..."):
+            results = evaluation.evaluate(
+                self.dataset, folds,
+                classifier=post_getters.CLASSIFIERS[classifier])
+
+        print(evaluation.report(results))
+
 
 if __name__ == '__main__':
     ch = CommandHandler()
@@ -0,0 +1,185 @@
+import random
+from typing import Dict, List, Set, Tuple, Union
+
+"""
+Finds reuploads and near-identical variants of posts, so that PostGetter can
+avoid showing a whole run of the same picture.
+
+Two posts count as duplicates if they have the same md5, or if their tag sets
+are nearly the same. Comparing the tags of every pair of posts would take
+forever, so near-duplicates are found with MinHash and locality-sensitive
+hashing: every post gets a few short signatures (bands) of its tag ids, and
+only posts that share a whole band are ever compared.
+
+Each band uses its own hash function, and is the ROWS smallest hashes of the
+post's tags (a bottom-k sketch), which is about as selective as ROWS separate
+MinHashes for a fraction of the work.
+
+https://en.wikipedia.org/wiki/MinHash
+"""
+
+# A prime bigger than any tag id, for the hash functions.
+_PRIME = (1 << 61) - 1
+
+
+# Almost every md5 and band belongs to just one post, so groups of one are
+# stored as a bare post id instead of a list. A list or set per post would
+# cost more memory than the whole cache.
+
+def _group_add(groups, key, id_):
+    group = groups.get(key)
+
+    if group is None:
+        groups[key] = id_
+    elif isinstance(group, int):
+        groups[key] = [group, id_]
+    else:
+        group.append(id_)
+
+
+def _group_discard(groups, key, id_):
+    group = groups.get(key)
+
+    if group == id_:
+        del groups[key]
+    elif isinstance(group, list) and id_ in group:
+        group.remove(id_)
+
+        if len(group) == 1:
+            groups[key] = group[0]
+
+
+def _group_members(groups, key) -> List[int]:
+    group = groups.get(key, [])
+    return [group] if isinstance(group, int) else group
+
+
+class DuplicateIndex(object):
+    """
+    Keep it in step with the table by calling add() after a post is added and
+    discard() before it's removed, just like tag_index.TagIndex. Dataset does
+    this for you.
+
+    self.md5_groups = {md5_bytes: [post_id, ...] or post_id, ...}
+    self.buckets    = {band_hash: [post_id, ...] or post_id, ...}
+    """
+
+    # With 4 bands of 3, posts whose tags are 80% the same share a band
+    # about 95% of the time, and posts that are 40% the same only about 25%
+    # of the time. Candidates are then checked against THRESHOLD exactly.
+    BANDS = 4
+    ROWS = 3
+    THRESHOLD = 0.8
+
+    # Posts with fewer tags than this are never near-duplicates, because a
+    # couple of common tags say nothing about whether two pictures match.
+    MIN_TAGS = 5
+
+    # Buckets bigger than this are full of unrelated posts that happen to
+    # share a few very common tags, so they aren't searched.
+    MAX_BUCKET = 100
+
+    def __init__(self, table, seed=0):
+        self.table = table
+
+        rand = random.Random(seed)
+        self.hash_params = [(rand.randrange(1, _PRIME), rand.randrange(_PRIME))
+                            for _ in range(self.BANDS)]
+
+        # Hashes of every tag id, worked out the first time they're needed.
+        self._tag_hashes: List[Tuple[int, ...]] = []
+
+        self.md5_groups: Dict[bytes, Union[int, List[int]]] = {}
+        self.buckets: Dict[int, Union[int, List[int]]] = {}
+
+        for row in range(len(table)):
+            self.add(table.ids[row])
+
+    def bands(self, tag_ids) -> Tuple[Tuple[int, ...], ...]:
+        """ The ROWS smallest hashes of the tag ids, for each hash function.
+        """
+        while len(self._tag_hashes) <= max(tag_ids):
+            x = len(self._tag_hashes)
+            self._tag_hashes.append(tuple((a*x + b) % _PRIME
+                                          for a, b in self.hash_params))
+
+        rows = self.ROWS
+        return tuple(tuple(sorted(column)[:rows]) for column in
+                     zip(*map(self._tag_hashes.__getitem__, tag_ids)))
+
+    def band_keys(self, row) -> Tuple[int, ...]:
+        """ The buckets that a row goes in. There are none for posts with
+        too few tags.
+        """
+        tag_ids = self.table.row_tag_ids(row)
+
+        if len(tag_ids) < self.MIN_TAGS:
+            return ()
+
+        return tuple(map(hash, enumerate(self.bands(tag_ids))))
+
+    def _md5(self, row):
+        """ None for posts with an odd md5, which we don't group. """
+        return self.table.row_md5(row)
+
+    def add(self, id_):
+        """ Index a post that's just been added to the table. """
+        row = self.table.row(id_)
+
+        md5 = self._md5(row)
+        if md5 is not None:
+            _group_add(self.md5_groups, md5, id_)
+
+        for key in self.band_keys(row):
+            _group_add(self.buckets, key, id_)
+
+    def discard(self, id_):
+        """ Un-index a post that's about to be removed from the table. Does
+        nothing if the post isn't there.
+        """
+        try:
+            row = self.table.row(id_)
+        except KeyError:
+            return
+
+        md5 = self._md5(row)
+        if md5 is not None:
+            _group_discard(self.md5_groups, md5, id_)
+
+        for key in self.band_keys(row):
+            _group_discard(self.buckets, key, id_)
+
+    def duplicates(self, id_) -> Set[int]:
+        """ Every post that looks like a duplicate of this one, not including
+        itself. Empty for posts that aren't in the table.
+        """
+        try:
+            row = self.table.row(id_)
+        except KeyError:
+            return set()
+
+        md5 = self._md5(row)
+        result = set(_group_members(self.md5_groups, md5))
+
+        candidates = set()
+        for key in self.band_keys(row):
+            bucket = _group_members(self.buckets, key)
+
+            if len(bucket) <= self.MAX_BUCKET:
+                candidates.update(bucket)
+
+        candidates -= result
+        candidates.discard(id_)
+
+        if len(candidates) > 0:
+            tags = set(self.table.row_tag_ids(row))
+
+            for candidate in candidates:
+                other = set(self.table.row_tag_ids(self.table.row(candidate)))
+
+                if (len(tags & other) / len(tags | other)
+                        >= self.THRESHOLD):
+                    result.add(candidate)
+
+        result.discard(id_)
+        return result
@@ -0,0 +1,167 @@
+import random
+import math
+import sys
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import post_data
+import naive_bayes
+import post_getters
+
+"""
+Offline evaluation for the classifier. Uses k-fold cross-validation over the
+user's votes to measure how well it ranks posts, and times how fast it trains
+and scores. Nothing here talks to Hypnohub, so it works just as well on a
+synthetic dataset as on the real one.
+
+Run it on the dataset on disk with: python evaluation.py [classifier]
+
+Where classifier is a name from post_getters.CLASSIFIERS, like "logistic".
+"""
+
+
+def k_fold(ids, k=5, seed=None) -> List[Tuple[List[int], List[int]]]:
+    """
+    Shuffle ids and split them into k folds. Returns one (train, test) pair
+    per fold, where each fold takes a turn being the test set.
+    """
+    ids = sorted(ids)
+    random.Random(seed).shuffle(ids)
+
+    folds = [ids[i::k] for i in range(k)]
+
+    return [([id_ for j, fold in enumerate(folds) if j != i for id_ in fold],
+             folds[i])
+            for i in range(k)]
+
+
+def precision_at_k(scores: Sequence[float], labels: Sequence[bool],
+                   k=10) -> float:
+    """ Out of the k highest scored posts, what portion are actually good? """
+    ranked = sorted(zip(scores, labels), key=lambda i: i[0], reverse=True)
+    top = ranked[:k]
+
+    if len(top) == 0:
+        return 0.0
+
+    return sum(1 for _, label in top if label) / len(top)
+
+
+def roc_auc(scores: Sequence[float], labels: Sequence[bool]) -> float:
+    """
+    The chance that a random good post is scored higher than a random bad one
+    (ties count as half). 0.5 is no better than guessing.
+
+    Computed from ranks (the Mann-Whitney U statistic), so it's O(n log n)
+    instead of comparing every pair.
+    """
+    ranked = sorted(zip(scores, labels), key=lambda i: i[0])
+    npos = sum(1 for label in labels if label)
+    nneg = len(labels) - npos
+
+    if npos == 0 or nneg == 0:
+        return math.nan
+
+    # Sum of the (1-based, tie-averaged) ranks of the good posts.
+    rank_sum = 0.0
+    i = 0
+    while i < len(ranked):
+        j = i
+        while j < len(ranked) and ranked[j][0] == ranked[i][0]:
+            j += 1
+
+        average_rank = (i + 1 + j) / 2
+        rank_sum += average_rank * sum(1 for _, label in ranked[i:j] if label)
+        i = j
+
+    return (rank_sum - npos * (npos + 1) / 2) / (npos * nneg)
+
+
+def log_loss(probabilities: Sequence[float], labels: Sequence[bool],
+             eps=1e-15) -> float:
+    """
+    Average negative log-likelihood of the labels. Lower is better.
+
+    The NBC's predictions aren't real probabilities (they can go over 1.0),
+    so they're clipped to [eps, 1-eps] first.
+    """
+    if len(labels) == 0:
+        return math.nan
+
+    total = 0.0
+    for p, label in zip(probabilities, labels):
+        p = min(max(p, eps), 1 - eps)
+        total -= math.log(p if label else 1 - p)
+
+    return total / len(labels)
+
+
+def evaluate(dataset: post_data.Dataset, folds=5, k=10, seed=None,
+             classifier=naive_bayes.NaiveBayesClassifier) -> Dict:
+    """
+    Cross-validate a classifier on the dataset's votes. Votes on posts that
+    aren't in the cache are ignored.
+
+    Returns: {
+        'folds': [{metric: value, ...}, ...],
+        'mean':  {metric: value, ...},
+    }
+
+    Metrics are precision_at_k, roc_auc, log_loss, train_seconds,
+    score_seconds and posts_per_second. The last two time scoring every post
+    in the cache, not just the test fold, to measure throughput.
+    """
+    table = dataset.cache
+    labelled = {i: True for i in dataset.good if i in table}
+    labelled.update({i: False for i in dataset.bad if i in table})
+
+    def tags(id_):
+        return table.get(id_).features
+
+    results = []
+
+    for train, test in k_fold(labelled.keys(), folds, seed):
+        start = time.perf_counter()
+        nbc = classifier.fit([tags(i) for i in train if labelled[i]],
+                             [tags(i) for i in train if not labelled[i]])
+        train_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        nbc.predict_many(table)
+        score_seconds = time.perf_counter() - start
+
+        scores = nbc.predict_many(table, [table.row(i) for i in test])
+        labels = [labelled[i] for i in test]
+
+        results.append({
+            'precision_at_k':   precision_at_k(scores, labels, k),
+            'roc_auc':          roc_auc(scores, labels),
+            'log_loss':         log_loss(scores, labels),
+            'train_seconds':    train_seconds,
+            'score_seconds':    score_seconds,
+            'posts_per_second': len(table) / max(score_seconds, 1e-9),
+        })
+
+    mean = {metric: sum(i[metric] for i in results) / max(len(results), 1)
+            for metric in (results[0] if results else {})}
+
+    return {'folds': results, 'mean': mean}
+
+
+def report(results: Dict) -> str:
+    lines = []
+
+    for i, fold in enumerate(results['folds'] + [results['mean']]):
+        name = 'mean' if i == len(results['folds']) else f'fold {i}'
+        lines.append(f"{name}:")
+
+        for metric, value in fold.items():
+            lines.append(f"    {metric:<16} {value:.4f}")
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else 'naive_bayes'
+    print(report(evaluate(post_data.Dataset(),
+                          classifier=post_getters.CLASSIFIERS[name])))
@@ -0,0 +1,291 @@
+import argparse
+import bisect
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+from typing import Dict, Iterable, Set
+
+import synthetic
+
+"""
+A local stand-in for Hypnohub's post/index.json API, for load testing and
+offline testing of anything in hhapi. It understands enough of the search
+syntax for what we actually send:
+
+order:id, order:id_desc   Sort order. Newest first by default, like Hypnohub.
+order:change              Oldest change first. Also order:change_desc.
+id:>N, id:<N, id:N        Filter by id. Also >= and <=.
+change:>N                 Filter by change number, the same way.
+vote:LEVEL:USER           Posts that USER voted LEVEL on.
+foo -bar                  Posts with the tag foo and without bar.
+
+Plus the limit and page parameters. It can also slow down or fail requests on
+purpose, to test how the crawler deals with a struggling server, and edit
+posts, to test how it keeps up with changes. See edit.
+
+Use it from code:
+
+    with FakeHypnohub(posts) as fake:
+        hhapi.BASE_URL = fake.url
+        ...
+
+Or on its own: python fake_hypnohub.py --posts 100000 --port 8001
+"""
+
+
+class FakeHypnohub(object):
+    """
+    posts: Raw post JSON, like synthetic.generate_posts gives.
+    votes: {(vote_level, user): {post_id, ...}, ...}
+
+    latency:     Seconds to wait before answering every request.
+    error_rate:  Chance that a request fails with a 500 error.
+    fail_every:  If set, every fail_every'th request fails with a 500, which
+                 is handy when the test needs to be deterministic.
+    """
+    DEFAULT_LIMIT = 16
+    MAX_LIMIT = 100
+
+    def __init__(self, posts: Iterable[Dict], votes=None,
+                 server_address=('127.0.0.1', 0), latency=0.0,
+                 error_rate=0.0, fail_every=None, seed=None):
+        self.posts = sorted(posts, key=lambda post: post['id'])
+        self.ids = [post['id'] for post in self.posts]
+        self.votes: Dict[tuple, Set[int]] = votes or {}
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fail_every = fail_every
+        self.random = random.Random(seed)
+
+        # Every post has a 'change' number, and every edit gets a higher one
+        # than anything before it, like Hypnohub's.
+        self.last_change = max((post.get('change', 0)
+                                for post in self.posts), default=0)
+
+        # How many requests we've had, and how many we failed on purpose.
+        self.request_count = 0
+        self.error_count = 0
+        self.lock = threading.Lock()
+
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(server_address,
+                                                      Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def should_fail(self):
+        with self.lock:
+            self.request_count += 1
+
+            fail = ((self.fail_every is not None
+                     and self.request_count % self.fail_every == 0)
+                    or self.random.random() < self.error_rate)
+
+            if fail:
+                self.error_count += 1
+
+            return fail
+
+    def handle(self, handler):
+        url = urllib.parse.urlparse(handler.path)
+
+        if url.path == '/robots.txt':
+            self.send(handler, 200, 'text/plain', '')
+            return
+
+        if url.path != '/post/index.json':
+            self.send(handler, 404, 'text/plain', 'Not found')
+            return
+
+        time.sleep(self.latency)
+
+        if self.should_fail():
+            self.send(handler, 500, 'text/plain', 'Injected error')
+            return
+
+        query = urllib.parse.parse_qs(url.query)
+
+        try:
+            posts = self.search(
+                query.get('tags', [''])[0],
+                int(query.get('limit', [self.DEFAULT_LIMIT])[0]),
+                int(query.get('page', [1])[0]))
+        except ValueError as e:
+            self.send(handler, 400, 'text/plain', str(e))
+            return
+
+        self.send(handler, 200, 'application/json', json.dumps(posts))
+
+    @staticmethod
+    def send(handler, code, content_type, body):
+        body = bytes(body, 'utf8')
+        handler.send_response(code)
+        handler.send_header('Content-type', content_type)
+        handler.send_header('Content-length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def edit(self, id_, **fields):
+        """
+        Change a post, the way someone editing it on Hypnohub would, and give
+        it a new change number. deleted=True deletes it, which leaves only
+        the fields that Hypnohub still shows for a deleted post.
+        """
+        row = bisect.bisect_left(self.ids, id_)
+        post = self.posts[row]
+
+        if fields.pop('deleted', False):
+            post = {'id': id_, 'status': 'deleted'}
+
+        with self.lock:
+            self.last_change += 1
+            self.posts[row] = dict(post, change=self.last_change, **fields)
+
+    def search(self, tags, limit=DEFAULT_LIMIT, page=1):
+        """ The posts that Hypnohub would return, as a list of JSON. """
+        filters = []
+        descending = True
+        by_change = False
+
+        # id: filters narrow down the range of posts to look at, so that
+        # crawling with id:>N doesn't mean scanning every post every time.
+        # Our posts are sorted by id, so self.posts[low:high] is the range.
+        low, high = 0, len(self.posts)
+
+        for term in tags.split():
+            if term == 'order:id':
+                descending = False
+            elif term == 'order:id_desc':
+                descending = True
+            elif term == 'order:change':
+                descending, by_change = False, True
+            elif term == 'order:change_desc':
+                descending, by_change = True, True
+            elif term.startswith('id:'):
+                term_low, term_high = self.id_range(term[len('id:'):])
+                low, high = max(low, term_low), min(high, term_high)
+            elif term.startswith('change:'):
+                filters.append(self.change_filter(term[len('change:'):]))
+            elif term.startswith('vote:'):
+                _, level, user = term.split(':', 2)
+                voted = self.votes.get((int(level), user), set())
+                filters.append(lambda post, voted=voted: post['id'] in voted)
+            elif term.startswith('-'):
+                filters.append(lambda post, tag=term[1:]:
+                               tag not in post['tags'].split(' '))
+            else:
+                filters.append(lambda post, tag=term:
+                               tag in post['tags'].split(' '))
+
+        rows = range(low, high)
+        if descending:
+            rows = reversed(rows)
+
+        matches = (self.posts[row] for row in rows
+                   if all(f(self.posts[row]) for f in filters))
+
+        if by_change:
+            matches = iter(sorted(matches,
+                                  key=lambda post: post.get('change', 0),
+                                  reverse=descending))
+
+        limit = min(limit, self.MAX_LIMIT)
+        skip = (max(page, 1) - 1) * limit
+
+        return [post for i, post in zip(range(skip + limit), matches)
+                if i >= skip]
+
+    def id_range(self, condition):
+        """ Turns '>1337' (etc.) into a (low, high) slice of self.posts. """
+        for op in ['>=', '<=', '>', '<', '']:
+            if condition.startswith(op):
+                value = int(condition[len(op):])
+                break
+
+        left = bisect.bisect_left(self.ids, value)
+        right = bisect.bisect_right(self.ids, value)
+
+        return {
+            '>=': (left, len(self.ids)),
+            '<=': (0, right),
+            '>':  (right, len(self.ids)),
+            '<':  (0, left),
+            '':   (left, right),
+        }[op]
+
+
+    @staticmethod
+    def change_filter(condition):
+        """ Turns '>1337' (etc.) into a filter on posts' change numbers.
+        """
+        for op in ['>=', '<=', '>', '<', '']:
+            if condition.startswith(op):
+                value = int(condition[len(op):])
+                break
+
+        compare = {
+            '>=': lambda change: change >= value,
+            '<=': lambda change: change <= value,
+            '>':  lambda change: change > value,
+            '<':  lambda change: change < value,
+            '':   lambda change: change == value,
+        }[op]
+
+        return lambda post: compare(post.get('change', 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve fake Hypnohub posts on post/index.json.")
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    fake = FakeHypnohub(
+        synthetic.generate_posts(args.posts, seed=args.seed),
+        server_address=('127.0.0.1', args.port),
+        latency=args.latency,
+        error_rate=args.error_rate,
+        seed=args.seed)
+
+    print(f"Serving {len(fake.posts)} fake posts on: {fake.url}/")
+    print(f"Use it with: HYPNOHUB_URL={fake.url}")
+
+    with fake:
+        try:
+            fake.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
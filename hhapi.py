@@ -1,3 +1,4 @@
+import os
 import time
 import json
 import urllib.robotparser
@@ -6,11 +7,20 @@ import requests
 
 import post_data
 import ahto_lib
+import metrics
 
 BASE_USERAGENT = "AhtoHypnohubCrawlerBot/0.0"
 USERAGENT = BASE_USERAGENT + " (mailto://weirdusername@techie.com)"
 DELAY_BETWEEN_REQUESTS = 2
 
+# Point this somewhere else (like a fake_hypnohub.FakeHypnohub) for testing.
+# Can also be set with the HYPNOHUB_URL environment variable.
+BASE_URL = os.environ.get('HYPNOHUB_URL', "http://hypnohub.net")
+
+# How many times to retry a request that fails with a server or connection
+# error. Each retry waits twice as long as the last.
+MAX_RETRIES = 3
+
 """
 This file is for communicating with the Hypnohub API (hence the name) and
 processing Hypnohub's responses.
@@ -28,8 +38,7 @@ def check_robots_txt():
 
     Last I checked (2017-11-16), HypnoHub's robots.txt was completely blank.
     """
-    rp = urllib.robotparser.RobotFileParser(
-        "http://hypnohub.net/robots.txt")
+    rp = urllib.robotparser.RobotFileParser(BASE_URL + "/robots.txt")
 
     rp.read()
     time.sleep(DELAY_BETWEEN_REQUESTS)
@@ -65,8 +74,26 @@ def get_posts(tags=None, page=None, limit=None):
     if tags is not None:
         params['tags'] = tags
 
-    response = requests.get("http://hypnohub.net/post/index.json",
-                            params=params, headers={'User-agent': USERAGENT})
+    delay = DELAY_BETWEEN_REQUESTS
+    for retry in range(MAX_RETRIES + 1):
+        try:
+            with metrics.timed('hypnohub_upstream_request_seconds',
+                               "Time spent waiting on Hypnohub's API."):
+                response = requests.get(BASE_URL + "/post/index.json",
+                                        params=params,
+                                        headers={'User-agent': USERAGENT})
+            response.raise_for_status()
+        except (requests.ConnectionError, requests.HTTPError) as e:
+            # Only retry things that might be temporary.
+            if (retry == MAX_RETRIES
+                    or (isinstance(e, requests.HTTPError)
+                        and e.response.status_code < 500)):
+                raise
+
+            time.sleep(delay)
+            delay *= 2
+        else:
+            break
 
     time.sleep(DELAY_BETWEEN_REQUESTS)
 
@@ -100,14 +127,13 @@ def get_vote_data(user, vote_level):
             f'vote:{vote_level}:{user} order:id id:>{max_post}')
         new_post_ids = {i['id'] for i in posts}
 
-        if __debug__ and len(new_post_ids) != 0:
+        if len(new_post_ids) == 0:
+            break
+
+        if __debug__:
             assert len(new_post_ids & post_ids) < len(new_post_ids)
 
         post_ids |= new_post_ids
-
-        if max_post == max(*post_ids):
-            break
-
-        max_post = max(*post_ids)
+        max_post = max(post_ids)
 
     return post_ids
@@ -1,16 +1,21 @@
 import os
+import io
 import http.server
 import urllib.parse
 import math
+import json
 import queue
 import threading
 import time
 import random
 
 import post_data
-import naive_bayes
-import post_getters
+import metrics
+import stats
+import profiling
+import http_server.sessions as sessions
 import http_server.html_generator as html_generator
+import http_server.compression as compression
 
 """
 This file is for interacting with the user's web browser in various ways.
@@ -44,22 +49,166 @@ class StatefulRequestHandler(object):
     class has a split personality.
 
     Also the server is built into this class because why not.
+
+    Connections are kept alive between requests (HTTP/1.1), so a page and its
+    scripts and styles don't each need a new one. For that, every response
+    needs a Content-Length, so whatever a handler writes to dh.wfile is
+    buffered, and only sent once the handler is done. That's also where the
+    body gets compressed, if the browser takes gzip or deflate. See
+    compression.py.
+
+    Every connection gets its own thread, so that one browser holding a
+    connection open doesn't block everyone else. Only one request is handled
+    at a time, though, so nothing else has to worry about threads.
     """
+
+    # Seconds that an idle connection is kept open for.
+    KEEP_ALIVE_TIMEOUT = 30
+
     def __init__(self, server_address=('127.0.0.1', 8000)):
         srh = self
 
         class DummyHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            timeout = srh.KEEP_ALIVE_TIMEOUT
+
+            # Only while a handler is running. Errors that http.server sends
+            # on its own, like for malformed requests, go out straight away.
+            buffering = False
+
             def do_GET(self):
-                srh.do_GET(self)
+                self.handle_buffered(srh.do_GET)
 
             def do_POST(self):
-                srh.do_POST(self)
+                self.handle_buffered(srh.do_POST)
+
+            def handle_buffered(self, handler):
+                # Headers that have to go out with whatever response the
+                # handler sends, like cookies. See sessions.py.
+                self.extra_headers = []
+
+                # (code, message) and [(keyword, value), ...] of the response
+                # so far. See send_buffered.
+                self.response = None
+                self.response_headers = []
+
+                # (name, version) for bodies that are the same every time
+                # until version changes, so they're only compressed once.
+                # See StatefulRequestHandler.compress.
+                self.cache_key = None
+
+                real_wfile, self.wfile = self.wfile, io.BytesIO()
+                self.buffering = True
+
+                # Counted outside the lock, so that requests waiting for it
+                # count too.
+                in_flight = metrics.REGISTRY.gauge(
+                    'hypnohub_http_requests_in_flight',
+                    "Requests currently being handled or waiting to be.")
+                in_flight.inc()
+
+                try:
+                    with srh.lock:
+                        handler(self)
+                finally:
+                    in_flight.dec()
+                    body, self.wfile = self.wfile.getvalue(), real_wfile
+                    self.buffering = False
+
+                self.send_buffered(body)
+
+            def send_response(self, code, message=None):
+                # Remember the status code, for metrics.
+                self.status_code = code
+
+                if not self.buffering:
+                    super().send_response(code, message)
+                    return
+
+                self.log_request(code)
+                self.response = (code, message)
+
+            def send_header(self, keyword, value):
+                if self.buffering:
+                    self.response_headers.append((keyword, value))
+                else:
+                    super().send_header(keyword, value)
+
+            def end_headers(self):
+                if not self.buffering:
+                    super().end_headers()
+
+            def send_buffered(self, body):
+                """ Actually send the response, now that it's all there. """
+                if self.response is None:
+                    # The handler never answered, so there's nothing to say.
+                    self.close_connection = True
+                    return
+
+                headers = [(keyword, value) for keyword, value
+                           in self.response_headers + self.extra_headers
+                           if keyword.lower() != 'content-length']
+                content_type = next((value for keyword, value in headers
+                                     if keyword.lower() == 'content-type'),
+                                    None)
+                encoding = None
+
+                if compression.compressible(content_type, body):
+                    headers.append(('Vary', 'Accept-Encoding'))
+                    encoding = compression.negotiate(
+                        self.headers.get('Accept-Encoding'))
+
+                if encoding is not None:
+                    body = srh.compress(body, encoding, self.cache_key)
+                    headers.append(('Content-Encoding', encoding))
+
+                metrics.REGISTRY.counter(
+                    'hypnohub_http_response_bytes_total',
+                    "Bytes of response bodies sent, by encoding.",
+                    encoding=encoding or 'identity').inc(len(body))
+
+                code, message = self.response
+                self.send_response_only(code, message)
+                self.send_header('Server', self.version_string())
+                self.send_header('Date', self.date_time_string())
+
+                for keyword, value in headers:
+                    self.send_header(keyword, value)
+
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
 
         # It's a syntax error to try:
         # class self.DummyHandler(...):
         self.DummyHandler = DummyHandler
 
-        self.server = http.server.HTTPServer(server_address, self.DummyHandler)
+        self.lock = threading.Lock()
+
+        # {(name, encoding): (version, compressed body), ...}. See compress.
+        self.compressed_bodies = {}
+
+        self.server = http.server.ThreadingHTTPServer(server_address,
+                                                      self.DummyHandler)
+
+    def compress(self, body, encoding, cache_key=None):
+        """ compression.compress, remembering the result if cache_key says
+        that the body will be the same next time.
+        """
+        if cache_key is None:
+            return compression.compress(body, encoding)
+
+        name, version = cache_key
+        cached_version, compressed = self.compressed_bodies.get(
+            (name, encoding), (None, None))
+
+        if cached_version != version:
+            compressed = compression.compress(body, encoding)
+            self.compressed_bodies[(name, encoding)] = (version, compressed)
+
+        return compressed
 
     def do_GET(self, dh):
         raise NotImplementedError
@@ -92,10 +241,47 @@ class AhtoRequestHandler(StatefulRequestHandler):
     SERVE_FILES = True
     FILE_DIR = os.path.abspath("./http_server/")
 
+    # Profile every request, not just ones with ?profile=1 in the URL.
+    PROFILE_ALL = bool(os.environ.get('HYPNOHUB_PROFILE'))
+
     def do_POST_and_GET(self, dh):
+        """ Times every request into metrics.REGISTRY, by route. Anything
+        that isn't in self.PATHS counts as the 'static' route, so that random
+        URLs can't make endless new metrics.
+        """
         dh.path_parsed = urllib.parse.urlparse(dh.path)
         dh.query_string = urllib.parse.parse_qs(dh.path_parsed.query)
+        dh.status_code = None
+
+        route = dh.path_parsed.path
+        if route not in self.PATHS:
+            route = 'static'
+
+        try:
+            with metrics.timed('hypnohub_http_request_duration_seconds',
+                               "Time spent handling requests, by route.",
+                               route=route, method=dh.command):
+                if self.PROFILE_ALL or 'profile' in dh.query_string:
+                    self.profile_request(dh)
+                else:
+                    self.route_request(dh)
+        finally:
+            metrics.REGISTRY.counter(
+                'hypnohub_http_requests_total',
+                "Requests handled, by route and status code.",
+                route=route, method=dh.command, status=dh.status_code).inc()
+
+    do_POST = do_GET = do_POST_and_GET
 
+    def profile_request(self, dh):
+        """ Like route_request, but with cProfile running. See profiling.py.
+        """
+        with profiling.profiled(dh.path_parsed.path) as result:
+            self.route_request(dh)
+
+        dh.log_message(f"Profile saved: /debug/profile?id={result.name}")
+
+    def route_request(self, dh):
         if dh.path_parsed.path not in self.PATHS:
             if not self.SERVE_FILES or not self.serve_from_filesystem(dh):
                 dh.send_error(404)
@@ -110,8 +296,6 @@ class AhtoRequestHandler(StatefulRequestHandler):
 
         handler(dh)
 
-    do_POST = do_GET = do_POST_and_GET
-
     def serve_from_filesystem(self, dh) -> bool:
         """ Will not send 404 if it can't find the file. Just returns False.
         """
@@ -138,12 +322,17 @@ class AhtoRequestHandler(StatefulRequestHandler):
 
         dh.log_message(f"Serving file at: {dh.path}")
 
+        with open(path, 'rb') as f:
+            body = f.read()
+            stat = os.fstat(f.fileno())
+
         dh.send_response(200)
         dh.send_header('Content-type', content_type)
         dh.end_headers()
+        dh.wfile.write(body)
 
-        with open(path, 'r') as f:
-            dh.wfile.write(bytes(f.read(), 'utf8'))
+        # Files are only compressed again once they've changed.
+        dh.cache_key = (path, (stat.st_mtime_ns, stat.st_size))
 
         return True
 
@@ -169,7 +358,15 @@ def requires_cache(f):
 
 
 class RecommendationRequestHandler(AhtoRequestHandler):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, workers=None, multi_user=False,
+                 collapse_duplicates=False, classifier='naive_bayes',
+                 max_resident_shards=None, **kwargs):
+        """
+        workers and collapse_duplicates are passed on to the PostGetter, and
+        classifier is a name from post_getters.CLASSIFIERS. If multi_user is
+        True, every browser gets its own votes and recommendations. See
+        sessions.py. max_resident_shards is passed on to the Dataset.
+        """
         super(RecommendationRequestHandler, self).__init__(*args, **kwargs)
 
         # TODO: API url's should start with /api/
@@ -180,10 +377,18 @@ class RecommendationRequestHandler(AhtoRequestHandler):
             '/hot':         [['GET'], self.hot],
             '/best':        [['GET'], self.best],
             '/random':      [['GET'], self.random],
+            '/explore':     [['GET'], self.explore],
             '/stats':       [['GET'], self.stats],
+            '/metrics':     [['GET'], self.prometheus_metrics],
+
+            '/api/explain': [['GET'], self.explain],
+
+            '/debug/profiles': [['GET'], self.profiles],
+            '/debug/profile':  [['GET'], self.profile],
 
             '/vote':        [['GET'], self.vote],
             '/save':        [['GET'], self.save],
+            '/refresh':     [['GET', 'POST'], self.refresh],
             '/readConsole': [['GET'], self.readConsole],
             '/console':     [['GET'], self.console],
             '/testConsole': [['GET'], self.testConsole],
@@ -193,20 +398,42 @@ class RecommendationRequestHandler(AhtoRequestHandler):
         # right next to them. Paths without descriptions won't be shown at all.
         self.PATH_DESCRIPTIONS = {
             '/':            'An index of all URLs on the server.',
-            '/hot':         'A random selection of good images.',
+            '/hot':         'A random selection of good images.'
+                            ' Takes ?tags=... like Hypnohub.',
             '/save':        'Save your votes so far.',
-            '/best':        'The absolute best images we can find for you.',
+            '/refresh':     'Fetch the cached posts that have changed on'
+                            ' Hypnohub since the last refresh, in the'
+                            ' background.',
+            '/best':        'The absolute best images we can find for you.'
+                            ' Takes ?tags=... like Hypnohub.',
             '/random':      'Totally random images.',
+            '/explore':     'Images we know the least about, so your votes'
+                            ' teach us the most. Takes ?tags=... too.',
             '/stats':       'Statistics on... everything!',
+            '/metrics':     'Timings and counters, for Prometheus.',
+            '/api/explain': 'How each tag of ?id=... adds up to its score.'
+                            ' Add ?explain=1 to a rating page to see it'
+                            ' there.',
+            '/debug/profiles': 'Saved profiles. Add ?profile=1 to any URL'
+                               ' to profile it.',
             '/testConsole': 'Test the console. (debugging feature)',
         }
 
         # Used by /readConsole and /console
         self.console_queues = dict()
 
-        self.dataset = post_data.Dataset()
-        self.nbc = naive_bayes.NaiveBayesClassifier.from_dataset(self.dataset)
-        self.post_getter = post_getters.PostGetter(self.dataset, self.nbc)
+        # The thread running the current /refresh, if any, and the id of its
+        # console_queue. See refresh.
+        self.refresh_thread = None
+        self.refresh_console = None
+        self.refresh_count = 0
+
+        # Only the cache and tag index of this are shared between sessions.
+        self.dataset = post_data.Dataset(
+            max_resident_shards=max_resident_shards)
+        self.sessions = sessions.SessionManager(
+            self.dataset, multi_user, workers=workers,
+            collapse_duplicates=collapse_duplicates, classifier=classifier)
 
     def send_html(self, dh, html_text):
         assert type(html_text) == str
@@ -229,8 +456,7 @@ class RecommendationRequestHandler(AhtoRequestHandler):
         #       200 incorrectly.
         def error():
             dh.wfile.write(bytes("false", 'utf8'))
-            print("--------- vote error", dh.query_string, "---------")
-            return
+            dh.log_message(f"Vote error: {dh.query_string}")
 
         dh.send_response(200)
         dh.send_header('Content-type', 'application/json')
@@ -240,43 +466,39 @@ class RecommendationRequestHandler(AhtoRequestHandler):
                 or 'id' not in dh.query_string
                 or len(dh.query_string['direction']) != 1
                 or len(dh.query_string['id']) != 1):
-            error()
+            return error()
 
-        try:
-            direction = dh.query_string['direction'][0].lower()
-        except AttributeError:
-            error()
+        direction = dh.query_string['direction'][0].lower()
 
         if direction == 'true':
             direction = True
         elif direction == 'false':
             direction = False
         else:
-            error()
+            return error()
 
         try:
             id_ = int(dh.query_string['id'][0])
         except ValueError:
-            error()
+            return error()
 
         dh.log_message(f"Adding ID: {id_} to dataset: "
                        + ('good' if direction else 'bad'))
 
-        if direction:
-            self.dataset.good.add(id_)
-        else:
-            self.dataset.bad.add(id_)
+        self.sessions.get(dh).record_vote(id_, direction)
 
         dh.wfile.write(bytes("true", 'utf8'))
 
     def save(self, dh):
-        """ Save the dataset to a file. """
+        """ Save the dataset and the classifier to files. """
         # Returns 'true' on success. On failure, just crashes :/
-        self.dataset.save()
-        dh.log_message("Saved self.dataset with good:"
-                       + str(len(self.dataset.good))
+        session = self.sessions.get(dh)
+        session.save()
+        dataset = session.dataset
+        dh.log_message("Saved dataset with good:"
+                       + str(len(dataset.good))
                        + " and bad:"
-                       + str(len(self.dataset.bad)))
+                       + str(len(dataset.bad)))
 
         dh.send_response(200)
         dh.send_header('Content-type', 'application/json')
@@ -284,6 +506,67 @@ class RecommendationRequestHandler(AhtoRequestHandler):
 
         dh.wfile.write(bytes("true", 'utf8'))
 
+    def refresh(self, dh):
+        """
+        POST starts catching the cache and every session up with posts that
+        have changed on Hypnohub, and redirects to a /console with its
+        progress. A crawl can take a while, so it runs in the background,
+        and only holds the lock while each page of changes is patched in.
+        Only one runs at a time. POSTing while one is running just redirects
+        to its console.
+
+        GET shows a button that POSTs here.
+        """
+        running = (self.refresh_thread is not None
+                   and self.refresh_thread.is_alive())
+
+        if dh.command == 'GET' and not running:
+            self.send_html(dh, html_generator.post_button(
+                '/refresh', 'Refresh',
+                ["Fetch the cached posts that have changed on Hypnohub since"
+                 " the last refresh."]))
+            return
+
+        if not running:
+            self.refresh_count += 1
+            self.refresh_console = f"refresh-{self.refresh_count}"
+            console_queue = queue.Queue()
+            self.console_queues[self.refresh_console] = console_queue
+
+            self.refresh_thread = threading.Thread(
+                target=self.refresh_in_background, args=(console_queue,),
+                daemon=True)
+            self.refresh_thread.start()
+
+        dh.send_response(303)
+        dh.send_header('Location', f"/console?id={self.refresh_console}")
+        dh.end_headers()
+
+    def refresh_in_background(self, console_queue):
+        """ The crawl for refresh. Progress goes to console_queue. """
+        changed = 0
+
+        try:
+            for changed_posts in self.dataset.changed_pages():
+                with self.lock:
+                    changes = self.dataset.apply_changes(changed_posts)
+                    self.sessions.refresh(changes)
+
+                changed += len(changes)
+                console_queue.put(f"Change# {self.dataset.cache.last_change}"
+                                  f" - {changed} posts changed")
+
+            with self.lock:
+                self.dataset.save()
+
+            console_queue.put(f"Refreshed {changed} changed posts.")
+            print(f"Refreshed {changed} changed posts")
+        except Exception as e:
+            console_queue.put(f"Refresh failed: {e!r}")
+            raise
+        finally:
+            console_queue.put(None)
+
     def testConsole(self, dh):
         """ Test the console system.
         """
@@ -398,54 +681,213 @@ class RecommendationRequestHandler(AhtoRequestHandler):
         # Overwrite final ',' with ']'. JSON doesn't allow trailing commas.
         dh.wfile.write(bytes(']', 'utf8'))
 
-    @requires_cache
-    def hot(self, dh):
-        score, post = self.post_getter.get_hot()
+    def send_searched_post(self, dh, get_post):
+        """ Shared code for /hot, /best and /explore, which take an optional
+        ?tags=... search. See tag_index.TagIndex for the syntax.
+        """
+        tags = dh.query_string.get('tags', [None])[0]
+
+        try:
+            score, post = get_post(tags)
+        except ValueError as e:
+            self.send_html(dh, html_generator.simple_message(str(e)))
+        except IndexError:
+            self.send_html(dh, html_generator.simple_message(
+                f"No posts left that match: {tags}"))
+        else:
+            self.send_rating_page(dh, score, post)
+
+    def send_rating_page(self, dh, score, post):
+        """ Adds the per-tag breakdown if there's ?explain=1 in the URL. """
+        if 'explain' in dh.query_string:
+            explanation = self.sessions.get(dh).nbc.explain(post.features)
+        else:
+            explanation = None
+
         self.send_html(
             dh,
-            html_generator.rating_page_for_post(post, f"score: {score:.2%}"))
+            html_generator.rating_page_for_post(
+                post, f"score: {score:.2%}", explanation))
+
+    @requires_cache
+    def hot(self, dh):
+        self.send_searched_post(
+            dh, self.sessions.get(dh).post_getter.get_hot)
 
     @requires_cache
     def best(self, dh):
-        score, post = self.post_getter.get_best()
-        self.send_html(
-            dh,
-            html_generator.rating_page_for_post(post, f"score: {score:.2%}"))
+        self.send_searched_post(
+            dh, self.sessions.get(dh).post_getter.get_best)
+
+    @requires_cache
+    def explore(self, dh):
+        self.send_searched_post(
+            dh, self.sessions.get(dh).post_getter.get_mysterious)
 
     @requires_cache
     def random(self, dh):
-        score, post = self.post_getter.get_random()
-        self.send_html(
-            dh,
-            html_generator.rating_page_for_post(post, f"score: {score:.2%}"))
+        score, post = self.sessions.get(dh).post_getter.get_random()
+        self.send_rating_page(dh, score, post)
+
+    def explain(self, dh):
+        """
+        Sends JSON like: {
+            "id": 1337,
+            "bias": -1.1,
+            "linear_score": 2.3,
+            "prediction": 9.97,
+            "tags": [{"tag": "foo", "weight": 1.5, "good": 3, "total": 4},
+                     ...]
+        }
+
+        linear_score is bias plus every tag's weight, and prediction is what
+        the classifier makes of that. See classifiers.py. For naive Bayes,
+        bias is log P(G) and linear_score is the log of the prediction.
+
+        Tags are sorted by weight, biggest first. A weight (or linear_score)
+        of null means -infinity: the tag has never been on a good post.
+        """
+        def finite(x):
+            return x if x != -math.inf else None
+
+        try:
+            post = self.dataset.cache.get(int(dh.query_string['id'][0]))
+        except (KeyError, ValueError):
+            dh.send_error(404)
+            return
+
+        nbc = self.sessions.get(dh).nbc
+        explanation = nbc.explain(post.features)
+        linear_score = nbc.bias + sum(w for _, w in explanation)
+
+        body = json.dumps({
+            'id':           post.id,
+            'bias':         finite(nbc.bias),
+            'linear_score': finite(linear_score),
+            'prediction':   nbc.from_linear(linear_score),
+            'tags': [{'tag':    tag,
+                      'weight': finite(weight),
+                      'good':   nbc.tag_history.get(tag, [0, 0])[0],
+                      'total':  nbc.tag_history.get(tag, [0, 0])[1]}
+                     for tag, weight in explanation],
+        })
+
+        dh.send_response(200)
+        dh.send_header('Content-type', 'application/json')
+        dh.end_headers()
+        dh.wfile.write(bytes(body, 'utf8'))
 
     @requires_cache
     def stats(self, dh):
+        """
+        Takes ?page=N (starting from 0) and ?per_page=N (at most
+        Stats.MAX_PER_PAGE) for the lists of good and bad id's, and
+        ?format=json for a JSON version.
+        """
         def header(s):
             spacer_length = (79 - len(s) - 2) / 2
             left = '-' * math.ceil(spacer_length)
             right = '-' * math.floor(spacer_length)
             return left + ' ' + s + ' ' + right
 
+        stats_tracker = self.sessions.get(dh).stats_tracker
+
+        try:
+            page = int(dh.query_string.get('page', [0])[0])
+            per_page = min(int(dh.query_string.get('per_page', [200])[0]),
+                           stats_tracker.MAX_PER_PAGE)
+            good_ids = stats_tracker.ids_page('good', page, per_page)
+            bad_ids = stats_tracker.ids_page('bad', page, per_page)
+        except ValueError:
+            dh.send_error(422)
+            return
+
+        summary = stats_tracker.summary()
+
+        if dh.query_string.get('format', [None])[0] == 'json':
+            body = bytes(json.dumps(dict(summary, page=page,
+                                         per_page=per_page, good=good_ids,
+                                         bad=bad_ids)), 'utf8')
+
+            dh.send_response(200)
+            dh.send_header('Content-type', 'application/json')
+            dh.end_headers()
+            dh.wfile.write(body)
+            return
+
+        p_g = 'n/a' if summary['p_g'] is None else f"{summary['p_g']:.2%}"
+
         # This is ugly code but I can't think of a better way to do it.
         s = '\n'.join([
-            f"Total good: {len(self.dataset.good)}",
-            f"Total bad:  {len(self.dataset.bad)}",
+            f"Total good: {summary['total_good']}",
+            f"Total bad:  {summary['total_bad']}",
             '',
-            f"NBC P(G): {self.nbc.p_g:.2%}",
+            f"NBC P(G): {p_g}",
             '',
-            header("GOOD"),
-            f"{self.dataset.good}",
+            header(f"GOOD (page {page}, {per_page} per page)"),
+            f"{good_ids}",
             '',
-            header("BAD"),
-            f"{self.dataset.bad}"
+            header(f"BAD (page {page}, {per_page} per page)"),
+            f"{bad_ids}"
         ])
 
         s += '\n'
-        s += header("100 most common NBC tags") + "\n"
-        tag_history = list(self.nbc.tag_history.items())
-        tag_history.sort(reverse=True, key=lambda i: i[1][1])
-        for tag, (good, total) in tag_history[:100]:
-            s += f"{good}/{total}: {tag}\n"
+        s += header(f"{stats.Stats.TOP_TAGS} most common NBC tags") + "\n"
+        for tag in summary['top_tags']:
+            s += f"{tag['good']}/{tag['total']}: {tag['tag']}\n"
+
+        s += '\n' + header("Timings") + '\n'
+        s += self.timing_summary()
 
         self.send_html(dh, html_generator.pre_message(s))
+
+    def timing_summary(self):
+        """ A human-readable version of the histograms in /metrics. """
+        lines = []
+
+        for name, (type_, _, _) in sorted(metrics.REGISTRY.metrics.items()):
+            if type_ is not metrics.Histogram:
+                continue
+
+            for labels, histogram in metrics.REGISTRY.children(name):
+                if histogram.count == 0:
+                    continue
+
+                labels = ' '.join(f"{k}={v}" for k, v in sorted(
+                    labels.items()))
+                mean = histogram.sum / max(histogram.count, 1)
+                lines.append(
+                    f"{name} {labels}\n"
+                    f"    count: {histogram.count}"
+                    f"  mean: {mean*1000:.1f}ms"
+                    f"  p50: {histogram.quantile(0.5)*1000:.1f}ms"
+                    f"  p95: {histogram.quantile(0.95)*1000:.1f}ms")
+
+        return '\n'.join(lines) + '\n'
+
+    def profiles(self, dh):
+        """ Links to every saved profile. """
+        self.send_html(dh, html_generator.path_index(
+            (f"/debug/profile?id={name}", name)
+            for name in profiling.list_profiles()))
+
+    def profile(self, dh):
+        """ The pstats table for one saved profile. Also takes ?sort=... """
+        try:
+            name = dh.query_string['id'][0]
+            sort = dh.query_string.get('sort', ['cumulative'])[0]
+            text = profiling.report(name, sort)
+        except (KeyError, FileNotFoundError):
+            dh.send_error(404)
+            return
+
+        self.send_html(dh, html_generator.pre_message(text))
+
+    def prometheus_metrics(self, dh):
+        """ Everything in metrics.REGISTRY, in the Prometheus text format. """
+        body = bytes(metrics.REGISTRY.render(), 'utf8')
+
+        dh.send_response(200)
+        dh.send_header('Content-type', 'text/plain; version=0.0.4')
+        dh.end_headers()
+        dh.wfile.write(body)
@@ -2,11 +2,20 @@ from typing import List, Tuple
 
 import yattag
 
+import metrics
+
 """
 Generates HTML for use by the http server.
 """
 
 
+def timed_render(f):
+    """ Record how long each kind of page takes to generate, in metrics. """
+    return metrics.timed('hypnohub_render_seconds',
+                         "Time spent generating HTML.",
+                         page=f.__name__)(f)
+
+
 def css_link():
     # Template version available.
     doc = yattag.Doc()
@@ -14,10 +23,14 @@ def css_link():
     return doc.getvalue()
 
 
-def rating_page_for_post(post, message=None):
+@timed_render
+def rating_page_for_post(post, message=None, explanation=None):
     # Template version available.
     """
     A page where you can rate a single Hypnohub post.
+
+    explanation: Optional List[Tuple[tag, weight]], like
+                 Classifier.explain gives. Shown under the image.
     """
     doc, tag, text, line = yattag.Doc().ttl()
 
@@ -59,9 +72,17 @@ def rating_page_for_post(post, message=None):
                 with tag('a', href=post.page_url):
                     doc.stag('img', src=post.sample_url, klass="rating_image")
 
+            if explanation is not None:
+                with tag('table', klass='explanation'):
+                    for tag_name, weight in explanation:
+                        with tag('tr'):
+                            line('td', f"{weight:+.2f}")
+                            line('td', tag_name)
+
     return doc.getvalue()
 
 
+@timed_render
 def path_index(paths_and_descriptions: List[Tuple[str, str]]):
     # Template version available.
     doc, tag, text, line = yattag.Doc().ttl()
@@ -84,6 +105,7 @@ def path_index(paths_and_descriptions: List[Tuple[str, str]]):
     return doc.getvalue()
 
 
+@timed_render
 def simple_message(paragraphs):
     """
     paragraphs is List[str] or just str
@@ -104,6 +126,29 @@ def simple_message(paragraphs):
     return doc.getvalue()
 
 
+@timed_render
+def post_button(action, label, paragraphs=()):
+    """
+    A page with a button that POSTs to action, for things that shouldn't
+    happen just because a link was followed. paragraphs go above it.
+    """
+    doc, tag, text, line = yattag.Doc().ttl()
+
+    with tag('html'):
+        with tag('head'):
+            doc.asis(css_link())
+
+        with tag('body'):
+            for paragraph in paragraphs:
+                line('p', paragraph)
+
+            with tag('form', method='post', action=action):
+                line('button', label, type='submit')
+
+    return doc.getvalue()
+
+
+@timed_render
 def pre_message(string):
     doc, tag, text, line = yattag.Doc().ttl()
 
@@ -117,6 +162,8 @@ def pre_message(string):
 
     return doc.getvalue()
 
+
+@timed_render
 def console(id_):
     doc, tag, text, line = yattag.Doc().ttl()
 
@@ -0,0 +1,257 @@
+import collections
+import hashlib
+import hmac
+import http.cookies
+import os
+import re
+import secrets
+
+import model_cache
+import post_data
+import post_getters
+import stats
+
+"""
+Cookie-based sessions, so that a few people can use the same server without
+sharing their votes and recommendations. Every session has its own votes,
+classifier and PostGetter, but they all use the same cache and tag index.
+"""
+
+
+class Session(object):
+    """ Everything that belongs to one user. """
+
+    def __init__(self, dataset: post_data.Dataset, workers=None,
+                 collapse_duplicates=False, classifier='naive_bayes'):
+        """
+        classifier is a name from post_getters.CLASSIFIERS. If a classifier
+        of that kind was saved with save(), it's picked back up instead of
+        being trained from scratch.
+        """
+        self.dataset = dataset
+        cls = post_getters.CLASSIFIERS[classifier]
+        saved = model_cache.load(dataset, cls)
+
+        if saved is None:
+            self.nbc, scores = cls.from_dataset(dataset, workers=workers), None
+        else:
+            self.nbc, scores = saved
+
+        self.post_getter = post_getters.PostGetter(dataset, self.nbc, workers,
+                                                   collapse_duplicates, scores)
+        self.stats_tracker = stats.Stats(dataset, self.nbc)
+
+        # Whether there are votes that save() hasn't saved yet.
+        self.unsaved = False
+
+    def save(self):
+        """ Save the votes, and the classifier and its predictions, so that a
+        restart can pick up where this left off.
+        """
+        self.dataset.save()
+        model_cache.save(self.dataset, self.nbc,
+                         self.post_getter.all_scores())
+        self.unsaved = False
+
+    def refresh(self, changes):
+        """
+        Patch the classifier for posts that Dataset.refresh_cache changed.
+        changes is what that returned. Votes on changed posts are taken back
+        out with the old features and put back in with the new ones, and
+        then only the changed posts are rescored, if that's all that needs
+        rescoring. Classifiers that can't take votes back out are trained
+        again from scratch instead.
+        """
+        refit = False
+
+        for id_, old_features in changes.items():
+            for is_good, votes in [(True, self.dataset.good),
+                                   (False, self.dataset.bad)]:
+                if id_ not in votes:
+                    continue
+
+                post = self.dataset.get_id(id_)
+                features = None if post.deleted else post.features
+
+                if old_features is not None:
+                    if self.nbc.can_remove:
+                        self.nbc.remove_post(old_features, is_good)
+                    else:
+                        refit = True
+
+                    self.stats_tracker.record_vote(id_, is_good, old_features,
+                                                   undo=True)
+
+                if features is not None and not refit:
+                    self.nbc.add_post(features, is_good)
+
+                self.stats_tracker.record_vote(id_, is_good, features)
+
+        if refit:
+            self.nbc.refit(self.dataset)
+
+        self.post_getter.refresh(changes.keys())
+
+    def record_vote(self, id_, is_good):
+        """
+        Add a vote to the dataset, and train the classifier on it straight
+        away. Voting the other way on a post that's already been voted on
+        moves it, which means training from scratch for classifiers that
+        can't take the old vote back out.
+        """
+        if is_good:
+            new_votes, old_votes = self.dataset.good, self.dataset.bad
+        else:
+            new_votes, old_votes = self.dataset.bad, self.dataset.good
+
+        if id_ in new_votes:
+            return
+
+        self.unsaved = True
+        post = self.dataset.get_id(id_)
+        tags = None if post.deleted else post.features
+
+        refit = False
+
+        if id_ in old_votes:
+            old_votes.remove(id_)
+
+            if tags is not None:
+                if self.nbc.can_remove:
+                    self.nbc.remove_post(tags, not is_good)
+                else:
+                    refit = True
+
+            self.stats_tracker.record_vote(id_, not is_good, tags, undo=True)
+
+        new_votes.add(id_)
+
+        if refit:
+            self.nbc.refit(self.dataset)
+        elif tags is not None:
+            self.nbc.add_post(tags, is_good)
+
+        self.stats_tracker.record_vote(id_, is_good, tags)
+
+
+class SessionManager(object):
+    """
+    Hands out a Session for every request.
+
+    If multi_user is False, everyone gets the same session, which uses the
+    shared dataset's own votes. That's the old single-user behaviour.
+
+    Otherwise, each browser gets a random token in a cookie, and its votes
+    are kept in a post_data.UserDataset named after that token. Sessions are
+    made the first time they're needed, including for tokens from before a
+    restart, which pick their saved votes back up.
+
+    Tokens are signed with a secret that only lasts as long as the server,
+    so clients can't pick their own. Unsigned ones are only taken if votes
+    were already saved under them. Only MAX_SESSIONS sessions are kept in
+    memory. The least recently used one is saved, if it has votes that
+    aren't already, and made again from them if it comes back.
+    """
+    COOKIE = 'hypnohub_session'
+    TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+    MAX_SESSIONS = 32
+
+    # Tokens are NONCE_LENGTH hex digits, followed by their signature.
+    NONCE_LENGTH = 32
+
+    def __init__(self, dataset: post_data.Dataset, multi_user=False,
+                 **session_options):
+        """ session_options are passed on to every Session. """
+        self.dataset = dataset
+        self.multi_user = multi_user
+        self.session_options = session_options
+        self.secret = secrets.token_bytes(32)
+
+        # {token: Session, ...}, least recently used first.
+        self.sessions = collections.OrderedDict()
+
+        if not multi_user:
+            self.default = Session(dataset, **session_options)
+
+    def refresh(self, changes):
+        """ Session.refresh for every session there is. """
+        if not self.multi_user:
+            self.default.refresh(changes)
+
+        for session in self.sessions.values():
+            session.refresh(changes)
+
+    def get(self, dh) -> Session:
+        """
+        The session for a request. If it needs a new cookie, this adds a
+        Set-Cookie header to dh.extra_headers, which goes out with the
+        response headers. Only call this for requests that need a session.
+        """
+        if not self.multi_user:
+            return self.default
+
+        token = self.token_from_cookie(dh.headers.get('Cookie'))
+
+        if token is None:
+            token = self.new_token()
+            dh.extra_headers.append((
+                'Set-Cookie',
+                f"{self.COOKIE}={token}; Path=/; HttpOnly; SameSite=Lax"))
+
+        if token in self.sessions:
+            self.sessions.move_to_end(token)
+            return self.sessions[token]
+
+        user_dataset = post_data.UserDataset(self.dataset, token)
+        session = Session(user_dataset, **self.session_options)
+        self.sessions[token] = session
+
+        while len(self.sessions) > self.MAX_SESSIONS:
+            _, old = self.sessions.popitem(last=False)
+
+            if old.unsaved:
+                old.save()
+
+        return session
+
+    def sign(self, nonce) -> str:
+        return hmac.new(self.secret, nonce.encode(),
+                        hashlib.sha256).hexdigest()[:self.NONCE_LENGTH]
+
+    def new_token(self) -> str:
+        nonce = secrets.token_hex(self.NONCE_LENGTH // 2)
+        return nonce + self.sign(nonce)
+
+    def token_from_cookie(self, cookie_header):
+        """ None if there's no valid session cookie. Tokens end up in file
+        names, so anything that doesn't look like one of ours is ignored, and
+        so is any token that this server didn't hand out, unless there are
+        votes saved under it.
+        """
+        if not cookie_header:
+            return None
+
+        cookie = http.cookies.SimpleCookie()
+
+        try:
+            cookie.load(cookie_header)
+        except http.cookies.CookieError:
+            return None
+
+        if self.COOKIE not in cookie:
+            return None
+
+        token = cookie[self.COOKIE].value
+
+        if not self.TOKEN_PATTERN.match(token):
+            return None
+
+        nonce = token[:self.NONCE_LENGTH]
+        signed = hmac.compare_digest(token[self.NONCE_LENGTH:],
+                                     self.sign(nonce))
+
+        if not signed and not os.path.isfile(
+                post_data.UserDataset.votes_file(token)):
+            return None
+
+        return token
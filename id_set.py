@@ -0,0 +1,151 @@
+import collections.abc
+import operator
+import re
+from typing import Iterable
+
+"""
+A set of post id's, stored as a bitset. Post id's are small and close
+together, so one bit per possible id is a lot smaller than a set of ints, and
+unions and counts run over whole machine words at a time instead of one id at
+a time.
+"""
+
+_NONZERO_BYTE = re.compile(rb'[^\x00]')
+
+
+class IdSet(collections.abc.MutableSet):
+    """
+    Works like a set of non-negative ints. Operators between two IdSets (|, &,
+    -, ^ and their in-place versions) are done on the whole bitset at once.
+    Mixing in a normal set works too, just more slowly.
+
+    self.bits = bytearray() # Bit (id % 8) of byte (id // 8) is set for id.
+    """
+
+    def __init__(self, ids: Iterable[int] = ()):
+        if isinstance(ids, IdSet):
+            self.bits = bytearray(ids.bits)
+            self._len = ids._len
+            return
+
+        self.bits = bytearray()
+        self._len = 0
+
+        for id_ in ids:
+            self.add(id_)
+
+    @classmethod
+    def _from_int(cls, n):
+        id_set = cls()
+        id_set._set_int(n)
+        return id_set
+
+    def _set_int(self, n):
+        self.bits = bytearray(n.to_bytes((n.bit_length() + 7) // 8, 'little'))
+        self._len = n.bit_count()
+
+    def _int(self):
+        return int.from_bytes(self.bits, 'little')
+
+    def __contains__(self, id_):
+        if not isinstance(id_, int) or id_ < 0:
+            return False
+
+        byte = id_ >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] >> (id_ & 7) & 1)
+
+    def __iter__(self):
+        """ In ascending order. Skips over empty bytes without looking at
+        them one by one in Python.
+        """
+        for match in _NONZERO_BYTE.finditer(self.bits):
+            byte = match.start()
+            value = self.bits[byte]
+
+            for bit in range(8):
+                if value >> bit & 1:
+                    yield byte * 8 + bit
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return f"IdSet({list(self)!r})"
+
+    def add(self, id_):
+        if id_ < 0:
+            raise ValueError(f"IdSet can't hold negative numbers: {id_}")
+
+        byte, mask = id_ >> 3, 1 << (id_ & 7)
+
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte - len(self.bits) + 1))
+
+        if not self.bits[byte] & mask:
+            self.bits[byte] |= mask
+            self._len += 1
+
+    def discard(self, id_):
+        if id_ in self:
+            self.bits[id_ >> 3] &= ~(1 << (id_ & 7)) & 0xff
+            self._len -= 1
+
+    def copy(self):
+        return IdSet(self)
+
+    def _binary(self, other, op, fallback):
+        if isinstance(other, IdSet):
+            return IdSet._from_int(op(self._int(), other._int()))
+
+        return fallback(self, other)
+
+    def _inplace(self, other, op, fallback):
+        if isinstance(other, IdSet):
+            self._set_int(op(self._int(), other._int()))
+            return self
+
+        return fallback(self, other)
+
+    def __or__(self, other):
+        return self._binary(other, operator.or_,
+                            collections.abc.MutableSet.__or__)
+
+    def __and__(self, other):
+        return self._binary(other, operator.and_,
+                            collections.abc.MutableSet.__and__)
+
+    def __sub__(self, other):
+        return self._binary(other, lambda a, b: a & ~b,
+                            collections.abc.MutableSet.__sub__)
+
+    def __xor__(self, other):
+        return self._binary(other, operator.xor,
+                            collections.abc.MutableSet.__xor__)
+
+    def __ior__(self, other):
+        return self._inplace(other, operator.or_,
+                             collections.abc.MutableSet.__ior__)
+
+    def __iand__(self, other):
+        return self._inplace(other, operator.and_,
+                             collections.abc.MutableSet.__iand__)
+
+    def __isub__(self, other):
+        return self._inplace(other, lambda a, b: a & ~b,
+                             collections.abc.MutableSet.__isub__)
+
+    def __ixor__(self, other):
+        return self._inplace(other, operator.xor,
+                             collections.abc.MutableSet.__ixor__)
+
+    __ror__ = __or__
+    __rand__ = __and__
+    __rxor__ = __xor__
+
+    def __eq__(self, other):
+        if isinstance(other, IdSet):
+            return self._len == other._len and self._int() == other._int()
+
+        return collections.abc.MutableSet.__eq__(self, other)
+
+    __hash__ = None
@@ -0,0 +1,199 @@
+import bisect
+import contextlib
+import math
+import threading
+import time
+from typing import Dict, Tuple
+
+"""
+Counters, gauges and latency histograms, for seeing where the time goes. The
+HTTP server shows them at /metrics in the Prometheus text format, and sums
+them up on /stats.
+
+Everything records into the module-level REGISTRY:
+
+with metrics.timed('hypnohub_render_seconds', "Time spent making HTML.",
+                   page='rating_page'):
+    make_some_html()
+
+@metrics.timed('hypnohub_save_seconds', "Time spent saving.")
+def save():
+    ...
+"""
+
+
+class Counter(object):
+    """ Counter names should end in _total, like Prometheus wants. Counters
+    and gauges can be changed from any thread, even outside the HTTP
+    server's lock.
+    """
+    TYPE = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram(object):
+    """ Counts observations into buckets, like a Prometheus histogram. The
+    buckets are upper bounds in seconds.
+    """
+    TYPE = 'histogram'
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+               2.5, 5.0, 10.0, math.inf)
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q) -> float:
+        """ Estimate a quantile by interpolating inside its bucket, the same
+        way Prometheus's histogram_quantile() does.
+        """
+        if self.count == 0:
+            return math.nan
+
+        rank = q * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                low = self.BUCKETS[i-1] if i > 0 else 0.0
+                high = self.BUCKETS[i]
+
+                if high == math.inf:
+                    return low
+
+                return low + (high - low) * (rank - seen) / count
+
+            seen += count
+
+        return self.BUCKETS[-2]
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            cumulative += count
+            le = '+Inf' if bound == math.inf else repr(bound)
+            yield name + '_bucket', labels + (('le', le),), cumulative
+
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class Registry(object):
+    """
+    self.metrics = {
+        name: (type, help, {labels: Counter/Gauge/Histogram, ...}),
+        ...
+    }
+
+    Where labels is a sorted tuple of (label_name, value) pairs.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Tuple[type, str, Dict]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, type_, name, help='', **labels):
+        labels = tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = (type_, help, {})
+
+            registered_type, _, children = self.metrics[name]
+
+            if registered_type is not type_:
+                raise TypeError(f"{name} is a {registered_type.TYPE}, not a"
+                                f" {type_.TYPE}")
+
+            if labels not in children:
+                children[labels] = type_()
+
+            return children[labels]
+
+    def counter(self, name, help='', **labels) -> Counter:
+        return self.get(Counter, name, help, **labels)
+
+    def gauge(self, name, help='', **labels) -> Gauge:
+        return self.get(Gauge, name, help, **labels)
+
+    def histogram(self, name, help='', **labels) -> Histogram:
+        return self.get(Histogram, name, help, **labels)
+
+    def children(self, name):
+        """ [(labels_dict, metric), ...] for every label set of a metric. """
+        if name not in self.metrics:
+            return []
+
+        return [(dict(labels), metric)
+                for labels, metric in self.metrics[name][2].items()]
+
+    def render(self) -> str:
+        """ Everything, in the Prometheus text exposition format. """
+        lines = []
+
+        with self.lock:
+            for name, (type_, help, children) in sorted(self.metrics.items()):
+                if help:
+                    lines.append(f"# HELP {name} {help}")
+
+                lines.append(f"# TYPE {name} {type_.TYPE}")
+
+                for labels, metric in sorted(children.items()):
+                    for sample, sample_labels, value in metric.samples(
+                            name, labels):
+                        lines.append(
+                            f"{sample}{format_labels(sample_labels)} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels) -> str:
+    if len(labels) == 0:
+        return ''
+
+    def escape(value):
+        return (value.replace('\\', r'\\')
+                     .replace('"', r'\"')
+                     .replace('\n', r'\n'))
+
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+
+REGISTRY = Registry()
+
+
+@contextlib.contextmanager
+def timed(name, help='', **labels):
+    """ Time a block of code (or, as a decorator, a function) into a
+    histogram in REGISTRY. Failed calls are timed too.
+    """
+    histogram = REGISTRY.histogram(name, help, **labels)
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start)
@@ -0,0 +1,152 @@
+import os
+import pickle
+import zlib
+from array import array
+from typing import Optional, Tuple
+
+import post_data
+import classifiers
+from id_set import IdSet
+
+"""
+Saves a trained classifier, and its prediction for every cached post, so that
+starting the server doesn't mean training from scratch and then scoring the
+whole cache again on the first /best.
+
+What gets saved is checked against the dataset when it's loaded:
+
+- Votes added or taken back since then are patched into the classifier with
+  add_post and remove_post, unless there are more than MAX_PATCH of them, or
+  votes were taken back and the classifier can't remove_post.
+- Every post gets a checksum of everything that its prediction depends on.
+  Saved predictions are reused for posts whose checksum hasn't changed, and
+  only new or changed posts are scored.
+- If the votes changed, every prediction changes a little, so they're all
+  thrown out and worked out again when they're needed, like before.
+"""
+
+# Bump this if the format of the saved file changes.
+FORMAT = 2
+
+# More vote changes than this, and we might as well train from scratch.
+MAX_PATCH = 1000
+
+
+def row_checksums(table: post_data.PostTable) -> array:
+    """ A checksum for every row, of the columns that predictions use. """
+    checksums = array('L')
+
+    for block, rows in table.blocks():
+        offsets, itemsize = block.tag_offsets, block.tag_ids.itemsize
+        tag_bytes = block.tag_ids.tobytes()
+
+        checksums.extend(
+            zlib.crc32(
+                tag_bytes[offsets[row]*itemsize:offsets[row+1]*itemsize],
+                hash((block.author_ids[row], block.ratings[row],
+                      block.scores[row])) & 0xffffffff)
+            for row in rows)
+
+    return checksums
+
+
+def save(dataset: post_data.Dataset, nbc: classifiers.Classifier,
+         scores: Optional[array] = None):
+    """ scores are predictions for every row of dataset.cache, in order, or
+    None to not save any.
+    """
+    table = dataset.cache
+
+    with open(dataset.MODEL, 'wb') as f:
+        pickle.dump({
+            'format':     FORMAT,
+            'classifier': type(nbc).__name__,
+            'good':       IdSet(dataset.good),
+            'bad':        IdSet(dataset.bad),
+            'nbc':        nbc,
+            'ids':        table.ids,
+            'checksums':  row_checksums(table),
+            'scores':     scores,
+        }, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load(dataset: post_data.Dataset, classifier: type
+         ) -> Optional[Tuple[classifiers.Classifier, Optional[array]]]:
+    """
+    Returns (nbc, scores), brought up to date with the dataset, or None if
+    there's nothing usable saved and the classifier should be trained from
+    scratch. scores is None if they all have to be worked out again.
+    """
+    if not os.path.isfile(dataset.MODEL):
+        return None
+
+    try:
+        with open(dataset.MODEL, 'rb') as f:
+            saved = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+
+    if (saved.get('format') != FORMAT
+            or saved['classifier'] != classifier.__name__):
+        return None
+
+    table = dataset.cache
+    nbc = saved['nbc']
+    checksums = row_checksums(table)
+
+    # {post_id: checksum, ...} for when the model was saved.
+    old_checksums = dict(zip(saved['ids'], saved['checksums']))
+
+    def checksum(id_):
+        return checksums[table.row(id_)] if id_ in table else None
+
+    # (post_id, is_good, add) for every vote that needs patching in.
+    patches = ([(id_, True, True) for id_ in dataset.good - saved['good']]
+               + [(id_, False, True) for id_ in dataset.bad - saved['bad']]
+               + [(id_, True, False) for id_ in saved['good'] - dataset.good]
+               + [(id_, False, False) for id_ in saved['bad'] - dataset.bad])
+
+    if len(patches) > MAX_PATCH:
+        return None
+
+    if not classifier.can_remove and any(not add for _, _, add in patches):
+        return None
+
+    # The model was trained on the old tags of voted posts, or skipped them
+    # if they weren't cached. If that's changed, there's no way to take them
+    # back out properly.
+    if any(old_checksums.get(id_) != checksum(id_)
+           for id_ in saved['good'] | saved['bad']):
+        return None
+
+    for id_, is_good, add in patches:
+        post = dataset.get_id(id_)
+
+        if post.deleted:
+            continue
+
+        if add:
+            nbc.add_post(post.features, is_good)
+        else:
+            nbc.remove_post(post.features, is_good)
+
+    if len(patches) > 0 or saved['scores'] is None:
+        return (nbc, None)
+
+    old_rows = {id_: row for row, id_ in enumerate(saved['ids'])}
+    scores = array('d', [0.0]) * len(table)
+    changed = []
+
+    for row, id_ in enumerate(table.ids):
+        old_row = old_rows.get(id_)
+
+        if (old_row is not None
+                and saved['checksums'][old_row] == checksums[row]):
+            scores[row] = saved['scores'][old_row]
+        else:
+            changed.append(row)
+
+    for row, score in zip(changed, nbc.predict_many(table, changed)):
+        scores[row] = score
+
+    return (nbc, scores)
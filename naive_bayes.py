@@ -1,8 +1,12 @@
 import random
 import math
+from array import array
+from collections import Counter
 from typing import List
 
 import post_data
+import parallel
+import classifiers
 
 """ Here's what's going on:
 
@@ -15,7 +19,8 @@ up or thumb them down, and we'll add them to the dataset.
 
 I don't want to have the user vote on stuff that the Classifier is
 predicting the user will like, because it seems like we'd start having a
-biased dataset. We should find out for sure, though.
+biased dataset. We should find out for sure, though. In the meantime,
+/explore shows the posts we know the least about. See mysteriousness.
 
 We need to make sure that ID's all stay the same no matter what. Can probably
 just ask. Seems likely, because of all those deleted posts and blank spots in
@@ -23,7 +28,7 @@ the ID list.
 """
 
 
-class NaiveBayesClassifier(object):
+class NaiveBayesClassifier(classifiers.Classifier):
     """
     Give it some Post's with tags and it'll try to guess which ones you'll like
     in the future.
@@ -96,44 +101,47 @@ class NaiveBayesClassifier(object):
     That's all it takes!
     """
 
-    def __init__(self, good_posts: List[List[str]],
-                 bad_posts: List[List[str]]):
-        good_posts, bad_posts = list(good_posts), list(bad_posts)
-
-        self.ngood = len(good_posts)
-        self.total = len(bad_posts) + len(good_posts)
-
-        try:
-            self.p_g = self.ngood / self.total
-        except ZeroDivisionError:
-            self.p_g = None
-
-        # {'tag_name': [n_good_posts, n_total_posts], ...}
-        self.tag_history = dict()
+    @classmethod
+    def from_dataset(cls, dataset: post_data.Dataset, *args, workers=None,
+                     **kwargs):
+        """ Alternative constructor. All * and ** args passed to __init__
 
-        for post in good_posts:
-            self._add_tags(post, True)
+        If workers is more than 1, the tags are counted in that many
+        processes, straight from the dataset's PostTable.
+        """
+        if workers is not None and workers > 1:
+            return cls._from_dataset_parallel(dataset, workers, *args,
+                                              **kwargs)
 
-        for post in bad_posts:
-            self._add_tags(post, False)
+        return super().from_dataset(dataset, *args, **kwargs)
 
     @classmethod
-    def from_dataset(cls, dataset: post_data.Dataset, *args, **kwargs):
-        """ Alternative constructor. All * and ** args passed to __init__"""
-        good_posts = [i.tags for i in dataset.get_good() if hasattr(i, 'tags')]
-        bad_posts  = [i.tags for i in dataset.get_bad()  if hasattr(i, 'tags')]
+    def _from_dataset_parallel(cls, dataset, workers, *args, **kwargs):
+        table = dataset.cache
+        good_rows = sorted(table.row(i) for i in dataset.good if i in table)
+        bad_rows  = sorted(table.row(i) for i in dataset.bad  if i in table)
+        good_counts, bad_counts = Counter(), Counter()
 
-        return cls(good_posts, bad_posts, *args, **kwargs)
+        for rows, counts in [(good_rows, good_counts),
+                             (bad_rows, bad_counts)]:
+            for block, block_rows in table.blocks(rows):
+                counts.update(parallel.count_tags(block, block_rows, workers))
 
-    def _add_tags(self, post: List[str], is_good: bool):
-        for tag in post:
-            if tag not in self.tag_history:
-                self.tag_history[tag] = [0, 0]
+        nbc = cls([], [], *args, **kwargs)
+        nbc.ngood = len(good_rows)
+        nbc.total = len(good_rows) + len(bad_rows)
+        nbc._update_p_g()
 
-            if is_good:
-                self.tag_history[tag][0] += 1
+        for tag_id in good_counts.keys() | bad_counts.keys():
+            good = good_counts.get(tag_id, 0)
+            nbc.tag_history[table.tag_names[tag_id]] = [
+                good, good + bad_counts.get(tag_id, 0)]
 
-            self.tag_history[tag][1] += 1
+        return nbc
+
+    def _train(self, post, is_good, count):
+        # The counts are the whole model.
+        pass
 
     def p_t_g(self, tag):
         """
@@ -183,20 +191,78 @@ class NaiveBayesClassifier(object):
 
         return temp
 
-    def mysteriousness(self, post: List[str]) -> int:
+    def tag_ratios(self, tag_names: List[str]) -> array:
         """
-        How mysterious is this post? How little do we know about its tags?
+        P(tag | G) / P(tag) for every tag in tag_names, in the same order. Tags
+        we've never seen get 1.0, so they don't change the prediction.
         """
-        # TODO: This whole thing.
-        # Should probably use self.total in here somewhere.
-        raise Exception("Not finished yet!")
+        ratios = array('d', [1.0]) * len(tag_names)
 
-        tags_seen = 0
-        for tag in post:
-            if tag not in self.tag_history:
+        for i, tag in enumerate(tag_names):
+            if tag in self.tag_history:
+                ratios[i] = self.p_t_g(tag) / self.p_t(tag)
+
+        return ratios
+
+    def _compute_tag_weights(self, tag_names: List[str]) -> List[float]:
+        """
+        log(P(tag | G) / P(tag)): how much each tag adds to a post's
+        prediction, in log space. -inf if the tag is never on a good post, 0
+        if we've never seen it at all.
+        """
+        return [math.log(ratio) if ratio > 0 else -math.inf
+                for ratio in self.tag_ratios(tag_names)]
+
+    # The old names, from before there was more than one classifier.
+    log_tag_weight = classifiers.Classifier.tag_weight
+    log_tag_weights = classifiers.Classifier.tag_weights
+
+    @property
+    def log_p_g(self) -> float:
+        """ log(P(G)), or -inf if we have no good posts (or no data). """
+        return math.log(self.p_g) if self.p_g else -math.inf
+
+    @property
+    def bias(self) -> float:
+        return self.log_p_g
+
+    from_linear = staticmethod(math.exp)
+
+    def predict_table(self, table: post_data.PostTable, rows=None,
+                      workers=None) -> array:
+        """
+        Like predict, but for many rows of a PostTable at once. Works on the
+        table's tag id columns directly, so no SimplePosts are created.
+
+        rows defaults to every row in the table. The predictions are in the
+        same order as rows. If workers is more than 1, the rows are split
+        between that many processes.
+
+        If we have no training data at all, everything is predicted as 0.
+        """
+        ratios = self.tag_ratios(table.tag_names)
+        p_g = self.p_g or 0.0
+        predictions = array('d')
+
+        for block, block_rows in table.blocks(rows):
+            if workers is not None and workers > 1:
+                predictions.extend(parallel.predict_table(
+                    block, ratios, p_g, block_rows, workers))
                 continue
 
-            tags_seen += self.tag_history[tag][1]
+            offsets, tag_ids = block.tag_offsets, block.tag_ids
+
+            for row in block_rows:
+                temp = p_g
+
+                for j in range(offsets[row], offsets[row+1]):
+                    temp *= ratios[tag_ids[j]]
+
+                predictions.append(temp)
+
+        return predictions
+
+    predict_many = predict_table
 
 
 def split_dataset(dataset, split_ratio=0.33):
@@ -205,12 +271,12 @@ def split_dataset(dataset, split_ratio=0.33):
     the algorithm after training is complete.
 
     Split ratio: What portion is used for training data?
+
+    See evaluation.py for proper k-fold cross-validation.
     """
-    # I definitely won't be using this as-is, but it's nice to have as a
-    # reference for later.
-    train_size = math.round(len(dataset) * split_ratio)
+    train_size = round(len(dataset) * split_ratio)
 
-    copy = dataset[:]
+    copy = list(dataset)
     random.shuffle(copy)
     train_set = copy[:train_size]
     test_set  = copy[train_size:]
@@ -0,0 +1,238 @@
+import atexit
+import collections
+import concurrent.futures
+import weakref
+from array import array
+from multiprocessing import shared_memory
+from typing import Dict
+
+"""
+Spreads the heavy PostTable loops (tag counting and scoring) across a process
+pool. The columns that every worker needs are copied into shared memory once,
+so that they don't have to be pickled and sent to each process.
+
+The pool is only started once per process, and the last table's columns are
+kept in shared memory until another table comes along, so that scoring the
+same table again costs nothing extra. Calls with fewer than MIN_PARALLEL_ROWS
+rows just run here, where the work is quicker than handing it out.
+"""
+
+# Below this many rows, the loops run in this process.
+MIN_PARALLEL_ROWS = 20000
+
+# {workers: ProcessPoolExecutor}, kept for as long as the process lasts.
+_executors = {}
+
+# (weakref to a table, its generation, SharedArrays of its tag columns) for
+# the last table that was worked on. See _table_columns.
+_columns = None
+
+
+class SharedArrays(object):
+    """
+    Copies some arrays into shared memory, for as long as the 'with' block
+    lasts, or until close():
+
+    with SharedArrays(tag_ids=table.tag_ids, ...) as shared:
+        executor.submit(worker, shared.spec, ...)
+
+    shared.spec is small and picklable. Workers turn it back into memoryviews
+    with attach().
+    """
+
+    def __init__(self, **arrays):
+        self.blocks = {}
+
+        # {'name': (shared_memory_name, typecode, length), ...}
+        self.spec = {}
+
+        for name, array_ in arrays.items():
+            nbytes = len(array_) * array_.itemsize
+
+            # SharedMemory won't make a block of size 0.
+            block = shared_memory.SharedMemory(
+                create=True, size=max(nbytes, array_.itemsize))
+            block.buf[:nbytes] = array_.tobytes()
+
+            self.blocks[name] = block
+            self.spec[name] = (block.name, array_.typecode, len(array_))
+
+    def view(self, name) -> memoryview:
+        _, typecode, length = self.spec[name]
+        return self.blocks[name].buf.cast(typecode)[:length]
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def attach(spec):
+    """
+    Returns ({'name': memoryview, ...}, [blocks]). Keep the blocks around
+    until you're done with the views, then close() them.
+    """
+    views, blocks = {}, []
+
+    for name, (block_name, typecode, length) in spec.items():
+        # Workers share the parent's resource tracker, so attaching here
+        # doesn't stop the parent from cleaning up the block later.
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        views[name] = block.buf.cast(typecode)[:length]
+
+    return views, blocks
+
+
+def _release(views, blocks):
+    for view in views.values():
+        view.release()
+
+    for block in blocks:
+        block.close()
+
+
+def _count_tags(offsets, tag_ids, rows, start, end) -> Dict[int, int]:
+    counts = collections.Counter()
+    for row in rows[start:end]:
+        counts.update(tag_ids[offsets[row]:offsets[row+1]])
+
+    return counts
+
+
+def _predict(offsets, tag_ids, rows, ratios, out, p_g, start, end):
+    for i in range(start, end):
+        row = rows[i]
+        temp = p_g
+
+        for j in range(offsets[row], offsets[row+1]):
+            temp *= ratios[tag_ids[j]]
+
+        out[i] = temp
+
+
+def _count_tags_worker(spec, start, end) -> Dict[int, int]:
+    views, blocks = attach(spec)
+
+    try:
+        return _count_tags(views['tag_offsets'], views['tag_ids'],
+                           views['rows'], start, end)
+    finally:
+        _release(views, blocks)
+
+
+def _predict_worker(spec, p_g, start, end):
+    views, blocks = attach(spec)
+
+    try:
+        _predict(views['tag_offsets'], views['tag_ids'], views['rows'],
+                 views['ratios'], views['predictions'], p_g, start, end)
+    finally:
+        _release(views, blocks)
+
+
+def _shards(n, workers):
+    """ Split range(n) into about 'workers' contiguous (start, end) pairs. """
+    size = max(1, -(-n // workers))
+    return [(start, min(start + size, n)) for start in range(0, n, size)]
+
+
+def _executor(workers) -> concurrent.futures.ProcessPoolExecutor:
+    if workers not in _executors:
+        _executors[workers] = concurrent.futures.ProcessPoolExecutor(workers)
+
+    return _executors[workers]
+
+
+def _table_columns(table) -> SharedArrays:
+    """ The table's tag columns in shared memory. They're only copied again
+    if it's a different table, or it's changed since.
+    """
+    global _columns
+
+    if _columns is not None:
+        table_ref, generation, shared = _columns
+
+        if table_ref() is table and generation == table.generation:
+            return shared
+
+        shared.close()
+
+    shared = SharedArrays(tag_offsets=table.tag_offsets,
+                          tag_ids=table.tag_ids)
+    _columns = (weakref.ref(table), table.generation, shared)
+    return shared
+
+
+@atexit.register
+def _close_columns():
+    global _columns
+
+    if _columns is not None:
+        _columns[2].close()
+        _columns = None
+
+
+def count_tags(table, rows, workers) -> Dict[int, int]:
+    """
+    How many of the given rows have each tag? Returns {tag_id: count, ...}
+    """
+    rows = array('l', rows)
+
+    if len(rows) < MIN_PARALLEL_ROWS:
+        return dict(_count_tags(table.tag_offsets, table.tag_ids, rows,
+                                0, len(rows)))
+
+    columns = _table_columns(table)
+
+    with SharedArrays(rows=rows) as shared:
+        spec = dict(columns.spec, **shared.spec)
+        futures = [_executor(workers).submit(_count_tags_worker, spec,
+                                             start, end)
+                   for start, end in _shards(len(rows), workers)]
+
+        counts = collections.Counter()
+        for future in futures:
+            counts.update(future.result())
+
+    return dict(counts)
+
+
+def predict_table(table, ratios, p_g, rows, workers) -> array:
+    """
+    Parallel version of the loop in NaiveBayesClassifier.predict_table. Each
+    worker writes its shard of predictions straight into shared memory.
+    """
+    rows = array('l', rows)
+    predictions = array('d', [0.0]) * len(rows)
+
+    if len(rows) < MIN_PARALLEL_ROWS:
+        _predict(table.tag_offsets, table.tag_ids, rows, ratios, predictions,
+                 p_g, 0, len(rows))
+        return predictions
+
+    columns = _table_columns(table)
+
+    with SharedArrays(rows=rows, ratios=ratios,
+                      predictions=predictions) as shared:
+        spec = dict(columns.spec, **shared.spec)
+        futures = [_executor(workers).submit(_predict_worker, spec, p_g,
+                                             start, end)
+                   for start, end in _shards(len(rows), workers)]
+
+        for future in futures:
+            future.result()
+
+        out = shared.view('predictions')
+        predictions = array('d', out)
+        out.release()
+
+    return predictions
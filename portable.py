@@ -0,0 +1,135 @@
+import bz2
+import gzip
+import json
+import lzma
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple
+
+import post_data
+from id_set import IdSet
+
+"""
+Moves a Dataset's votes and cache in and out of a portable file, for backups
+and for moving them between machines. Unlike the pickles, it doesn't care
+about the Python version, and it's read and written a line at a time, so
+nothing but the Dataset itself ever has to be in memory.
+
+The file is JSON Lines, compressed according to its extension (.gz, .bz2 or
+.xz, or not at all). The first line is a header, and every line after that is
+one of:
+
+{"good": [post_id, ...]}    Up to CHUNK_SIZE votes.
+{"bad": [post_id, ...]}
+{"post": {...}}             A post, as Hypnohub-style JSON. See
+                            SimplePost.to_json.
+"""
+
+FORMAT = 'hypnohub-dataset'
+VERSION = 1
+
+CHUNK_SIZE = 1000
+
+# {extension: (open function, options for writing), ...}
+# The default levels are much slower, for files that are barely smaller.
+_OPENERS = {
+    '.gz':  (gzip.open, {'compresslevel': 5}),
+    '.bz2': (bz2.open,  {'compresslevel': 5}),
+    '.xz':  (lzma.open, {'preset': 1}),
+}
+
+
+def open_file(path, mode='r'):
+    """ Open a text file, compressed or not depending on its extension. """
+    for extension, (opener, options) in _OPENERS.items():
+        if path.endswith(extension):
+            if mode == 'r':
+                options = {}
+
+            return opener(path, mode + 't', encoding='utf8', **options)
+
+    return open(path, mode, encoding='utf8')
+
+
+def _chunks(iterable: Iterable, size) -> Iterator[List]:
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(islice(iterator, size))
+
+        if len(chunk) == 0:
+            return
+
+        yield chunk
+
+
+def export_dataset(dataset: post_data.Dataset, path,
+                   chunk_size=CHUNK_SIZE, posts=None) -> int:
+    """
+    Write every vote and cached post to path. Returns how many posts there
+    were.
+
+    posts are the posts to write instead of the ones in dataset.cache, like
+    dataset.shards.posts() to read them straight from disk.
+    """
+    if posts is None:
+        posts = dataset.get_all()
+
+    count = 0
+
+    with open_file(path, 'w') as f:
+        f.write(json.dumps({'format': FORMAT, 'version': VERSION}) + '\n')
+
+        for key, ids in [('good', dataset.good), ('bad', dataset.bad)]:
+            for chunk in _chunks(ids, chunk_size):
+                f.write(json.dumps({key: chunk}) + '\n')
+
+        for chunk in _chunks(posts, chunk_size):
+            f.write(''.join(json.dumps({'post': post.to_json()}) + '\n'
+                            for post in chunk))
+            count += len(chunk)
+
+    return count
+
+
+def import_dataset(dataset: post_data.Dataset, path) -> Tuple[int, int]:
+    """
+    Add everything in a file from export_dataset to the dataset. Posts
+    replace any cached version of themselves, and votes replace any vote the
+    other way on the same post. Returns (posts, votes) read.
+
+    Raises ValueError if the file isn't an export, or is from a newer version
+    of this.
+    """
+    posts = votes = 0
+
+    with open_file(path) as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = None
+
+        if not isinstance(header, dict) or header.get('format') != FORMAT:
+            raise ValueError(f"Not a dataset export: {path}")
+
+        if header.get('version', 0) > VERSION:
+            raise ValueError(f"Export is from a newer version ({path}): "
+                             f"{header['version']} > {VERSION}")
+
+        for line in f:
+            record = json.loads(line)
+
+            if 'post' in record:
+                dataset.add_post(record['post'])
+                posts += 1
+            elif 'good' in record:
+                ids = IdSet(record['good'])
+                dataset.good |= ids
+                dataset.bad -= ids
+                votes += len(ids)
+            elif 'bad' in record:
+                ids = IdSet(record['bad'])
+                dataset.bad |= ids
+                dataset.good -= ids
+                votes += len(ids)
+
+    return (posts, votes)
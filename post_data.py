@@ -3,8 +3,16 @@ import pickle
 import sys
 import string
 import bz2
+import bisect
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
 
 import hhapi
+import tag_index
+import dedup
+import cache_file
+from id_set import IdSet
+import metrics
 
 """
 Classes for storing data on Hypnohub posts.
@@ -42,6 +50,33 @@ Classes for storing data on Hypnohub posts.
 # </posts>
 
 
+def extra_features(rating, author, score):
+    """
+    The names of a post's features besides its tags: its rating, author and
+    score, for the classifiers to learn from like any other tag. Scores are
+    bucketed by powers of two, so that there are only a few of them.
+
+    Tags never have spaces in them, so these can't clash with real tags.
+    """
+    if score < 1:
+        score_name = "score: <1"
+    else:
+        low = 1 << (score.bit_length() - 1)
+        score_name = f"score: {low}-{2*low - 1}"
+
+    return (f"rating: {rating or '-'}", f"author: {author}", score_name)
+
+
+# The kinds of extra_features that only have a few values, so that each one
+# is shared by a big part of the cache. See TagIndex.top_k.
+COMMON_FEATURES = ('rating', 'score')
+
+
+def is_extra_feature(name) -> bool:
+    """ Is this the name of one of extra_features, rather than a tag? """
+    return ' ' in name
+
+
 class SimplePost(object):
     """
     A simple way of storing the data of a Hypnohub post. It intentionally
@@ -135,61 +170,574 @@ class SimplePost(object):
 
         return str_
 
+    def to_json(self):
+        """ Hypnohub-style JSON that makes this post again. """
+        if self.deleted:
+            return {'id': self.id}
+
+        return {
+            'id':          self.id,
+            'score':       self.score,
+            'rating':      self.rating,
+            'tags':        ' '.join(sorted(self.tags)),
+            'author':      self.author,
+            'md5':         self.md5,
+            'file_url':    self.file_url,
+            'jpeg_url':    self.file_url,
+            'preview_url': self.preview_url,
+            'sample_url':  self.sample_url,
+        }
+
+    @property
+    def features(self):
+        """ What the classifiers look at. The tags, plus extra_features. """
+        return self.tags | set(extra_features(self.rating, self.author,
+                                              self.score))
+
     @property
     def page_url(self):
         return f"http://hypnohub.net/post/show/{self.id}/"
 
 
+class PostTable(object):
+    """
+    A columnar store for every cached Hypnohub post. Instead of one dict (or
+    one SimplePost) per post, each field lives in its own compact column and a
+    post is just a row number. Rows are always kept sorted by post id, so
+    finding a post is a binary search over self.ids.
+
+    self.ids         = array('l', [post_id, post_id, ...])
+    self.scores      = array('l', [score, score, ...])
+    self.ratings     = array('b', [rating_code, ...]) # index into RATINGS
+    self.author_ids  = array('l', [author_id, ...])   # index into authors
+    self.md5s        = bytearray(16 bytes per post)
+    self.url_exts    = bytearray(3 bytes per post)    # index into EXTENSIONS
+
+    URLs are never stored as strings if they can be helped. A post's file,
+    preview and sample URLs are URL_PREFIXES plus its md5 and an extension,
+    so only the extension codes are kept. See url().
+
+    Tags use the CSR (compressed sparse row) layout. Row i's tag ids are:
+
+    self.tag_ids[self.tag_offsets[i]:self.tag_offsets[i+1]]
+
+    They're sorted within each row, and map to strings through
+    self.tag_names. Authors work the same way with self.authors.
+
+    Each row's tags are followed by the ids of its self.nfeatures
+    extra_features, which share the tag vocabulary. So a classifier can score
+    a post from tag_ids alone, without caring what kind of feature each one
+    is. row_tag_ids leaves them off, and row_feature_ids doesn't.
+
+    Iterating over a PostTable yields PostViews, which look like SimplePosts
+    but read straight from the columns.
+    """
+
+    RATINGS = 'sqe'
+
+    # The file, preview and sample URLs of a post go:
+    # URL_PREFIXES[i] + md5 + '.' + EXTENSIONS[url_exts[row*3 + i]]
+    URL_PREFIXES = ('//hypnohub.net//data/image/',
+                    '//hypnohub.net//data/preview/',
+                    '//hypnohub.net//data/sample/')
+    EXTENSIONS = ('jpg', 'png', 'gif', 'jpeg', 'webm', 'mp4', 'swf')
+    _EXTENSION_CODES = {ext: i for i, ext in enumerate(EXTENSIONS)}
+
+    # In url_exts, for posts whose URLs are in odd_urls instead.
+    ODD_URL = 0xff
+
+    # len(extra_features(...)). Tables pickled before there were extra
+    # features have nfeatures = 0, and Dataset rebuilds them.
+    NFEATURES = 3
+    nfeatures = 0
+
+    # The highest Hypnohub change number that the table is up to date with,
+    # or None if nobody's been keeping track. See Dataset.refresh_cache.
+    last_change = None
+
+    # Whether reading rows in any order is as cheap as reading them in
+    # order. See cache_file.ShardedTable.
+    random_access = True
+
+    def __init__(self):
+        self.ids        = array('l')
+        self.scores     = array('l')
+        self.ratings    = array('b')
+        self.author_ids = array('l')
+        self.md5s       = bytearray()
+
+        self.tag_offsets = array('L', [0])
+        self.tag_ids     = array('l')
+        self.nfeatures   = self.NFEATURES
+
+        self.url_exts = bytearray()
+
+        # Hypnohub's md5's are always 32 hex digits, but just in case they
+        # aren't we keep them here. {post_id: 'md5 string', ...}
+        self.odd_md5s = {}
+
+        # The same goes for URLs that don't fit URL_PREFIXES.
+        # {post_id: (file_url, preview_url, sample_url), ...}
+        self.odd_urls = {}
+
+        self.tag_names = []
+        self.tag_index = {}
+        self.authors = []
+        self.author_index = {}
+
+        # Bumped on every change, so that anything derived from the table
+        # (like row numbers or score arrays) knows when it's out of date.
+        self.generation = 0
+
+        self.last_change = None
+
+    def __setstate__(self, state):
+        """ Tables pickled before url_exts kept every URL as a string. """
+        url_lists = [state.pop(name, None) for name in
+                     ('file_urls', 'preview_urls', 'sample_urls')]
+        self.__dict__.update(state)
+
+        if url_lists[0] is not None:
+            self.url_exts = bytearray()
+            self.odd_urls = {}
+
+            for row, urls in enumerate(zip(*url_lists)):
+                self.url_exts += self.encode_urls(row, urls)
+
+    @classmethod
+    def from_cache(cls, cache):
+        """ Build a table from an old-style {post_id: post_json, ...} dict. """
+        table = cls()
+
+        for id_ in sorted(cache.keys()):
+            table.add(cache[id_])
+
+        return table
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id_):
+        try:
+            self.row(id_)
+        except KeyError:
+            return False
+
+        return True
+
+    def __iter__(self):
+        return map(self.view, range(len(self.ids)))
+
+    @property
+    def highest_id(self):
+        return self.ids[-1] if len(self.ids) > 0 else 0
+
+    def row(self, id_):
+        """ Raises KeyError if the post isn't in the table. """
+        row = bisect.bisect_left(self.ids, id_)
+
+        if row == len(self.ids) or self.ids[row] != id_:
+            raise KeyError(id_)
+
+        return row
+
+    def get(self, id_):
+        return self.view(self.row(id_))
+
+    def view(self, row):
+        return PostView(self, row)
+
+    def row_tag_ids(self, row):
+        return self.tag_ids[self.tag_offsets[row]:
+                            self.tag_offsets[row+1] - self.nfeatures]
+
+    def row_feature_ids(self, row):
+        """ row_tag_ids, plus the ids of the row's extra_features. """
+        return self.tag_ids[self.tag_offsets[row]:self.tag_offsets[row+1]]
+
+    def row_md5(self, row) -> Optional[bytes]:
+        """ The row's md5 as 16 bytes, or None if it's an odd one. """
+        if self.ids[row] in self.odd_md5s:
+            return None
+
+        return bytes(self.md5s[row*16:row*16+16])
+
+    def blocks(self, rows=None) -> Iterator[Tuple['PostTable', Sequence]]:
+        """
+        For loops that work on the columns directly. Yields (table,
+        rows_of_that_table) for the given rows (every row by default), in
+        order. A PostTable is all one block, but a cache_file.ShardedTable
+        has one per shard.
+        """
+        yield self, range(len(self)) if rows is None else rows
+
+    def url(self, row, which) -> str:
+        """ which is 0, 1 or 2, for the file, preview or sample URL. """
+        try:
+            return self.odd_urls[self.ids[row]][which]
+        except KeyError:
+            pass
+
+        md5 = self.md5s[row*16:row*16+16].hex()
+        ext = self.EXTENSIONS[self.url_exts[row*3 + which]]
+        return f"{self.URL_PREFIXES[which]}{md5}.{ext}"
+
+    def encode_urls(self, row, urls) -> bytes:
+        """
+        The url_exts bytes for a row's (file_url, preview_url, sample_url),
+        going by the md5 that's already in the row. If they don't fit
+        URL_PREFIXES, they go in odd_urls instead, and the bytes say so.
+        """
+        id_ = self.ids[row]
+        md5 = self.md5s[row*16:row*16+16].hex()
+        codes = []
+
+        if id_ not in self.odd_md5s:
+            for prefix, url in zip(self.URL_PREFIXES, urls):
+                start = f"{prefix}{md5}."
+
+                if not url.startswith(start):
+                    break
+
+                code = self._EXTENSION_CODES.get(url[len(start):])
+
+                if code is None:
+                    break
+
+                codes.append(code)
+            else:
+                return bytes(codes)
+
+        self.odd_urls[id_] = tuple(urls)
+        return bytes([self.ODD_URL] * 3)
+
+    def intern_tag(self, tag):
+        try:
+            return self.tag_index[tag]
+        except KeyError:
+            self.tag_index[tag] = len(self.tag_names)
+            self.tag_names.append(tag)
+            return self.tag_index[tag]
+
+    def intern_author(self, author):
+        try:
+            return self.author_index[author]
+        except KeyError:
+            self.author_index[author] = len(self.authors)
+            self.authors.append(author)
+            return self.author_index[author]
+
+    def add(self, data):
+        """
+        Add (or replace) a post from its raw Hypnohub JSON. Deleted posts are
+        removed from the table instead.
+        """
+        spost = SimplePost(data)
+
+        if spost.deleted:
+            self.remove(spost.id)
+            return
+
+        if spost.id in self:
+            self.remove(spost.id)
+
+        tag_ids = array('l', sorted(map(self.intern_tag, spost.tags)))
+
+        if self.nfeatures > 0:
+            tag_ids.extend(map(self.intern_tag, extra_features(
+                spost.rating, spost.author, spost.score)))
+
+        try:
+            md5 = bytes.fromhex(spost.md5)
+        except ValueError:
+            md5 = b''
+
+        if len(md5) != 16:
+            self.odd_md5s[spost.id] = spost.md5
+            md5 = bytes(16)
+
+        row = bisect.bisect_left(self.ids, spost.id)
+        tag_start = self.tag_offsets[row]
+
+        self.ids.insert(row, spost.id)
+        self.scores.insert(row, spost.score)
+        self.ratings.insert(row, self.RATINGS.find(spost.rating or '-'))
+        self.author_ids.insert(row, self.intern_author(spost.author))
+        self.md5s[row*16:row*16] = md5
+
+        self.tag_ids[tag_start:tag_start] = tag_ids
+        self.tag_offsets[row+1:] = array(
+            'L', (i + len(tag_ids) for i in self.tag_offsets[row:]))
+
+        self.url_exts[row*3:row*3] = self.encode_urls(
+            row, (spost.file_url, spost.preview_url, spost.sample_url))
+
+        self.generation += 1
+
+    def remove(self, id_):
+        """ Does nothing if the post isn't in the table. """
+        try:
+            row = self.row(id_)
+        except KeyError:
+            return
+
+        tag_start, tag_end = self.tag_offsets[row], self.tag_offsets[row+1]
+        ntags = tag_end - tag_start
+
+        del self.ids[row]
+        del self.scores[row]
+        del self.ratings[row]
+        del self.author_ids[row]
+        del self.md5s[row*16:row*16+16]
+
+        del self.tag_ids[tag_start:tag_end]
+        self.tag_offsets[row+1:] = array(
+            'L', (i - ntags for i in self.tag_offsets[row+2:]))
+
+        del self.url_exts[row*3:row*3+3]
+
+        self.odd_md5s.pop(id_, None)
+        self.odd_urls.pop(id_, None)
+        self.generation += 1
+
+
+class PostView(SimplePost):
+    """
+    A SimplePost that reads its data from a row in a PostTable, instead of
+    storing it. Cheap to make and throw away.
+
+    Don't hold onto these across changes to the table. Row numbers shift when
+    posts are added or removed.
+    """
+
+    deleted = False
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+        self.id = table.ids[row]
+
+    @property
+    def score(self):
+        return self.table.scores[self.row]
+
+    @property
+    def tags(self):
+        names = self.table.tag_names
+        return {names[i] for i in self.table.row_tag_ids(self.row)}
+
+    @property
+    def features(self):
+        names = self.table.tag_names
+        return {names[i] for i in self.table.row_feature_ids(self.row)}
+
+    @property
+    def author(self):
+        return self.table.authors[self.table.author_ids[self.row]]
+
+    @property
+    def rating(self):
+        code = self.table.ratings[self.row]
+        return None if code < 0 else self.table.RATINGS[code]
+
+    @property
+    def md5(self):
+        if self.id in self.table.odd_md5s:
+            return self.table.odd_md5s[self.id]
+
+        return self.table.md5s[self.row*16:self.row*16+16].hex()
+
+    @property
+    def file_url(self):
+        return self.table.url(self.row, 0)
+
+    @property
+    def preview_url(self):
+        return self.table.url(self.row, 1)
+
+    @property
+    def sample_url(self):
+        return self.table.url(self.row, 2)
+
+
 class Dataset(object):
     """ Tracks the posts that the user has liked and disliked. Stores them in a
     file for later use. Also keeps a cache of all Hypnohub posts on the site.
 
-    self.good = [good_id, good_id, ...]
-    self.bad = [bad_id, bad_id, ...]
+    self.good = IdSet({good_id, good_id, ...})
+    self.bad = IdSet({bad_id, bad_id, ...})
+
+    self.cache = PostTable()
+    self.tag_index = tag_index.TagIndex(self.cache)
+    self.duplicate_index = dedup.DuplicateIndex(self.cache)
 
-    self.cache = {
-        post_id: SimplePost(post_id),
-        post_id: SimplePost(post_id),
-        ...
-    }
+    The cache is saved in shards with cache_file.ShardedCache, and only the
+    shards that add_post has touched are rewritten. On a host without the
+    memory for the whole cache, self.cache can be a cache_file.ShardedTable
+    instead, which only keeps a few shards in memory. See __init__. Old
+    caches in a single file, or pickled as a {post_id: post_json, ...} dict
+    or a PostTable without extra_features, are converted when they're
+    loaded.
+
+    update_cache fetches new posts, and refresh_cache fetches changes to the
+    ones that are already cached.
     """
     DATASET = "dataset.pickle.bz2"
-    CACHE   = "cache.pickle.bz2"
+    CACHE   = "cache"
 
-    def __init__(self):
-        if os.path.isfile(self.DATASET):
-            with bz2.open(self.DATASET, 'rb') as f:
-                raw_dataset = pickle.load(f)
+    # Where the cache was kept before, in order. Only read if there's no
+    # CACHE yet.
+    SINGLE_FILE_CACHE = "cache.hhc"
+    OLD_CACHE = "cache.pickle.bz2"
 
-            self.good = raw_dataset['good']
-            self.bad = raw_dataset['bad']
-        else:
-            self.good = set()
-            self.bad = set()
+    # The trained classifier and its predictions. See model_cache.py.
+    MODEL   = "model.pickle"
+
+    def __init__(self, load=True, load_cache=True, max_resident_shards=None):
+        """
+        If load is False, start out empty instead of reading the files on
+        disk. Saving will still overwrite the votes, though. See save.
 
-        if os.path.isfile(self.CACHE):
-            with bz2.open(self.CACHE, 'rb') as f:
+        If load_cache is False, only the votes are loaded, and saving leaves
+        the cache on disk alone. self.shards can still read posts from it.
+
+        If max_resident_shards is given, a sharded cache isn't read into
+        memory. self.cache is a cache_file.ShardedTable instead, which reads
+        shards as they're needed, and only keeps that many of them, besides
+        the ones with unsaved changes.
+        """
+        self.load_votes(load)
+        self.cache = PostTable()
+        self.shards = cache_file.ShardedCache(self.CACHE)
+        self.cache_loaded = load_cache
+
+        # Shards that are the same on disk as in self.cache.
+        self._clean_shards = set()
+        index = None
+        load_cache = load and load_cache
+
+        # Whether the cache on disk is self.cache, as it was loaded or last
+        # saved, so saving it can't lose posts that were never loaded.
+        self._cache_from_disk = load_cache
+
+        if (load_cache and self.shards.exists()
+                and max_resident_shards is not None):
+            self.shards.max_resident = max_resident_shards
+            self.cache, index = cache_file.ShardedTable.load(self.shards)
+        elif load_cache and self.shards.exists():
+            index = self.shards.load(self.cache)
+            self._clean_shards = set(self.shards.shards())
+        elif load_cache and os.path.isfile(self.SINGLE_FILE_CACHE):
+            index = cache_file.load(self.SINGLE_FILE_CACHE, self.cache)
+        elif load_cache and os.path.isfile(self.OLD_CACHE):
+            with bz2.open(self.OLD_CACHE, 'rb') as f:
                 self.cache = pickle.load(f)
-        else:
-            self.cache = {}
+
+            if isinstance(self.cache, dict):
+                self.cache = PostTable.from_cache(self.cache)
+
+        if self.cache.nfeatures != PostTable.NFEATURES:
+            self.cache = PostTable.from_cache(
+                {post.id: post.to_json() for post in self.cache})
+            self._clean_shards = set()
+            index = None
+
+        if index is None:
+            index = tag_index.TagIndex(self.cache)
+
+        self.tag_index = index
+        self._duplicate_index = None
 
     @property
     def cache_empty(self):
         return len(self.cache) == 0
 
-    def save(self):
-        """ Save dataset back to pickle file. """
+    @property
+    def duplicate_index(self) -> dedup.DuplicateIndex:
+        """ Built the first time it's needed, since it takes a few seconds
+        on a big cache. After that, add_post keeps it up to date.
+        """
+        if self._duplicate_index is None:
+            self._duplicate_index = dedup.DuplicateIndex(self.cache)
+
+        return self._duplicate_index
+
+    def load_votes(self, load=True):
+        """ Read self.good and self.bad from self.DATASET. """
+        if load and os.path.isfile(self.DATASET):
+            with bz2.open(self.DATASET, 'rb') as f:
+                raw_dataset = pickle.load(f)
+
+            # Older dataset files have plain sets.
+            self.good = IdSet(raw_dataset['good'])
+            self.bad = IdSet(raw_dataset['bad'])
+        else:
+            self.good = IdSet()
+            self.bad = IdSet()
+
+    def save_votes(self):
         with bz2.open(self.DATASET, 'wb') as f:
             pickle.dump({'good': self.good, 'bad': self.bad}, f)
 
-        with bz2.open(self.CACHE, 'wb') as f:
-            pickle.dump(self.cache, f)
+    @metrics.timed('hypnohub_save_seconds', "Time spent in Dataset.save.")
+    def save(self):
+        """
+        Save the votes, and any shards of the cache that have changed.
 
-    def get_highest_post(self):
-        if len(self.cache) == 0:
-            return 0
+        Raises FileExistsError, without saving anything, if the cache was
+        neither loaded from disk nor saved there yet, and there are already
+        posts there. reset_cache on a loaded dataset is the way to throw them
+        away.
+        """
+        if (self.cache_loaded and not self._cache_from_disk
+                and self.shards.exists() and len(self.shards.shards()) > 0):
+            raise FileExistsError(
+                f"Not overwriting the cache in {self.shards.path}, since it "
+                f"wasn't loaded")
+
+        self.save_votes()
+
+        if not self.cache_loaded:
+            return
+
+        if isinstance(self.cache, cache_file.ShardedTable):
+            self.cache.save(self.tag_index)
         else:
-            return max(self.cache.keys())
+            self._clean_shards = self.shards.save(
+                self.cache, self.tag_index, self._clean_shards)
+
+        self._cache_from_disk = True
+
+    def get_highest_post(self):
+        return self.cache.highest_id
+
+    def reset_cache(self):
+        """ Throw away every cached post. """
+        self.cache = PostTable()
+        self.tag_index = tag_index.TagIndex(self.cache)
+        self._duplicate_index = None
+        self._clean_shards = set()
+
+    def add_post(self, data):
+        """
+        Add a post to the cache from its raw Hypnohub JSON, replacing any old
+        version of it and keeping the tag index up to date. Deleted posts are
+        removed from the cache.
+        """
+        id_ = int(data['id'])
+        self._clean_shards.discard(cache_file.ShardedCache.shard_of(id_))
+
+        self.tag_index.discard(id_)
+        if self._duplicate_index is not None:
+            self._duplicate_index.discard(id_)
+
+        self.cache.add(data)
+
+        if id_ in self.cache:
+            self.tag_index.add(id_)
+
+            if self._duplicate_index is not None:
+                self._duplicate_index.add(id_)
 
     def get_id(self, id_):
         """ Get a SimplePost from the cache by post id.
@@ -197,7 +745,7 @@ class Dataset(object):
         Returns a blank, deleted SimplePost if the id wasn't found.
         """
         try:
-            return SimplePost(self.cache[id_])
+            return self.cache.get(id_)
         except KeyError:
             return SimplePost({'id': id_})
 
@@ -215,28 +763,167 @@ class Dataset(object):
 
     def get_all(self):
         """ Get all posts, in SimplePost form. """
-        return map(SimplePost, self.cache.values())
+        return iter(self.cache)
 
     def update_cache(self, print_progress=True):
-        new_posts = list(hhapi.get_posts(
-            tags="order:id id:>" + str(self.get_highest_post()),
-            limit=100))
+        """ Fetch every post newer than the newest one in the cache. Safe to
+        interrupt; it'll carry on from the newest post next time.
+        """
+        after = self.get_highest_post()
+
+        while True:
+            new_posts = list(hhapi.get_posts(
+                tags="order:id id:>" + str(after),
+                limit=100))
+
+            if len(new_posts) == 0:
+                return
+
+            # Not get_highest_post(), in case a whole page was deleted posts.
+            after = max(int(post['id']) for post in new_posts)
+
+            if print_progress:
+                print("ID#", new_posts[-1]['id'], end=' ')
+                print('-', len(new_posts), "posts", end=' ')
+                sys.stdout.flush()
+
+            for post in new_posts:
+                self.add_post(post)
+
+            if print_progress:
+                print('-', len(self.cache), 'stored')
+
+    def _start_tracking_changes(self):
+        """ Remember Hypnohub's latest change number, so that refresh_cache
+        knows where to start from.
+        """
+        newest = hhapi.get_posts(tags="order:change_desc", limit=1)
+        self.cache.last_change = max((int(post['change']) for post in newest),
+                                     default=0)
+
+    def refresh_cache(self, print_progress=True
+                      ) -> Dict[int, Optional[Set[str]]]:
+        """
+        Fetch the cached posts that have changed on Hypnohub since last time,
+        by asking for them in order of Hypnohub's change numbers, and patch
+        them into the cache and tag index. Tag and rating edits, new scores
+        and deletions all get picked up, for a request per 100 changed posts
+        instead of a whole new crawl. Safe to interrupt, like update_cache.
+
+        Posts newer than the newest cached post are left to update_cache.
+        The first refresh only starts keeping track of changes, since there's
+        no telling what changed before then.
+
+        Returns {post_id: its old features, ...} for every post that
+        actually changed, or None instead of features for posts that weren't
+        cached before. Classifiers trained on the old features can be patched
+        with that. See sessions.Session.refresh.
+
+        This is changed_pages and apply_changes, for when nothing else is
+        using the dataset in the meantime.
+        """
+        changes = {}
+
+        for changed_posts in self.changed_pages():
+            for id_, features in self.apply_changes(changed_posts).items():
+                changes.setdefault(id_, features)
 
-        if len(new_posts) == 0:
+            if print_progress:
+                print("Change#", self.cache.last_change, end=' ')
+                print('-', len(changes), "posts changed")
+                sys.stdout.flush()
+
+        return changes
+
+    def changed_pages(self) -> Iterator[List[Dict]]:
+        """
+        The raw JSON of cached posts that have changed since the last
+        refresh, a page at a time. Each page has to go through apply_changes
+        before the next one is asked for. Nothing in the dataset changes
+        while waiting for Hypnohub, so a server only has to lock it for
+        apply_changes. See refresh_cache.
+        """
+        if self.cache.last_change is None:
+            self._start_tracking_changes()
             return
 
-        if print_progress:
-            print("ID#", new_posts[-1]['id'], end=' ')
-            print('-', len(new_posts), "posts", end=' ')
-            sys.stdout.flush()
+        highest = self.get_highest_post()
+
+        while True:
+            changed_posts = list(hhapi.get_posts(
+                tags=(f"order:change change:>{self.cache.last_change}"
+                      f" id:<={highest}"),
+                limit=100))
+
+            if len(changed_posts) == 0:
+                return
+
+            yield changed_posts
+
+    def apply_changes(self, changed_posts: List[Dict]
+                      ) -> Dict[int, Optional[Set[str]]]:
+        """ Patch a page from changed_pages in. Returns the same as
+        refresh_cache, for just that page.
+        """
+        changes = {}
+
+        for data in changed_posts:
+            old = self.get_id(int(data['id']))
+
+            if data.get('status') == 'deleted':
+                data = {'id': data['id']}
+
+            if old.to_json() == SimplePost(data).to_json():
+                continue
+
+            changes.setdefault(old.id, None if old.deleted else old.features)
+            self.add_post(data)
+
+        self.cache.last_change = max(int(post['change'])
+                                     for post in changed_posts)
+        return changes
 
-        for post in new_posts:
-            spost = SimplePost(post)
 
-            if not spost.deleted:
-                self.cache[spost.id] = post
+class UserDataset(Dataset):
+    """
+    One user's votes, on top of another Dataset's cache and tag index. Every
+    user of the server gets one of these, so that there's only ever one copy
+    of the cache in memory, however many users there are.
+
+    The shared cache is never written by a UserDataset. Saving only saves the
+    votes, to "dataset-{name}.pickle.bz2", and model_cache.py saves the
+    user's classifier to "model-{name}.pickle".
+    """
+
+    def __init__(self, shared: Dataset, name, load=True):
+        self.shared = shared
+        self.name = name
+        self.DATASET = self.votes_file(name)
+        self.MODEL = f"model-{name}.pickle"
+        self.load_votes(load)
+
+    @staticmethod
+    def votes_file(name) -> str:
+        return f"dataset-{name}.pickle.bz2"
+
+    @property
+    def cache(self):
+        return self.shared.cache
+
+    @property
+    def tag_index(self):
+        return self.shared.tag_index
+
+    @property
+    def duplicate_index(self):
+        return self.shared.duplicate_index
+
+    def save(self):
+        """ Save this user's votes. """
+        self.save_votes()
 
-        if print_progress:
-            print('-', len(self.cache), 'stored')
+    def add_post(self, data):
+        self.shared.add_post(data)
 
-        self.update_cache(print_progress)
+    def reset_cache(self):
+        raise TypeError("The cache is shared. Reset it on the shared Dataset.")
@@ -1,86 +1,551 @@
+import bisect
+import collections
+import heapq
 import random
+import math
+from array import array
 from typing import List, Tuple
-import itertools
 
 import post_data
 import naive_bayes
+import classifiers
+import metrics
+from id_set import IdSet
 
 """
 Uses an NBC and a dataset to retrieve posts from various sort methods, like
-"best", "random", etc.
+"best", "random", etc. Any classifiers.Classifier works in place of the NBC.
 """
 
+# Every kind of classifier, by the name used to pick one in start_http.py.
+CLASSIFIERS = {
+    'naive_bayes': naive_bayes.NaiveBayesClassifier,
+    'logistic':    classifiers.LogisticClassifier,
+}
+
+SCORING_HELP = "Time spent ranking posts for PostGetter."
+
+
+def diverse_batch(candidates: List[Tuple[float, int]], table, k,
+                  diversity=0.3) -> List[Tuple[float, int]]:
+    """
+    Pick k of the (prediction, post_id) candidates, trading off prediction
+    against how much each post's tags overlap with the posts already picked.
+    This is Maximal Marginal Relevance: every step picks the candidate with
+    the best
+
+        (1 - diversity) * prediction - diversity * max_similarity
+
+    where max_similarity is the highest Jaccard similarity between its tags
+    and the tags of any post picked so far. diversity=0 just sorts by
+    prediction. Returned in the order they were picked.
+
+    Tag sets are bitsets in Python ints, over tag ids renumbered to just the
+    tags in the candidates, so a similarity is an & and a popcount.
+    """
+    # Read in row order, so that a cache_file.ShardedTable reads each shard
+    # once.
+    tag_ids = {}
+    for block, rows in table.blocks(sorted(table.row(id_)
+                                           for _, id_ in candidates)):
+        for row in rows:
+            tag_ids[block.ids[row]] = block.row_tag_ids(row)
+
+    local_ids = {}
+    masks = []
+
+    for _, id_ in candidates:
+        mask = 0
+
+        for tag_id in tag_ids[id_]:
+            mask |= 1 << local_ids.setdefault(tag_id, len(local_ids))
+
+        masks.append(mask)
+
+    sizes = [mask.bit_count() for mask in masks]
+    max_similarity = [0.0] * len(candidates)
+    remaining = list(range(len(candidates)))
+    picked = []
+
+    def mmr(i):
+        return ((1 - diversity) * candidates[i][0]
+                - diversity * max_similarity[i])
+
+    while len(remaining) > 0 and len(picked) < k:
+        best = max(remaining, key=mmr)
+        remaining.remove(best)
+        picked.append(candidates[best])
+
+        best_mask, best_size = masks[best], sizes[best]
+
+        # Only the newly picked post can raise anyone's max_similarity.
+        for i in remaining:
+            overlap = (masks[i] & best_mask).bit_count()
+
+            if overlap > 0:
+                similarity = overlap / (sizes[i] + best_size - overlap)
+
+                if similarity > max_similarity[i]:
+                    max_similarity[i] = similarity
+
+    return picked
+
+
+class QueryCache(collections.OrderedDict):
+    """
+    A dict by query that only keeps the max_size most recently used ones,
+    since queries come straight from users and there's no end to them.
+    """
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def __getitem__(self, query):
+        value = super().__getitem__(query)
+        self.move_to_end(query)
+        return value
+
+    def __setitem__(self, query, value):
+        super().__setitem__(query, value)
+        self.move_to_end(query)
+
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
 
 class PostGetter(object):
-    def __init__(self, dataset=None, nbc=None):
+    # How many posts get_best pulls out of the cache at a time.
+    BEST_BATCH_SIZE = 50
+
+    # get_hot picks HOT_BATCH_SIZE posts at a time with diverse_batch, out
+    # of about HOT_POOL_SIZE randomly chosen, positively rated posts.
+    HOT_BATCH_SIZE = 50
+    HOT_POOL_SIZE = 250
+    HOT_DIVERSITY = 0.3
+
+    # How many queries' rankings are kept in each of the caches below.
+    MAX_CACHED_QUERIES = 32
+
+    def __init__(self, dataset=None, nbc=None, workers=None,
+                 collapse_duplicates=False, scores=None):
+        """
+        workers: If more than 1, training and full rescoring of the cache are
+                 split across that many processes. See parallel.py.
+
+        scores: nbc's prediction for every row of the cache, in order, if
+                they're already known. See model_cache.py.
+
+        collapse_duplicates: If True, showing a post counts as showing every
+                             reupload and near-identical variant of it too,
+                             so that they don't come up again. See dedup.py.
+        """
         if dataset is None:
             dataset = post_data.Dataset()
         self.dataset = dataset
 
+        self.workers = workers
+        self.collapse_duplicates = collapse_duplicates
+
         if nbc is None:
-            nbc = naive_bayes.NaiveBayesClassifier.from_dataset(self.dataset)
+            nbc = naive_bayes.NaiveBayesClassifier.from_dataset(
+                self.dataset, workers=workers)
         self.nbc = nbc
 
-        # self._best_posts :: List[ Tuple[int, post_data.SimplePost] ]
-        self._best_posts = []
-        self.seen = set()
+        # self._best_posts :: Dict[ query, List[ Tuple[int, post_id] ] ]
+        # The query is a Hypnohub-style tag search, or None for every post.
+        self._best_posts = QueryCache(self.MAX_CACHED_QUERIES)
 
-    def _get_best_posts(self) -> List[Tuple[int, post_data.SimplePost]]:
+        # Same as self._best_posts, but only the top BEST_BATCH_SIZE posts.
+        # See _get_top_posts.
+        self._top_posts = QueryCache(self.MAX_CACHED_QUERIES)
+
+        # Same as self._top_posts, but for get_hot. See _get_hot_batch.
+        self._hot_batches = QueryCache(self.MAX_CACHED_QUERIES)
+
+        # The nbc.version that the three caches above were ranked with. See
+        # _check_rankings.
+        self._rankings_version = nbc.version
+
+        # Max-heaps of (-mysteriousness, post_id) for get_mysterious, by
+        # query like the others. See _get_mystery_heap.
+        self._mystery_heaps = QueryCache(self.MAX_CACHED_QUERIES)
+        self._mystery_state = None
+
+        # Posts that have been shown this session, voted on or not.
+        self.seen = IdSet()
+
+        # (predictions for every row, nbc.version, cache generation, cache
+        # ids) for _get_scores. Only good for as long as neither of the
+        # first two changes, unless refresh patches them. The ids are a copy
+        # for refresh, to line the old rows up with the new ones.
+        self._scores = None
+        if scores is not None:
+            self._keep_scores(scores)
+
+    def _clear_rankings(self):
+        self._best_posts.clear()
+        self._top_posts.clear()
+        self._hot_batches.clear()
+        self._rankings_version = self.nbc.version
+
+    def _check_rankings(self):
+        """ Drop the ranked posts if nbc has been trained since they were
+        ranked, like _get_scores does with the predictions.
+        """
+        if self._rankings_version != self.nbc.version:
+            self._clear_rankings()
+
+    def _keep_scores(self, scores):
+        table = self.dataset.cache
+        self._scores = (scores, self.nbc.version, table.generation,
+                        array('l', table.ids))
+
+    def _get_scores(self):
+        """ The prediction for every row of the cache, if they're still up
+        to date, and None otherwise.
+        """
+        if self._scores is None:
+            return None
+
+        scores, version, generation, _ = self._scores
+
+        if (version != self.nbc.version
+                or generation != self.dataset.cache.generation):
+            self._scores = None
+            return None
+
+        return scores
+
+    def all_scores(self):
+        """ The prediction for every row of the cache, in order. Worked out
+        if they aren't already known, and kept until the next vote.
+        """
+        scores = self._get_scores()
+
+        if scores is None:
+            with metrics.timed('hypnohub_scoring_seconds', SCORING_HELP,
+                               method='full'):
+                scores = self.nbc.predict_many(self.dataset.cache,
+                                               workers=self.workers)
+
+            self._keep_scores(scores)
+
+        return scores
+
+    def refresh(self, changed):
+        """
+        Catch up with posts that Dataset.refresh_cache changed. changed is
+        their ids. If nbc hasn't changed since the predictions were worked
+        out, only the changed posts are scored again, and every other
+        prediction is kept. Otherwise they all have to be worked out again
+        anyway.
+        """
+        self._clear_rankings()
+
+        if self._scores is None:
+            return
+
+        old_scores, version, _, old_ids = self._scores
+        self._scores = None
+
+        if version != self.nbc.version:
+            return
+
+        table = self.dataset.cache
+
+        if old_ids == table.ids:
+            # Nothing was added or deleted, so every row is where it was.
+            scores = array('d', old_scores)
+            rescore = sorted(table.row(id_) for id_ in changed
+                             if id_ in table)
+        else:
+            scores, rescore = self._line_up_scores(old_scores, old_ids,
+                                                   changed)
+
+        with metrics.timed('hypnohub_scoring_seconds', SCORING_HELP,
+                           method='refresh'):
+            for row, score in zip(rescore,
+                                  self.nbc.predict_many(table, rescore)):
+                scores[row] = score
+
+        self._keep_scores(scores)
+
+    def _line_up_scores(self, old_scores, old_ids, changed):
+        """ Old predictions, moved to the rows that their posts are in now.
+        Returns (scores, rows that need scoring again).
+        """
+        table = self.dataset.cache
+        scores = array('d', [0.0]) * len(table)
+        rescore = []
+        old_row = 0
+
+        # Both are sorted, and the posts that didn't change are in both.
+        for row, id_ in enumerate(table.ids):
+            while old_row < len(old_ids) and old_ids[old_row] < id_:
+                old_row += 1
+
+            if (id_ in changed or old_row == len(old_ids)
+                    or old_ids[old_row] != id_):
+                rescore.append(row)
+            else:
+                scores[row] = old_scores[old_row]
+
+        return (scores, rescore)
+
+    def _get_best_posts(self, tags=None) -> List[Tuple[int, int]]:
         """
         In ASCENDING order of rating. Not descending as you might assume! The
         best posts are at the end of the list so that we can efficiently pop
         them off.
+
+        Holds post id's rather than SimplePosts, so that we only have to look
+        up the posts that we actually serve.
+
+        If tags is given, only posts matching that search are scored. See
+        tag_index.TagIndex for the syntax.
         """
-        if len(self._best_posts) >= 1:
-            return self._best_posts
+        self._check_rankings()
+
+        if len(self._best_posts.get(tags, [])) >= 1:
+            return self._best_posts[tags]
 
         seen = self.dataset.good | self.dataset.bad | self.seen
-        self._best_posts = [(self.nbc.predict(i.tags), i)
-                            for i in self.dataset.get_all()
-                            if i.id not in seen]
+        table = self.dataset.cache
 
-        self._best_posts = sorted(self._best_posts, key=lambda x: x[0])
+        if tags is None:
+            rows = range(len(table))
+        else:
+            rows = self.dataset.tag_index.query_rows(tags)
 
-        return self._best_posts
+        scores = self._get_scores()
 
-    def get_best(self) -> Tuple[int, post_data.SimplePost]:
-        best_posts = self._get_best_posts()
-        prediction, post = best_posts.pop()
-        self.seen.add(post.id)
-        return (prediction, post)
+        with metrics.timed('hypnohub_scoring_seconds', SCORING_HELP,
+                           method='full' if scores is None else 'cached'):
+            if scores is None:
+                predictions = self.nbc.predict_many(table, rows, self.workers)
 
-    def get_random(self) -> Tuple[int, post_data.SimplePost]:
-        id_ = random.choice(list(self.dataset.cache.keys()))
+                if tags is None:
+                    self._keep_scores(predictions)
+            else:
+                predictions = map(scores.__getitem__, rows)
+
+            self._best_posts[tags] = sorted(
+                (prediction, table.ids[row])
+                for row, prediction in zip(rows, predictions)
+                if table.ids[row] not in seen)
+
+        return self._best_posts[tags]
+
+    def _get_top_posts(self, tags=None) -> List[Tuple[int, int]]:
+        """
+        Like _get_best_posts, but only finds the top BEST_BATCH_SIZE posts,
+        and uses the tag index to skip posts that can't possibly make it.
+        Before from_linear, the prediction for a post is a sum of per-tag
+        weights (see classifiers.py), so TagIndex.top_k can bound it from the
+        positive tags alone. With naive Bayes, most posts have no positive
+        tags at all, and never get scored.
+
+        If every post's prediction is already known, this just picks the
+        best of them.
+        """
+        self._check_rankings()
+
+        if len(self._top_posts.get(tags, [])) >= 1:
+            return self._top_posts[tags]
+
+        seen = self.dataset.good | self.dataset.bad | self.seen
+        index = self.dataset.tag_index
+        scores = self._get_scores()
+
+        # top_k reads posts in order of their bounds, which would mean
+        # reading shards over and over, so a ShardedTable is scored a shard
+        # at a time instead.
+        if scores is None and not self.dataset.cache.random_access:
+            scores = self.all_scores()
+
+        if scores is not None:
+            table = self.dataset.cache
+
+            if tags is None:
+                rows = range(len(table))
+            else:
+                rows = index.query_rows(tags)
+
+            with metrics.timed('hypnohub_scoring_seconds', SCORING_HELP,
+                               method='cached'):
+                top = heapq.nlargest(
+                    self.BEST_BATCH_SIZE,
+                    ((scores[row], table.ids[row]) for row in rows
+                     if table.ids[row] not in seen))
+
+            self._top_posts[tags] = top[::-1]
+            return self._top_posts[tags]
+
+        if tags is None:
+            candidates = None
+        else:
+            candidates = set(index.query(tags))
+
+        with metrics.timed('hypnohub_scoring_seconds', SCORING_HELP,
+                           method='top_k'):
+            top = index.top_k(
+                self.nbc.tag_weights(self.dataset.cache.tag_names),
+                self.nbc.bias,
+                self.BEST_BATCH_SIZE,
+                candidates,
+                seen)
+
+        self._top_posts[tags] = [(self.nbc.from_linear(score), id_)
+                                 for score, id_ in top]
+        return self._top_posts[tags]
+
+    def _mark_seen(self, id_):
         self.seen.add(id_)
+
+        if self.collapse_duplicates:
+            self.seen |= self.dataset.duplicate_index.duplicates(id_)
+
+    def _get_mystery_heap(self, tags=None) -> List[Tuple[float, int]]:
+        """
+        Every unseen post, by how mysterious it was when the heap was made.
+        Voting only makes posts less mysterious, so these are upper bounds
+        and get_mysterious can fix them up lazily. The heaps are only rebuilt
+        when that stops being true: when the cache changes, or when votes
+        are taken back out.
+        """
+        table = self.dataset.cache
+        generation, total = self._mystery_state or (None, None)
+
+        if generation != table.generation or self.nbc.total < total:
+            self._mystery_heaps.clear()
+            self._mystery_state = (table.generation, self.nbc.total)
+
+        if tags in self._mystery_heaps:
+            return self._mystery_heaps[tags]
+
+        seen = self.dataset.good | self.dataset.bad | self.seen
+
+        if tags is None:
+            rows = range(len(table))
+        else:
+            rows = self.dataset.tag_index.query_rows(tags)
+
+        with metrics.timed('hypnohub_scoring_seconds', SCORING_HELP,
+                           method='mysteriousness'):
+            scores = self.nbc.mysteriousness_table(table, rows)
+            heap = [(-score, table.ids[row])
+                    for row, score in zip(rows, scores)
+                    if table.ids[row] not in seen]
+            heapq.heapify(heap)
+
+        self._mystery_heaps[tags] = heap
+        return heap
+
+    def get_mysterious(self, tags=None) -> Tuple[int, post_data.SimplePost]:
+        """
+        The post that we know the least about, so that voting on it teaches
+        the classifier the most. See Classifier.mysteriousness.
+        Returns the usual prediction with it. Raises IndexError if there's
+        nothing left to show.
+        """
+        heap = self._get_mystery_heap(tags)
+        voted = self.dataset.good | self.dataset.bad
+
+        while True:
+            _, id_ = heapq.heappop(heap)
+
+            if id_ in self.seen or id_ in voted:
+                continue
+
+            post = self.dataset.get_id(id_)
+            mysteriousness = self.nbc.mysteriousness(post.features)
+
+            # Still at least as mysterious as the best upper bound left?
+            if len(heap) == 0 or mysteriousness >= -heap[0][0]:
+                break
+
+            heapq.heappush(heap, (-mysteriousness, id_))
+
+        self._mark_seen(id_)
+        return (self.nbc.predict(post.features), post)
+
+    def get_best(self, tags=None) -> Tuple[int, post_data.SimplePost]:
+        """ Raises IndexError if there's nothing left to show. """
+        # Posts can be seen after they're ranked, if they're duplicates of
+        # something that's been shown since.
+        while True:
+            prediction, id_ = self._get_top_posts(tags).pop()
+
+            if id_ not in self.seen:
+                break
+
+        self._mark_seen(id_)
+        return (prediction, self.dataset.get_id(id_))
+
+    def get_random(self) -> Tuple[int, post_data.SimplePost]:
+        id_ = random.choice(self.dataset.cache.ids)
+        self._mark_seen(id_)
         post = self.dataset.get_id(id_)
         assert not post.deleted
-        prediction = self.nbc.predict(post.tags)
+        prediction = self.nbc.predict(post.features)
         return (prediction, post)
 
-    def get_hot(self) -> Tuple[int, post_data.SimplePost]:
+    def _get_hot_batch(self, tags=None) -> List[Tuple[float, int]]:
         """
-        Posts that have a chance of being good and a chance of being... worse
-        than good.
+        The next HOT_BATCH_SIZE posts for get_hot. Like the other caches,
+        the post to show next is at the end.
+
+        The pool is drawn from the positively rated posts with a triangular
+        distribution, so better posts are more likely to make it in, and
+        then diverse_batch spreads the batch across different tags. Posts
+        that have been shown since the ranking are dropped from it first, so
+        the pool is only ever drawn from posts that are still left.
         """
-        def post_filter(i):
-            rating, post = i
-            return rating <= 0
+        self._check_rankings()
+
+        if len(self._hot_batches.get(tags, [])) >= 1:
+            return self._hot_batches[tags]
+
+        best_posts = self._get_best_posts(tags)
+        table = self.dataset.cache
 
-        best_posts = self._get_best_posts()
-        best_posts = list(itertools.dropwhile(post_filter, best_posts))
-        index = round(random.triangular(0,
-                                        len(best_posts)-1,
-                                        len(best_posts)-1))
+        with metrics.timed('hypnohub_scoring_seconds', SCORING_HELP,
+                           method='hot_batch'):
+            # Posts can also be deleted from the cache after they're ranked.
+            best_posts[:] = [(prediction, id_)
+                             for prediction, id_ in best_posts
+                             if id_ not in self.seen and id_ in table]
 
-        while index >= 0:
-            try:
-                result = best_posts.pop(index)
-                self.seen.add(result[1].id)
-                return result
-            except IndexError:
-                pass
+            # Skip the ones that aren't rated better than 0.
+            start = bisect.bisect_right(best_posts, (0, math.inf))
+            positive = len(best_posts) - start
+
+            if positive <= self.HOT_POOL_SIZE:
+                indexes = range(start, len(best_posts))
+            else:
+                indexes = {start + round(random.triangular(0, positive - 1,
+                                                           positive - 1))
+                           for _ in range(self.HOT_POOL_SIZE)}
+
+            pool = [best_posts[i] for i in indexes]
+
+            batch = diverse_batch(pool, table,
+                                  self.HOT_BATCH_SIZE, self.HOT_DIVERSITY)
+
+        self._hot_batches[tags] = batch[::-1]
+        return self._hot_batches[tags]
+
+    def get_hot(self, tags=None) -> Tuple[int, post_data.SimplePost]:
+        """
+        Posts that have a chance of being good and a chance of being...
+        worse than good, without a run of posts that are all about the same
+        thing. Raises IndexError if there's nothing left to show.
+        """
+        while True:
+            prediction, id_ = self._get_hot_batch(tags).pop()
 
-            index -= 1
+            if id_ not in self.seen and id_ in self.dataset.cache:
+                break
 
-        # Can't happen.
-        assert False
+        self._mark_seen(id_)
+        return (prediction, self.dataset.get_id(id_))
@@ -0,0 +1,93 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+from typing import List
+
+"""
+Opt-in cProfile captures for single requests and commands, so that "it's
+slow" can turn into an actual profile without patching any code.
+
+with profiling.profiled('best') as result:
+    do_slow_stuff()
+
+print(result.name)            # To find it again with load() or report().
+print(profiling.report(result.name))
+
+Profiles are saved in PROFILE_DIR as ordinary .prof files, so they also work
+with snakeviz, gprof2dot, or python -m pstats.
+"""
+
+PROFILE_DIR = os.path.abspath("./profiles/")
+
+# Only keep this many profiles around. The oldest get deleted first.
+MAX_PROFILES = 100
+
+
+class ProfileResult(object):
+    """ Filled in once the profiled block is done. """
+    name = None
+    path = None
+
+
+@contextlib.contextmanager
+def profiled(label):
+    """ Profile a block of code, and save the profile once it's done, even
+    if the block raises an exception.
+    """
+    result = ProfileResult()
+    profile = cProfile.Profile()
+    profile.enable()
+
+    try:
+        yield result
+    finally:
+        profile.disable()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        label = re.sub(r'[^A-Za-z0-9_-]+', '_', label).strip('_') or 'root'
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        result.name = f"{stamp}-{label}.prof"
+
+        # Don't overwrite a profile from earlier in the same second.
+        n = 1
+        while os.path.exists(os.path.join(PROFILE_DIR, result.name)):
+            n += 1
+            result.name = f"{stamp}-{label}-{n}.prof"
+
+        result.path = os.path.join(PROFILE_DIR, result.name)
+        profile.dump_stats(result.path)
+        prune()
+
+
+def list_profiles() -> List[str]:
+    """ Names of every saved profile, newest first. """
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+
+    return sorted((i for i in os.listdir(PROFILE_DIR) if i.endswith('.prof')),
+                  key=lambda i: os.path.getmtime(os.path.join(PROFILE_DIR, i)),
+                  reverse=True)
+
+
+def prune():
+    for name in list_profiles()[MAX_PROFILES:]:
+        os.remove(os.path.join(PROFILE_DIR, name))
+
+
+def report(name, sort='cumulative', limit=40) -> str:
+    """
+    The usual pstats table for a saved profile. Raises FileNotFoundError for
+    unknown names, including anything that tries to escape PROFILE_DIR.
+    """
+    if name not in list_profiles():
+        raise FileNotFoundError(name)
+
+    out = io.StringIO()
+    stats = pstats.Stats(os.path.join(PROFILE_DIR, name), stream=out)
+    stats.sort_stats(sort).print_stats(limit)
+
+    return out.getvalue()
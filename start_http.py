@@ -1,10 +1,34 @@
 import http_server
 
 server_address = ('127.0.0.1', 8000)
+
+# Set this to something like os.cpu_count() to train and score in parallel.
+# Only worth it for very large caches.
+workers = None
+
+# Set this to True to give everyone their own votes and recommendations, with
+# a cookie to tell them apart. Otherwise everyone shares dataset.pickle.bz2.
+multi_user = False
+
+# Set this to True to skip reuploads and near-identical variants of posts
+# you've already been shown. The first page load takes a few seconds longer.
+collapse_duplicates = False
+
+# Which classifier to rank posts with. See post_getters.CLASSIFIERS.
+classifier = 'naive_bayes'
+
+# Set this to a number of shards (of 10,000 post ids each) to only keep that
+# many of them in memory, instead of the whole cache. Ranking gets slower,
+# since shards have to be read back in. See cache_file.ShardedTable.
+max_resident_shards = None
+
 print("Serving on:",
       f"http://{server_address[0]}:{server_address[1]}/")
 try:
-    handler = http_server.RecommendationRequestHandler(server_address)
+    handler = http_server.RecommendationRequestHandler(
+        server_address, workers=workers, multi_user=multi_user,
+        collapse_duplicates=collapse_duplicates, classifier=classifier,
+        max_resident_shards=max_resident_shards)
     handler.server.serve_forever()
 except KeyboardInterrupt:
     pass
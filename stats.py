@@ -0,0 +1,160 @@
+import bisect
+from typing import Dict, Hashable, List, Tuple
+
+import post_data
+import classifiers
+
+"""
+The numbers behind /stats, kept up to date as votes come in instead of being
+recomputed from scratch on every page load.
+"""
+
+
+class CountRanking(object):
+    """
+    Keeps keys ranked by an integer count. Changing a count is O(1) (plus a
+    bisect when a brand new count shows up), and getting the top k is about
+    O(k), no matter how many keys there are.
+
+    self.counts  = {key: count, ...}
+    self.buckets = {count: {key, key, ...}, ...}
+    self.sorted_counts = [count, count, ...] # Ascending, no duplicates.
+    """
+
+    def __init__(self, counts: Dict[Hashable, int] = None):
+        self.counts = {}
+        self.buckets = {}
+        self.sorted_counts = []
+
+        for key, count in (counts or {}).items():
+            self.add(key, count)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _bucket_remove(self, key, count):
+        bucket = self.buckets[count]
+        bucket.remove(key)
+
+        if len(bucket) == 0:
+            del self.buckets[count]
+            del self.sorted_counts[bisect.bisect_left(self.sorted_counts,
+                                                      count)]
+
+    def _bucket_add(self, key, count):
+        if count not in self.buckets:
+            self.buckets[count] = set()
+            bisect.insort(self.sorted_counts, count)
+
+        self.buckets[count].add(key)
+
+    def add(self, key, delta=1):
+        """ Keys whose count drops to 0 (or less) are forgotten. """
+        old = self.counts.get(key, 0)
+        new = old + delta
+
+        if old > 0:
+            self._bucket_remove(key, old)
+
+        if new > 0:
+            self.counts[key] = new
+            self._bucket_add(key, new)
+        else:
+            self.counts.pop(key, None)
+
+    def top(self, k) -> List[Tuple[Hashable, int]]:
+        """ The k keys with the highest counts, highest first. Ties are in
+        no particular order.
+        """
+        result = []
+
+        for count in reversed(self.sorted_counts):
+            for key in self.buckets[count]:
+                if len(result) == k:
+                    return result
+
+                result.append((key, count))
+
+        return result
+
+
+class Stats(object):
+    """
+    Everything that /stats shows, for one dataset and classifier. Call
+    record_vote() whenever a vote is added or taken back, and the summary is
+    patched instead of rebuilt. Anything expensive is cached until the next
+    change, using self.version.
+    """
+
+    TOP_TAGS = 100
+
+    # The most id's that ids_page gives at once.
+    MAX_PER_PAGE = 1000
+
+    def __init__(self, dataset: post_data.Dataset,
+                 nbc: classifiers.Classifier):
+        self.dataset = dataset
+        self.nbc = nbc
+
+        # Just tags, not ratings and the like. See post_data.extra_features.
+        self.tag_totals = CountRanking(
+            {tag: total for tag, (_, total) in nbc.tag_history.items()
+             if not post_data.is_extra_feature(tag)})
+
+        self.sorted_ids = {'good': sorted(dataset.good),
+                           'bad':  sorted(dataset.bad)}
+
+        # Bumped on every change, so cached results know they're stale.
+        self.version = 0
+        self._summary = None
+        self._summary_version = None
+
+    def record_vote(self, id_, is_good, tags=None, undo=False):
+        """
+        Call this after adding the vote to the dataset and classifier (or
+        after taking it back out, with undo=True). tags is None for posts
+        that the classifier didn't train on.
+        """
+        ids = self.sorted_ids['good' if is_good else 'bad']
+        i = bisect.bisect_left(ids, id_)
+
+        if undo:
+            if i < len(ids) and ids[i] == id_:
+                del ids[i]
+        elif i == len(ids) or ids[i] != id_:
+            ids.insert(i, id_)
+
+        for tag in (tags or ()):
+            if not post_data.is_extra_feature(tag):
+                self.tag_totals.add(tag, -1 if undo else 1)
+
+        self.version += 1
+
+    def summary(self) -> Dict:
+        """ {'total_good', 'total_bad', 'p_g', 'top_tags': [...]} """
+        if self._summary_version != self.version:
+            self._summary = {
+                'total_good': len(self.dataset.good),
+                'total_bad':  len(self.dataset.bad),
+                'p_g':        self.nbc.p_g,
+                'top_tags': [
+                    {'tag': tag,
+                     'good': self.nbc.tag_history[tag][0],
+                     'total': total}
+                    for tag, total in self.tag_totals.top(self.TOP_TAGS)],
+            }
+            self._summary_version = self.version
+
+        return self._summary
+
+    def ids_page(self, which, page=0, per_page=200) -> List[int]:
+        """ One page of the sorted 'good' or 'bad' id's. Pages start at 0,
+        and have at most MAX_PER_PAGE id's. Raises ValueError for a negative
+        page, or a page size less than 1.
+        """
+        if page < 0 or per_page < 1:
+            raise ValueError(f"Bad page: {page}, {per_page} per page")
+
+        per_page = min(per_page, self.MAX_PER_PAGE)
+        start = page * per_page
+        return self.sorted_ids[which][start:start + per_page]
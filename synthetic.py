@@ -0,0 +1,112 @@
+import random
+import itertools
+from typing import Dict, Iterator
+
+import post_data
+from id_set import IdSet
+
+"""
+Makes up fake, but realistic-looking, Hypnohub data for tests and benchmarks,
+so that we don't have to pester Hypnohub or rely on whatever happens to be
+cached on disk.
+
+Tags and authors follow a Zipf distribution like on the real site: a handful
+of tags are on almost every post, and most tags are only on a few. Votes come
+from a made-up user who likes some tags and dislikes others, so there's
+actually something for the classifier to learn.
+"""
+
+
+def zipf_weights(n, s=1.0):
+    """ Cumulative weights for random.choices, where item i has weight
+    1/(i+1)**s.
+    """
+    return list(itertools.accumulate(1 / (i+1)**s for i in range(n)))
+
+
+def generate_posts(n, ntags=20000, nauthors=2000, seed=None, zipf_s=1.0,
+                   tags_per_post=(5, 30), deleted_ratio=0.05,
+                   start_id=1) -> Iterator[Dict]:
+    """
+    Yields n raw post JSON objects, exactly like hhapi.get_posts gives, in
+    order:id. Post id's skip a few numbers here and there, the same way that
+    deleted posts leave gaps on the real site.
+    """
+    rng = random.Random(seed)
+    tag_names = [f"tag_{i}" for i in range(ntags)]
+    authors = [f"author_{i}" for i in range(nauthors)]
+    tag_weights = zipf_weights(ntags, zipf_s)
+    author_weights = zipf_weights(nauthors, zipf_s)
+
+    id_ = start_id
+    for _ in range(n):
+        while rng.random() < deleted_ratio:
+            id_ += 1
+
+        md5 = f"{rng.getrandbits(128):032x}"
+        ext = rng.choice(['jpg', 'jpg', 'jpg', 'png', 'gif'])
+        ntags_here = rng.randint(*tags_per_post)
+        tags = set(rng.choices(tag_names, cum_weights=tag_weights,
+                               k=ntags_here))
+
+        yield {
+            'id':          id_,
+            'score':       str(int(rng.expovariate(1/15))),
+            'rating':      rng.choices('sqe', weights=[5, 3, 2])[0],
+            'tags':        ' '.join(sorted(tags)),
+            'author':      rng.choices(authors, cum_weights=author_weights)[0],
+            'md5':         md5,
+            'file_url':    f"//hypnohub.net//data/image/{md5}.{ext}",
+            'jpeg_url':    f"//hypnohub.net//data/image/{md5}.{ext}",
+            'preview_url': f"//hypnohub.net//data/preview/{md5}.jpg",
+            'sample_url':  f"//hypnohub.net//data/sample/{md5}.{ext}",
+            'status':      'active',
+            'change':      id_,
+        }
+
+        id_ += 1
+
+
+def generate_votes(dataset: post_data.Dataset, ngood, nbad, seed=None,
+                   nliked_tags=200, noise=1.0):
+    """
+    Fill in dataset.good and dataset.bad with votes from a made-up user. The
+    user has a hidden opinion (+1 or -1) on nliked_tags random tags. We pick
+    ngood + nbad random posts, and the ones the user would like most (plus
+    some gaussian noise) become the good ones.
+    """
+    rng = random.Random(seed)
+    table = dataset.cache
+
+    opinions = {tag_id: rng.choice([-1, 1])
+                for tag_id in rng.sample(range(len(table.tag_names)),
+                                         min(nliked_tags,
+                                             len(table.tag_names)))}
+
+    def utility(row):
+        return (sum(opinions.get(tag_id, 0)
+                    for tag_id in table.row_feature_ids(row))
+                + rng.gauss(0, noise))
+
+    rows = rng.sample(range(len(table)), min(ngood + nbad, len(table)))
+    rows.sort(key=utility, reverse=True)
+
+    dataset.good = IdSet(table.ids[row] for row in rows[:ngood])
+    dataset.bad  = IdSet(table.ids[row] for row in rows[ngood:])
+
+
+def generate_dataset(nposts, ngood=500, nbad=1000, seed=None,
+                     **kwargs) -> post_data.Dataset:
+    """
+    A whole in-memory Dataset, with a cache of nposts posts and votes on some
+    of them. Extra kwargs go to generate_posts. Nothing is read from or
+    written to disk unless you call .save() on it.
+    """
+    dataset = post_data.Dataset(load=False)
+
+    for post in generate_posts(nposts, seed=seed, **kwargs):
+        dataset.add_post(post)
+
+    generate_votes(dataset, ngood, nbad, seed)
+
+    return dataset
@@ -0,0 +1,386 @@
+import heapq
+from array import array
+from typing import Dict, Iterable, List, Tuple
+
+import post_data
+
+"""
+An inverted index over the tags in a PostTable, for answering Hypnohub-style
+tag searches without looking at every cached post.
+"""
+
+
+class PostingList(object):
+    """
+    A sorted list of post id's, stored compressed. Each id is stored as the
+    difference from the one before it, written as a varint (7 bits per byte,
+    high bit set on every byte but the last). Since post id's are dense, most
+    entries only take a single byte.
+
+    Appending an id that's higher than every other id is cheap, which is the
+    usual case because update_cache fetches posts in order:id. Any other
+    change is kept to one side, in self.added or self.removed, and only
+    merged into the encoded data by compact() once there are enough of them
+    to be worth re-encoding the list for. So replacing a post (like
+    Dataset.refresh_cache does) doesn't mean re-encoding the whole list of
+    every common tag it has.
+    """
+
+    # compact() once there are more changes waiting than this fraction of
+    # the ids in self.data.
+    MAX_PENDING = 0.25
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.data = bytearray()
+        self.last = 0
+
+        # How many ids are in self.data, including any in self.removed.
+        self.count = 0
+
+        # Ids that aren't in self.data yet, and ids in self.data that don't
+        # count any more. See compact.
+        self.added = set()
+        self.removed = set()
+
+        for id_ in ids:
+            self.append(id_)
+
+    @classmethod
+    def from_data(cls, data: bytes, count, last):
+        """ A list that's already encoded, like one saved by cache_file.py.
+        """
+        postings = cls()
+        postings.data = bytearray(data)
+        postings.count = count
+        postings.last = last
+        return postings
+
+    def __len__(self):
+        return self.count + len(self.added) - len(self.removed)
+
+    def _decode(self):
+        """ Every id in self.data, in order. """
+        id_ = shift = 0
+        delta = 0
+
+        for byte in self.data:
+            delta |= (byte & 0x7f) << shift
+
+            if byte & 0x80:
+                shift += 7
+            else:
+                id_ += delta
+                yield id_
+                delta = shift = 0
+
+    def __iter__(self):
+        ids = self._decode()
+
+        if self.removed:
+            ids = (id_ for id_ in ids if id_ not in self.removed)
+
+        if self.added:
+            ids = heapq.merge(ids, sorted(self.added))
+
+        return iter(ids)
+
+    def __contains__(self, id_):
+        return id_ in set(self)
+
+    def append(self, id_):
+        """ id_ must be higher than every id already in the list. """
+        if self.count > 0 and id_ <= self.last:
+            raise ValueError(f"{id_} isn't higher than {self.last}")
+
+        delta = id_ - self.last
+
+        while delta > 0x7f:
+            self.data.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+
+        self.data.append(delta)
+        self.last = id_
+        self.count += 1
+
+    def add(self, id_):
+        """ id_ mustn't be in the list already. """
+        if id_ in self.removed:
+            self.removed.remove(id_)
+        elif self.count == 0 or id_ > self.last:
+            self.append(id_)
+        else:
+            self.added.add(id_)
+            self._maybe_compact()
+
+    def remove(self, id_):
+        """ id_ has to be in the list, unless it's higher than every id in
+        it, in which case this does nothing.
+        """
+        if id_ in self.added:
+            self.added.remove(id_)
+        elif self.count > 0 and id_ <= self.last:
+            self.removed.add(id_)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if len(self.added) + len(self.removed) > self.count * self.MAX_PENDING:
+            self.compact()
+
+    def compact(self):
+        """ Merge self.added and self.removed into the encoded data. """
+        if self.added or self.removed:
+            self.__init__(list(self))
+
+
+class TagIndex(object):
+    """
+    Maps every tag id in a PostTable to a PostingList of the posts that have
+    that tag. Ratings get their own posting lists, so that rating: searches
+    are just as fast.
+
+    Keep it in step with the table by calling add() after a post is added and
+    discard() before it's removed. Dataset does this for you.
+
+    Queries work like searches on Hypnohub itself:
+
+    foo bar          Posts with both foo and bar.
+    ~foo ~bar        Posts with foo or bar (or both).
+    -foo             Posts without foo.
+    rating:s         Safe posts. Also rating:q and rating:e.
+    -rating:e        Anything that isn't explicit.
+
+    All of these can be mixed together, like "foo ~bar ~baz -qux rating:s".
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.postings = []
+        self.rating_postings = [PostingList() for _ in table.RATINGS]
+        self._reset_features()
+
+        for row in range(len(table)):
+            self.add(table.ids[row])
+
+    @classmethod
+    def from_postings(cls, table, postings: List[PostingList],
+                      rating_postings: List[PostingList]):
+        """ An index that's already been built, like one loaded by
+        cache_file.py. It isn't checked against the table.
+        """
+        index = cls.__new__(cls)
+        index.table = table
+        index.postings = postings
+        index.rating_postings = rating_postings
+        index._reset_features()
+        return index
+
+    def _reset_features(self):
+        # {kind: [tag_id, ...]} for the post_data.COMMON_FEATURES, and how
+        # many tag names that's been worked out for. See _common_features.
+        self._features = {kind: [] for kind in post_data.COMMON_FEATURES}
+        self._features_known = 0
+
+    def _tag_postings(self, tag_id) -> PostingList:
+        while len(self.postings) <= tag_id:
+            self.postings.append(PostingList())
+
+        return self.postings[tag_id]
+
+    def add(self, id_):
+        """ Index a post that's just been added to the table. """
+        row = self.table.row(id_)
+
+        for tag_id in self.table.row_feature_ids(row):
+            self._tag_postings(tag_id).add(id_)
+
+        if self.table.ratings[row] >= 0:
+            self.rating_postings[self.table.ratings[row]].add(id_)
+
+    def discard(self, id_):
+        """ Un-index a post that's about to be removed from the table. Does
+        nothing if the post isn't there.
+        """
+        try:
+            row = self.table.row(id_)
+        except KeyError:
+            return
+
+        for tag_id in self.table.row_feature_ids(row):
+            self._tag_postings(tag_id).remove(id_)
+
+        if self.table.ratings[row] >= 0:
+            self.rating_postings[self.table.ratings[row]].remove(id_)
+
+    def _common_features(self) -> Dict[str, List[int]]:
+        """ The tag ids of every post_data.COMMON_FEATURES, by kind. Tag ids
+        never change, so only names that are new since last time are looked
+        at.
+        """
+        names = self.table.tag_names
+
+        for tag_id in range(self._features_known, len(names)):
+            if post_data.is_extra_feature(names[tag_id]):
+                kind = names[tag_id].split(':', 1)[0]
+
+                if kind in self._features:
+                    self._features[kind].append(tag_id)
+
+        self._features_known = len(names)
+        return self._features
+
+    def tag_count(self, tag):
+        """ How many posts have this tag? """
+        try:
+            return len(self.postings[self.table.tag_index[tag]])
+        except (KeyError, IndexError):
+            return 0
+
+    def _term_postings(self, term) -> PostingList:
+        if term.startswith('rating:'):
+            rating = term[len('rating:'):][:1]
+
+            if rating == '' or rating not in self.table.RATINGS:
+                raise ValueError(f"Unknown rating: {term!r}")
+
+            return self.rating_postings[self.table.RATINGS.index(rating)]
+
+        try:
+            return self.postings[self.table.tag_index[term]]
+        except (KeyError, IndexError):
+            return PostingList()
+
+    def query(self, query: str) -> List[int]:
+        """ Returns a sorted list of matching post id's. """
+        required, optional, excluded = [], [], []
+
+        for term in query.split():
+            if term.startswith('-'):
+                excluded.append(self._term_postings(term[1:]))
+            elif term.startswith('~'):
+                optional.append(self._term_postings(term[1:]))
+            else:
+                required.append(self._term_postings(term))
+
+        # Start from the smallest posting list, so the set stays small.
+        required.sort(key=len)
+
+        if len(required) > 0:
+            matches = set(required[0])
+
+            for postings in required[1:]:
+                matches.intersection_update(postings)
+        elif len(optional) > 0:
+            matches = None
+        else:
+            matches = set(self.table.ids)
+
+        if len(optional) > 0:
+            any_of = set()
+
+            for postings in optional:
+                any_of.update(postings)
+
+            matches = any_of if matches is None else matches & any_of
+
+        for postings in excluded:
+            matches.difference_update(postings)
+
+        return sorted(matches)
+
+    def query_rows(self, query: str) -> array:
+        """ Like query, but gives row numbers in the table instead of id's. """
+        return array('l', map(self.table.row, self.query(query)))
+
+    def top_k(self, weights: array, base: float, k: int,
+              candidates=None, exclude=()) -> List[Tuple[float, int]]:
+        """
+        Find the k best posts for a linear score without scoring every post.
+        A post's score is:
+
+        base + sum(weights[tag_id] for tag_id in the post's tags)
+
+        weights is indexed by tag id and can hold -inf. This works like the
+        MaxScore algorithm from search engines. A post can't score higher
+        than base plus the weights of its positive tags, so we add those
+        bounds up by walking only the posting lists of positive tags. Then we
+        score posts exactly in order of their bound, and stop as soon as the
+        next bound can't beat the k'th best score found so far. Posts without
+        any positive tags are bounded by base itself, so they're only looked
+        at if there aren't k better posts.
+
+        Ratings and scores (post_data.COMMON_FEATURES) are left out of that
+        walk, because a positive weight for one of them would make a big part
+        of the cache candidates. Since every post has exactly one of each,
+        they can't add more than the best weight of each kind, which goes
+        into the bounds' base instead.
+
+        candidates, if given, is a set of post id's to restrict the search to
+        (like the result of a query). Posts in exclude are skipped.
+
+        Returns (score, post_id) in ASCENDING order of score, like
+        PostGetter's lists. Ties are broken arbitrarily.
+        """
+        table = self.table
+
+        def score(id_):
+            total = base
+
+            for tag_id in table.row_feature_ids(table.row(id_)):
+                total += weights[tag_id]
+
+            return total
+
+        def allowed(id_):
+            return ((candidates is None or id_ in candidates)
+                    and id_ not in exclude)
+
+        npostings = min(len(weights), len(self.postings))
+        bound_base = base
+        feature_ids = set()
+
+        for ids in self._common_features().values():
+            ids = [tag_id for tag_id in ids
+                   if tag_id < npostings and len(self.postings[tag_id]) > 0]
+            feature_ids.update(ids)
+            bound_base += max((weights[tag_id] for tag_id in ids), default=0)
+
+        # {post_id: upper_bound, ...}
+        bounds = {}
+        for tag_id in range(npostings):
+            weight = weights[tag_id]
+
+            if weight <= 0 or tag_id in feature_ids:
+                continue
+
+            for id_ in self.postings[tag_id]:
+                bounds[id_] = bounds.get(id_, bound_base) + weight
+
+        # Min-heap of the best (score, post_id) found so far.
+        best = []
+
+        for id_, bound in sorted(bounds.items(), key=lambda i: i[1],
+                                 reverse=True):
+            if len(best) == k and bound <= best[0][0]:
+                break
+
+            if not allowed(id_):
+                continue
+
+            if len(best) < k:
+                heapq.heappush(best, (score(id_), id_))
+            else:
+                heapq.heappushpop(best, (score(id_), id_))
+
+        if len(best) < k or bound_base > best[0][0]:
+            ids = table.ids if candidates is None else candidates
+
+            for id_ in ids:
+                if id_ in bounds or not allowed(id_):
+                    continue
+
+                if len(best) < k:
+                    heapq.heappush(best, (score(id_), id_))
+                else:
+                    heapq.heappushpop(best, (score(id_), id_))
+
+        return sorted(best)
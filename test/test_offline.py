@@ -1,9 +1,34 @@
+import os
+import gzip
+import zlib
+import threading
+import http.client
 import pytest
 import random
+import math
+from array import array
 
 import post_data
 import naive_bayes
+import classifiers
+import tag_index
+import evaluation
+import post_getters
+import synthetic
+import hhapi
+import fake_hypnohub
+import metrics
+import profiling
+import stats
+import model_cache
+import portable
+import cache_file
+import parallel
+from id_set import IdSet
 import ahto_lib
+import http_server
+import http_server.sessions as sessions
+import http_server.compression as compression
 
 """
 Tests that don't require us to pester Hypnohub with requests. Ideally almost
@@ -69,6 +94,133 @@ class TestNaiveBayes:
             nbc = naive_bayes.NaiveBayesClassifier(good, bad)
             assert nbc.predict(['a']) == pytest.approx(expected)
 
+    def test_nbc_predict_table(self):
+        table = post_data.PostTable()
+        for id_, tags in enumerate(['a b', 'a', 'b c', 'd']):
+            table.add(dict(DUMMY_JSON, id=id_, tags=tags))
+
+        nbc = naive_bayes.NaiveBayesClassifier([['a', 'b'], ['a']], [['c']])
+
+        for post, prediction in zip(table, nbc.predict_table(table)):
+            assert prediction == pytest.approx(nbc.predict(post.tags))
+
+        assert (nbc.predict_table(table, workers=2)
+                == nbc.predict_table(table))
+
+    def test_nbc_explain(self):
+        nbc = naive_bayes.NaiveBayesClassifier(
+            [['a', 'b'], ['a', 'c']], [['b'], ['c', 'd']])
+        post = ['a', 'b', 'z']
+
+        explanation = nbc.explain(post)
+        assert [tag for tag, _ in explanation][0] == 'a'
+        assert (math.exp(nbc.log_p_g + sum(w for _, w in explanation))
+                == pytest.approx(nbc.predict(post)))
+
+        # Cached weights have to notice new training data.
+        old_weight = nbc.log_tag_weight('b')
+        weights = nbc.log_tag_weights(['a', 'b'])
+        nbc.add_post(['b'], True)
+        assert nbc.log_tag_weight('b') > old_weight
+        assert nbc.log_tag_weights(['a', 'b'])[1] > weights[1]
+
+    def test_nbc_parallel(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(parallel, 'MIN_PARALLEL_ROWS', 0)
+        dataset = post_data.Dataset()
+        rand = random.Random(0)
+
+        for id_ in range(1, 201):
+            tags = ' '.join(rand.sample('abcdefghij', 4))
+            dataset.add_post(dict(DUMMY_JSON, id=id_, tags=tags))
+
+        dataset.good = set(range(1, 201, 3))
+        dataset.bad = set(range(2, 201, 3))
+
+        serial = naive_bayes.NaiveBayesClassifier.from_dataset(dataset)
+        nbc = naive_bayes.NaiveBayesClassifier.from_dataset(dataset,
+                                                            workers=2)
+        assert nbc.tag_history == serial.tag_history
+        assert (nbc.ngood, nbc.total) == (serial.ngood, serial.total)
+
+        assert list(serial.predict_table(dataset.cache, workers=2)) \
+            == pytest.approx(list(serial.predict_table(dataset.cache)))
+
+        # The pool and the table's columns are kept for the next call.
+        executor, columns = parallel._executors[2], parallel._columns[2]
+        serial.predict_table(dataset.cache, workers=2)
+        assert parallel._executors[2] is executor
+        assert parallel._columns[2] is columns
+
+        dataset.add_post(dict(DUMMY_JSON, id=201, tags='a b'))
+        assert len(serial.predict_table(dataset.cache, workers=2)) == 201
+        assert parallel._columns[2] is not columns
+
+
+class TestLogisticClassifier:
+    def test_logistic(self):
+        table = post_data.PostTable()
+        for id_, tags in enumerate(['a b', 'a', 'b c', 'c d', 'd']):
+            table.add(dict(DUMMY_JSON, id=id_, tags=tags))
+
+        lr = classifiers.LogisticClassifier.fit(
+            [['a', 'b'], ['a']] * 10, [['c', 'd'], ['d']] * 10)
+        assert lr.predict(['a']) > 0.8 > 0.2 > lr.predict(['d'])
+
+        for post, prediction in zip(table, lr.predict_many(table)):
+            assert prediction == pytest.approx(lr.predict(post.tags))
+
+        explanation = lr.explain(['a', 'd', 'z'])
+        assert [tag for tag, _ in explanation] == ['a', 'z', 'd']
+        assert (lr.from_linear(lr.bias + sum(w for _, w in explanation))
+                == pytest.approx(lr.predict(['a', 'd', 'z'])))
+
+        old = lr.predict(['z'])
+        lr.partial_fit(['z'], True)
+        assert lr.predict(['z']) > old and lr.tag_history['z'] == [1, 1]
+
+    def test_refit(self, tmp_path, monkeypatch):
+        """ Taking a vote back out has to give the same model as never having
+        it, which takes training from scratch.
+        """
+        monkeypatch.chdir(tmp_path)
+        dataset = synthetic.generate_dataset(200, ngood=10, nbad=10, seed=4)
+        lr = classifiers.LogisticClassifier.from_dataset(dataset, epochs=5)
+        post = next(post for post in dataset.get_all()
+                    if post.id not in dataset.good | dataset.bad)
+        before = lr.predict(post.features)
+
+        dataset.good.add(post.id)
+        lr.add_post(post.features, True)
+        assert lr.predict(post.features) > before
+
+        with pytest.raises(NotImplementedError):
+            lr.remove_post(post.features, True)
+
+        dataset.good.remove(post.id)
+        version = lr.version
+        lr.refit(dataset)
+        assert lr.predict(post.features) == before
+        assert lr.version > version and lr.epochs == 5
+
+        # Sessions do the same when a vote is moved.
+        session = sessions.Session(dataset, classifier='logistic')
+        session.record_vote(post.id, True)
+        session.record_vote(post.id, False)
+        fresh = classifiers.LogisticClassifier.from_dataset(dataset)
+        assert (session.nbc.predict(post.features)
+                == fresh.predict(post.features))
+
+    def test_post_getter(self):
+        """ top_k has to find the same best posts as scoring everything. """
+        dataset = synthetic.generate_dataset(500, ngood=30, nbad=30, seed=8,
+                                             ntags=100)
+        lr = classifiers.LogisticClassifier.from_dataset(dataset)
+        getter = post_getters.PostGetter(dataset, lr)
+
+        expected = [id_ for _, id_ in getter._get_best_posts()[-5:]][::-1]
+        assert [getter.get_best()[1].id for _ in range(5)] == expected
+
 
 DUMMY_JSON = {
     'id': 1337,
@@ -109,10 +261,943 @@ class TestPostStorage:
             assert sp.id == DUMMY_JSON['id']
 
     def test_dataset(self, dataset):
-        for k, v in dataset.cache.items():
-            assert type(k) is int
-            assert type(v) is dict
+        for post in dataset.cache:
+            assert type(post.id) is int
+            assert dataset.get_id(post.id) == post
+
+    def test_post_table(self):
+        table = post_data.PostTable()
+
+        for id_ in [5, 1, 3]:
+            table.add(dict(DUMMY_JSON, id=id_, tags=f'foo tag_{id_}'))
+
+        assert list(table.ids) == [1, 3, 5]
+        assert table.highest_id == 5
+
+        view = table.get(3)
+        sp = post_data.SimplePost(dict(DUMMY_JSON, id=3, tags='foo tag_3'))
+        assert view == sp
+        assert view.tags == sp.tags
+        assert view.score == sp.score
+        assert view.sample_url == sp.sample_url
+
+        table.remove(3)
+        assert 3 not in table
+        assert table.get(5).tags == {'foo', 'tag_5'}
+
+        table.add({'id': 5})
+        assert list(table.ids) == [1]
+        assert table.get(1).tags == {'foo', 'tag_1'}
+
+    def test_urls(self):
+        table = post_data.PostTable()
+        posts = list(synthetic.generate_posts(20, seed=2, deleted_ratio=0))
+        posts[3]['sample_url'] = 'https://elsewhere.example/sample.jpg'
+
+        for post in posts:
+            table.add(post)
+
+        assert list(table.odd_urls) == [posts[3]['id']]
+        assert len(table.url_exts) == 3 * len(posts)
+
+        for post in posts:
+            view = table.get(post['id'])
+            assert (view.file_url, view.preview_url, view.sample_url) == (
+                post['file_url'], post['preview_url'], post['sample_url'])
+
+        # Tables pickled with the URLs as lists of strings.
+        state = table.__dict__.copy()
+        del state['url_exts'], state['odd_urls']
+        state['file_urls'] = [post['file_url'] for post in posts]
+        state['preview_urls'] = [post['preview_url'] for post in posts]
+        state['sample_urls'] = [post['sample_url'] for post in posts]
+        old = post_data.PostTable.__new__(post_data.PostTable)
+        old.__setstate__(state)
+        assert old.url_exts == table.url_exts
+        assert old.odd_urls == table.odd_urls
+
+    def test_features(self):
+        table = post_data.PostTable()
+        table.add(dict(DUMMY_JSON, tags='foo bar'))
+        view = table.get(DUMMY_JSON['id'])
+        sp = post_data.SimplePost(dict(DUMMY_JSON, tags='foo bar'))
+
+        assert view.tags == {'foo', 'bar'}
+        assert view.features == sp.features == {
+            'foo', 'bar', 'rating: s', 'author: foo', 'score: 1024-2047'}
+        assert post_data.extra_features('q', 'x', 0)[2] == 'score: <1'
+        assert post_data.SimplePost(view.to_json()) == view
+
+
+class TestIdSet:
+    def test_id_set(self):
+        a = IdSet([1, 5, 100, 7])
+        b = IdSet({5, 6})
+
+        assert list(a) == [1, 5, 7, 100]
+        assert 100 in a and 8 not in a and 10**9 not in a and -1 not in a
+        assert a | b == {1, 5, 6, 7, 100} and len(a | b) == 5
+        assert a & b == {5}
+        assert a - b == {1, 7, 100}
+        assert a ^ b == {1, 6, 7, 100}
+        assert {5, 6} | a == a | {5, 6}
+
+        a |= {9}
+        a -= b
+        a.discard(1)
+        a.discard(1)
+        assert a == IdSet([7, 9, 100]) and len(a) == 3
+
+        with pytest.raises(KeyError):
+            a.remove(1)
+
+    def test_dataset_votes(self, tmp_path, monkeypatch):
+        """ Old dataset files with plain sets still load. """
+        monkeypatch.chdir(tmp_path)
+        dataset = post_data.Dataset(load=False)
+        dataset.good, dataset.bad = {1, 2}, {3}
+        dataset.save_votes()
+
+        dataset = post_data.Dataset()
+        assert isinstance(dataset.good, IdSet)
+        assert dataset.good == {1, 2} and dataset.bad == {3}
+
+
+class TestTagIndex:
+    @pytest.fixture
+    def table(self):
+        table = post_data.PostTable()
+
+        for id_, tags, rating in [(1, 'a b', 's'), (2, 'a', 'e'),
+                                  (300, 'b c', 's'), (4000, 'c', 'q')]:
+            table.add(dict(DUMMY_JSON, id=id_, tags=tags, rating=rating))
+
+        return table
+
+    def test_posting_list(self):
+        ids = [1, 2, 127, 128, 300, 70000, 70001]
+        postings = tag_index.PostingList(ids)
+        assert list(postings) == ids
+        assert len(postings) == len(ids)
+
+        postings.add(5)
+        postings.remove(128)
+        assert list(postings) == [1, 2, 5, 127, 300, 70000, 70001]
+        assert len(postings) == len(ids)
+
+        # Changes in the middle wait to be merged in, until there are enough
+        # of them.
+        postings = tag_index.PostingList(range(0, 400, 2))
+        data = bytes(postings.data)
+        postings.remove(100)
+        postings.add(100)
+        postings.remove(50)
+        postings.add(51)
+        assert bytes(postings.data) == data
+        assert list(postings) == sorted(set(range(0, 400, 2)) - {50} | {51})
+
+        for id_ in range(1, 200, 2):
+            postings.add(id_)
+
+        assert len(postings.data) > len(data)
+        assert len(postings.added) <= postings.count * postings.MAX_PENDING
+        assert list(postings) == sorted(set(range(200)) - {50}
+                                        | set(range(200, 400, 2)))
+
+    @pytest.mark.parametrize("query,expected", [
+        ('a', [1, 2]),
+        ('a b', [1]),
+        ('~a ~c', [1, 2, 300, 4000]),
+        ('b -a', [300]),
+        ('-c', [1, 2]),
+        ('rating:s', [1, 300]),
+        ('c -rating:q', [300]),
+        ('nonexistent', []),
+    ])
+    def test_query(self, table, query, expected):
+        index = tag_index.TagIndex(table)
+        assert index.query(query) == expected
+
+    def test_incremental(self, table):
+        index = tag_index.TagIndex(table)
+
+        index.discard(2)
+        table.remove(2)
+        table.add(dict(DUMMY_JSON, id=5000, tags='a c', rating='s'))
+        index.add(5000)
+
+        assert index.query('a') == [1, 5000]
+        assert index.query('c rating:s') == [300, 5000]
+
+    def test_top_k(self, table):
+        index = tag_index.TagIndex(table)
+        # Extra features count towards the score like anything else.
+        by_name = {'a': 0.5, 'b': -1.0, 'c': 2.0, 'rating: s': 0.7,
+                   'score: 1024-2047': -0.4}
+        weights = array('d', [by_name.get(name, -0.2)
+                              for name in table.tag_names])
+
+        def brute_force(candidates, exclude):
+            scores = []
+            for post in table:
+                if post.id in exclude:
+                    continue
+                if candidates is not None and post.id not in candidates:
+                    continue
+                tag_ids = table.row_feature_ids(table.row(post.id))
+                scores.append(
+                    (0.1 + sum(weights[i] for i in tag_ids), post.id))
+            return sorted(scores)
+
+        for k in range(1, 6):
+            for candidates in [None, {1, 2, 300}]:
+                for exclude in [(), {4000}]:
+                    top = index.top_k(weights, 0.1, k, candidates, exclude)
+                    expected = brute_force(candidates, exclude)[-k:]
+                    assert ([s for s, _ in top]
+                            == pytest.approx([s for s, _ in expected]))
+
+
+class TestDuplicates:
+    def test_duplicates(self):
+        posts = [post for post in synthetic.generate_posts(500, seed=5)
+                 if 'md5' in post and len(post['tags'].split()) >= 10]
+        original, other = posts[0], posts[1]
+        tags = original['tags'].split()
+
+        dataset = post_data.Dataset(load=False)
+        for post in posts:
+            dataset.add_post(post)
+
+        index = dataset.duplicate_index
+        assert index.duplicates(original['id']) == set()
+
+        # A reupload with the same picture, and a variant with one tag
+        # swapped out, both added after the index was built.
+        reupload = dict(other, id=10001)
+        variant = dict(original, id=10002, md5='f' * 32,
+                       tags=' '.join(tags[:-1] + ['a_new_tag']))
+        dataset.add_post(reupload)
+        dataset.add_post(variant)
+
+        assert index.duplicates(original['id']) == {10002}
+        assert index.duplicates(other['id']) == {10001}
+        assert dataset.duplicate_index.duplicates(10001) == {other['id']}
+
+        dataset.add_post({'id': 10002, 'status': 'deleted'})
+        assert index.duplicates(original['id']) == set()
+
+        # With collapse_duplicates, /best never shows both of a pair.
+        dataset.add_post(variant)
+        dataset.good = IdSet([original['id'], 10002])
+        getter = post_getters.PostGetter(dataset, collapse_duplicates=True)
+        shown = {getter.get_best()[1].id for _ in range(len(posts) - 2)}
+        assert not {other['id'], 10001} <= shown
+
+
+class TestPostGetter:
+    def test_diverse_batch(self):
+        [post] = synthetic.generate_posts(1, seed=0, deleted_ratio=0)
+        dataset = post_data.Dataset(load=False)
+        for id_, tags in [(1, 'a b c d'), (2, 'a b c d'), (3, 'w x y z'),
+                          (4, 'a b c x')]:
+            dataset.add_post(dict(post, id=id_, tags=tags))
+
+        candidates = [(0.9, 1), (0.85, 2), (0.6, 3), (0.8, 4)]
+        assert ([id_ for _, id_ in post_getters.diverse_batch(
+                    candidates, dataset.cache, 4, diversity=0)]
+                == [1, 2, 4, 3])
+        assert ([id_ for _, id_ in post_getters.diverse_batch(
+                    candidates, dataset.cache, 2, diversity=0.5)]
+                == [1, 3])
+
+    def test_query_cache(self):
+        cache = post_getters.QueryCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        assert cache['a'] == 1
+        cache['c'] = 3
+        assert list(cache) == ['a', 'c']
+
+        dataset = synthetic.generate_dataset(200, ngood=10, nbad=10, seed=5)
+        getter = post_getters.PostGetter(dataset)
+        for i in range(getter.MAX_CACHED_QUERIES + 10):
+            getter.get_best('-id:%d' % i)
+        assert len(getter._top_posts) == getter.MAX_CACHED_QUERIES
+
+    def test_votes_rerank(self):
+        dataset = synthetic.generate_dataset(300, ngood=10, nbad=10, seed=9)
+        getter = post_getters.PostGetter(dataset)
+        getter.get_best()
+
+        # Vote down the post that was going to come next.
+        _, id_ = getter._get_top_posts()[-1]
+        dataset.bad.add(id_)
+        getter.nbc.add_post(dataset.get_id(id_).features, False)
+
+        fresh = post_getters.PostGetter(dataset, getter.nbc)
+        fresh.seen |= getter.seen
+        prediction, post = getter.get_best()
+        assert post.id != id_
+        assert post.id == fresh.get_best()[1].id
+        assert prediction == pytest.approx(getter.nbc.predict(post.features))
+
+    def test_get_hot(self):
+        dataset = synthetic.generate_dataset(1000, ngood=50, nbad=50, seed=6)
+        getter = post_getters.PostGetter(dataset)
+        positive = {id_ for prediction, id_ in getter._get_best_posts()
+                    if prediction > 0}
+        shown = []
+
+        # Every positively rated post comes up once before it runs out.
+        with pytest.raises(IndexError):
+            while True:
+                shown.append(getter.get_hot()[1].id)
+
+        assert len(set(shown)) == len(shown)
+        assert set(shown) == positive
+        assert not set(shown) & (dataset.good | dataset.bad)
+
+    def test_get_mysterious(self):
+        dataset = synthetic.generate_dataset(500, ngood=20, nbad=20, seed=7,
+                                             ntags=200)
+        getter = post_getters.PostGetter(dataset)
+        nbc = getter.nbc
+
+        def most_mysterious():
+            return max(nbc.mysteriousness(post.features)
+                       for post in dataset.get_all()
+                       if post.id not in getter.seen
+                       and post.id not in dataset.good | dataset.bad)
+
+        for _ in range(10):
+            expected = most_mysterious()
+            _, post = getter.get_mysterious()
+            assert (nbc.mysteriousness(post.features)
+                    == pytest.approx(expected))
+
+            # Vote on it, which makes a bunch of other posts less
+            # mysterious too.
+            dataset.good.add(post.id)
+            nbc.add_post(post.tags, True)
+
+
+class TestEvaluation:
+    def test_k_fold(self):
+        ids = list(range(23))
+        folds = evaluation.k_fold(ids, 5, seed=0)
+        assert len(folds) == 5
+
+        for train, test in folds:
+            assert sorted(train + test) == ids
+
+        assert sorted(i for _, test in folds for i in test) == ids
+
+    def test_metrics(self):
+        scores = [0.9, 0.8, 0.7, 0.6, 0.2]
+        labels = [True, False, True, False, False]
+
+        assert evaluation.precision_at_k(scores, labels, 2) == 0.5
+        assert evaluation.roc_auc(scores, labels) == pytest.approx(5/6)
+        assert evaluation.roc_auc([1, 1], [True, False]) == 0.5
+        assert evaluation.log_loss([1.0, 0.0], [True, False]) < 1e-10
+
+    def test_evaluate(self):
+        dataset = post_data.Dataset(load=False)
+
+        for id_ in range(1, 41):
+            tags = 'good_tag' if id_ % 2 else 'bad_tag'
+            dataset.add_post(dict(DUMMY_JSON, id=id_, tags=tags + ' foo'))
+
+        dataset.good = set(range(1, 41, 2))
+        dataset.bad = set(range(2, 41, 2))
+
+        results = evaluation.evaluate(dataset, folds=4, k=1, seed=0)
+        assert len(results['folds']) == 4
+        assert results['mean']['roc_auc'] == 1.0
+        assert results['mean']['precision_at_k'] == 1.0
+
+
+class TestSynthetic:
+    def test_generate_dataset(self):
+        dataset = synthetic.generate_dataset(300, ngood=20, nbad=30, seed=1,
+                                             ntags=500)
+        assert len(dataset.cache) == 300
+        assert len(dataset.good) == 20
+        assert len(dataset.bad) == 30
+        assert not dataset.good & dataset.bad
+        assert list(dataset.cache.ids) == sorted(dataset.cache.ids)
+
+        again = synthetic.generate_dataset(300, ngood=20, nbad=30, seed=1,
+                                           ntags=500)
+        assert again.good == dataset.good
+        assert again.get_id(dataset.cache.ids[7]) == dataset.cache.view(7)
+
+
+class TestFakeHypnohub:
+    @pytest.fixture
+    def posts(self):
+        return list(synthetic.generate_posts(250, ntags=50, seed=2))
+
+    @pytest.fixture
+    def fake_api(self, posts, monkeypatch):
+        votes = {(3, 'someone'): {post['id'] for post in posts[::7]}}
+
+        with fake_hypnohub.FakeHypnohub(posts, votes, fail_every=4) as fake:
+            monkeypatch.setattr(hhapi, 'BASE_URL', fake.url)
+            monkeypatch.setattr(hhapi, 'DELAY_BETWEEN_REQUESTS', 0)
+            yield fake
+
+    def test_search(self, posts):
+        fake = fake_hypnohub.FakeHypnohub(posts)
+        ids = [post['id'] for post in posts]
+
+        assert [p['id'] for p in fake.search('', 5)] == ids[::-1][:5]
+        assert ([p['id'] for p in fake.search(f'order:id id:>{ids[9]}', 3)]
+                == ids[10:13])
+        assert ([p['id'] for p in fake.search('order:id', 3, page=2)]
+                == ids[3:6])
+        assert all('tag_0' in p['tags'].split(' ')
+                   for p in fake.search('tag_0', 100))
+
+    def test_update_cache_retries(self, posts, fake_api):
+        dataset = post_data.Dataset(load=False)
+        dataset.update_cache(print_progress=False)
+
+        assert list(dataset.cache.ids) == [post['id'] for post in posts]
+        assert fake_api.error_count > 0
+
+        # Keeping track of changes is left to the first refresh_cache.
+        assert dataset.cache.last_change is None
+
+    def test_refresh_cache(self, posts, fake_api, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        dataset = post_data.Dataset(load=False)
+        assert dataset.refresh_cache(print_progress=False) == {}
+        dataset.update_cache(print_progress=False)
+
+        ids = [post['id'] for post in posts]
+        dataset.good = IdSet(ids[:2])
+        dataset.bad = IdSet(ids[2:4])
+        session = sessions.Session(dataset)
+        session.post_getter.all_scores()
+
+        fake_api.edit(ids[0], tags='new_tag tag_1')
+        fake_api.edit(ids[5], score='99')
+        fake_api.edit(ids[3], deleted=True)
+        fake_api.edit(ids[6], score=posts[6]['score'])
+        changes = dataset.refresh_cache(print_progress=False)
+
+        assert set(changes) == {ids[0], ids[3], ids[5]}
+        assert changes[ids[0]] == post_data.SimplePost(posts[0]).features
+        assert dataset.get_id(ids[0]).tags == {'new_tag', 'tag_1'}
+        assert dataset.get_id(ids[5]).score == 99
+        assert dataset.get_id(ids[3]).deleted
+        assert dataset.tag_index.query('new_tag') == [ids[0]]
+        assert dataset.refresh_cache(print_progress=False) == {}
+
+        # Votes on changed posts were patched, so everything gets rescored.
+        session.refresh(changes)
+        assert session.nbc.tag_history == naive_bayes.NaiveBayesClassifier \
+            .from_dataset(dataset).tag_history
+        assert session.post_getter._get_scores() is None
+
+        # Otherwise only the changed posts are.
+        session.post_getter.all_scores()
+        fake_api.edit(ids[9], tags='tag_2 tag_3')
+        fake_api.edit(ids[11], deleted=True)
+        session.refresh(dataset.refresh_cache(print_progress=False))
+        scores = session.post_getter._get_scores()
+        assert scores is not None
+        assert list(scores) == pytest.approx(list(
+            session.nbc.predict_many(dataset.cache)))
+
+        fake_api.edit(ids[12], tags='tag_4')
+        session.refresh(dataset.refresh_cache(print_progress=False))
+        assert list(session.post_getter._get_scores()) == pytest.approx(
+            list(session.nbc.predict_many(dataset.cache)))
+
+        # Hot batches from before a refresh don't serve deleted posts.
+        hot = [id_ for _, id_ in session.post_getter._get_hot_batch()]
+        for id_ in hot[1:]:
+            fake_api.edit(id_, deleted=True)
+        session.refresh(dataset.refresh_cache(print_progress=False))
+        assert session.post_getter.get_hot()[1].id not in hot[1:]
+
+    def test_refresh_endpoint(self, posts, fake_api, tmp_path,
+                              monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        handler = http_server.RecommendationRequestHandler(('127.0.0.1', 0))
+        handler.dataset.update_cache(print_progress=False)
+        thread = threading.Thread(target=handler.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        conn = http.client.HTTPConnection(*handler.server.server_address)
+
+        def request(method):
+            conn.request(method, '/refresh')
+            response = conn.getresponse()
+            response.read()
+            return response
+
+        try:
+            assert request('GET').status == 200
+
+            # The first refresh only starts keeping track of changes.
+            response = request('POST')
+            assert response.status == 303
+            assert response.getheader('Location') == '/console?id=refresh-1'
+            handler.refresh_thread.join()
+            assert handler.dataset.cache.last_change is not None
+
+            ids = [post['id'] for post in posts]
+            fake_api.edit(ids[0], tags='new_tag')
+            assert (request('POST').getheader('Location')
+                    == '/console?id=refresh-2')
+            handler.refresh_thread.join()
+            assert handler.dataset.get_id(ids[0]).tags == {'new_tag'}
+
+            console_queue = handler.console_queues['refresh-2']
+            lines = [console_queue.get() for _ in range(console_queue.qsize())]
+            assert lines[-2:] == ["Refreshed 1 changed posts.", None]
+        finally:
+            conn.close()
+            handler.server.shutdown()
+            handler.server.server_close()
+
+    def test_get_vote_data(self, posts, fake_api):
+        assert (hhapi.get_vote_data('someone', 3)
+                == {post['id'] for post in posts[::7]})
+        assert hhapi.get_vote_data('nobody', 3) == set()
+
+
+class TestMetrics:
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+
+        for value in [0.002] * 50 + [0.2] * 50:
+            histogram.observe(value)
+
+        assert histogram.count == 100
+        assert histogram.sum == pytest.approx(10.1)
+        assert 0.001 <= histogram.quantile(0.25) <= 0.0025
+        assert 0.1 <= histogram.quantile(0.75) <= 0.25
+
+    def test_render(self):
+        registry = metrics.Registry()
+        registry.counter('requests_total', "Some requests.",
+                         route='/a"b').inc(3)
+        registry.histogram('latency', route='/').observe(0.03)
+
+        text = registry.render()
+        assert '# HELP requests_total Some requests.' in text
+        assert '# TYPE requests_total counter' in text
+        assert 'requests_total{route="/a\\"b"} 3' in text
+        assert 'latency_bucket{route="/",le="0.05"} 1' in text
+        assert 'latency_bucket{route="/",le="+Inf"} 1' in text
+        assert 'latency_count{route="/"} 1' in text
+
+        with pytest.raises(TypeError):
+            registry.gauge('requests_total')
+
+
+class TestProfiling:
+    def test_profiled(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+
+        with profiling.profiled('/best') as result:
+            sorted(range(1000), key=lambda i: -i)
+
+        assert result.name.endswith('-best.prof')
+        assert profiling.list_profiles() == [result.name]
+        assert 'function calls' in profiling.report(result.name)
+
+        with pytest.raises(FileNotFoundError):
+            profiling.report('../' + result.name)
+
+
+class TestStats:
+    def test_count_ranking(self):
+        ranking = stats.CountRanking({'a': 3, 'b': 1, 'c': 2})
+        assert ranking.top(2) == [('a', 3), ('c', 2)]
+
+        ranking.add('b', 5)
+        ranking.add('a', -3)
+        assert ranking.top(5) == [('b', 6), ('c', 2)]
+        assert len(ranking) == 2
+
+    def test_record_vote(self):
+        dataset = synthetic.generate_dataset(200, ngood=10, nbad=10, seed=3,
+                                             ntags=100)
+        nbc = naive_bayes.NaiveBayesClassifier.from_dataset(dataset)
+        tracker = stats.Stats(dataset, nbc)
+        summary = tracker.summary()
+        assert tracker.summary() is summary
+
+        id_ = next(i for i in dataset.cache.ids if i not in dataset.good)
+        tags = dataset.get_id(id_).features
+        dataset.good.add(id_)
+        nbc.add_post(tags, True)
+        tracker.record_vote(id_, True, tags)
+
+        fresh = stats.Stats(dataset, nbc)
+        assert tracker.summary() is not summary
+        assert not any(post_data.is_extra_feature(row['tag'])
+                       for row in tracker.summary()['top_tags'])
+        assert tracker.sorted_ids == fresh.sorted_ids
+        assert (sorted(tracker.tag_totals.counts.items())
+                == sorted(fresh.tag_totals.counts.items()))
+        assert tracker.ids_page('good', 1, 4) == sorted(dataset.good)[4:8]
+        assert tracker.ids_page('good', 0, 10 ** 9) == sorted(dataset.good)
+
+        for page, per_page in [(-1, 4), (0, 0)]:
+            with pytest.raises(ValueError):
+                tracker.ids_page('good', page, per_page)
+
+        lr = classifiers.LogisticClassifier.from_dataset(dataset)
+        assert (stats.Stats(dataset, lr).summary()['total_good']
+                == len(dataset.good))
+
+
+class TestSessions:
+    class FakeRequest:
+        def __init__(self, cookie=None):
+            self.headers = {'Cookie': cookie} if cookie else {}
+            self.extra_headers = []
+
+    def test_sessions(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        shared = synthetic.generate_dataset(200, ngood=10, nbad=10, seed=4,
+                                            ntags=100)
+        manager = sessions.SessionManager(shared, multi_user=True)
+
+        request = self.FakeRequest()
+        alice = manager.get(request)
+        [(header, cookie)] = request.extra_headers
+        assert header == 'Set-Cookie'
+        cookie = cookie.split(';')[0]
+
+        bob = manager.get(self.FakeRequest())
+        assert manager.get(self.FakeRequest(cookie)) is alice
+        assert alice is not bob
+        assert alice.dataset.cache is bob.dataset.cache is shared.cache
+        assert len(alice.dataset.good) == 0
+
+        alice.record_vote(shared.cache.ids[0], True)
+        assert shared.cache.ids[0] in alice.dataset.good
+        assert len(bob.dataset.good) == 0
+        assert alice.nbc.ngood == 1 and bob.nbc.ngood == 0
+
+        # Votes survive a restart, and bad tokens never touch the disk.
+        alice.dataset.save()
+        manager = sessions.SessionManager(shared, multi_user=True)
+        assert (manager.get(self.FakeRequest(cookie)).dataset.good
+                == {shared.cache.ids[0]})
+        assert manager.token_from_cookie(
+            f"{sessions.SessionManager.COOKIE}=../../etc/passwd") is None
+
+        # Made up tokens get a new one instead.
+        request = self.FakeRequest(
+            f"{sessions.SessionManager.COOKIE}={'a' * 64}")
+        manager.get(request)
+        assert 'a' * 64 not in request.extra_headers[0][1]
+        assert not os.path.exists(post_data.UserDataset.votes_file('a' * 64))
+
+        # Old sessions are saved and dropped once there are too many.
+        manager.MAX_SESSIONS = 2
+        request = self.FakeRequest()
+        carol = manager.get(request)
+        cookie = request.extra_headers[0][1].split(';')[0]
+        carol.record_vote(shared.cache.ids[1], False)
+        manager.get(self.FakeRequest())
+        manager.get(self.FakeRequest())
+        assert carol not in manager.sessions.values()
+        assert len(manager.sessions) == 2
+        assert (manager.get(self.FakeRequest(cookie)).dataset.bad
+                == {shared.cache.ids[1]})
+
+
+class TestModelCache:
+    def test_model_cache(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        dataset = synthetic.generate_dataset(300, ngood=20, nbad=20, seed=9,
+                                             ntags=100)
+        assert model_cache.load(dataset, naive_bayes.NaiveBayesClassifier) \
+            is None
+
+        session = sessions.Session(dataset)
+        expected = [session.post_getter.get_best()[1].id for _ in range(5)]
+        session.save()
+
+        # Picked back up with every prediction, so nothing is rescored.
+        session = sessions.Session(dataset)
+        assert session.nbc.tag_history == naive_bayes.NaiveBayesClassifier \
+            .from_dataset(dataset).tag_history
+        assert session.post_getter._get_scores() is not None
+        assert [session.post_getter.get_best()[1].id
+                for _ in range(5)] == expected
+        assert model_cache.load(dataset, classifiers.LogisticClassifier) \
+            is None
+
+        # A new post is scored on its own.
+        data = dict(DUMMY_JSON, id=dataset.cache.highest_id + 1, tags='t1 t2')
+        dataset.add_post(data)
+        nbc, scores = model_cache.load(dataset,
+                                       naive_bayes.NaiveBayesClassifier)
+        assert list(scores) == pytest.approx(list(nbc.predict_many(
+            dataset.cache)))
+
+        # New votes are patched in, and the predictions thrown out.
+        dataset.good.add(data['id'])
+        dataset.bad.remove(next(iter(dataset.bad)))
+        nbc, scores = model_cache.load(dataset,
+                                       naive_bayes.NaiveBayesClassifier)
+        assert scores is None
+        assert nbc.tag_history == naive_bayes.NaiveBayesClassifier \
+            .from_dataset(dataset).tag_history
+
+        # But not if the tags of a voted post have changed since.
+        dataset.add_post(dict(data, id=next(iter(dataset.good)),
+                              tags='t3 t4'))
+        assert model_cache.load(dataset,
+                                naive_bayes.NaiveBayesClassifier) is None
+
+        # Logistic regression can't take votes back out, so it starts over.
+        model_cache.save(dataset,
+                         classifiers.LogisticClassifier.from_dataset(dataset))
+        assert model_cache.load(dataset, classifiers.LogisticClassifier) \
+            is not None
+        dataset.good.remove(next(iter(dataset.good)))
+        assert model_cache.load(dataset, classifiers.LogisticClassifier) \
+            is None
+
+
+class TestPortable:
+    @pytest.mark.parametrize("name", ['dataset.jsonl', 'dataset.jsonl.gz'])
+    def test_round_trip(self, tmp_path, name):
+        dataset = synthetic.generate_dataset(300, ngood=20, nbad=20, seed=3)
+        path = str(tmp_path / name)
+        assert portable.export_dataset(dataset, path, chunk_size=7) == 300
+
+        copy = post_data.Dataset(load=False)
+        copy.bad.add(next(iter(dataset.good)))
+        assert portable.import_dataset(copy, path) == (300, 40)
+
+        assert copy.good == dataset.good and copy.bad == dataset.bad
+        assert list(copy.cache.ids) == list(dataset.cache.ids)
+        assert all(a == b and a.features == b.features
+                   for a, b in zip(copy.cache, dataset.cache))
+        assert (copy.tag_index.query('tag_1')
+                == dataset.tag_index.query('tag_1'))
+
+    def test_not_an_export(self, tmp_path):
+        path = tmp_path / 'other.jsonl'
+        path.write_text('{"something": "else"}\n')
+
+        with pytest.raises(ValueError):
+            portable.import_dataset(post_data.Dataset(load=False), str(path))
+
+
+class TestCacheFile:
+    COLUMNS = ['ids', 'scores', 'ratings', 'author_ids', 'md5s',
+               'tag_offsets', 'tag_ids', 'tag_names', 'authors', 'odd_md5s',
+               'url_exts', 'odd_urls']
+
+    @pytest.fixture
+    def dataset(self):
+        dataset = synthetic.generate_dataset(300, ngood=20, nbad=20, seed=5)
+        dataset.add_post(dict(DUMMY_JSON, id=1000, score=-3, rating=None,
+                              md5='abc123'))
+        return dataset
+
+    def test_round_trip(self, tmp_path, monkeypatch, dataset):
+        monkeypatch.setattr(cache_file, 'BLOCK_SIZE', 64)
+        monkeypatch.chdir(tmp_path)
+        cache_file.save(post_data.Dataset.SINGLE_FILE_CACHE, dataset.cache,
+                        dataset.tag_index)
+
+        table = post_data.PostTable()
+        index = cache_file.load(post_data.Dataset.SINGLE_FILE_CACHE, table)
+        old = dataset.cache
+
+        for column in self.COLUMNS:
+            assert getattr(table, column) == getattr(old, column), column
+
+        assert ([list(p) for p in index.postings]
+                == [list(p) for p in dataset.tag_index.postings])
+        assert index.query('tag_3 rating:s') == \
+            dataset.tag_index.query('tag_3 rating:s')
+
+        # Dataset picks it up, and it still works like any other table.
+        copy = post_data.Dataset()
+        assert copy.cache.get(1000).features == old.get(1000).features
+        copy.add_post(dict(DUMMY_JSON, id=1001, tags='tag_3 new'))
+        assert copy.tag_index.query('tag_3')[-1] == 1001
+
+    def test_shards(self, tmp_path, monkeypatch, dataset):
+        monkeypatch.setattr(cache_file.ShardedCache, 'SHARD_SIZE', 100)
+        monkeypatch.chdir(tmp_path)
+        dataset.save()
+
+        shards = cache_file.ShardedCache(dataset.CACHE, max_resident=2)
+        assert shards.shards() == [0, 1, 2, 3, 10]
+
+        # A dataset that never loaded the cache can't wipe it out.
+        with pytest.raises(FileExistsError):
+            post_data.Dataset(load=False).save()
+        dataset.save()
+        assert shards.shards() == [0, 1, 2, 3, 10]
+
+        copy = post_data.Dataset()
+        for column in self.COLUMNS:
+            assert (getattr(copy.cache, column)
+                    == getattr(dataset.cache, column)), column
+        assert copy.tag_index.query('tag_3') == \
+            dataset.tag_index.query('tag_3')
+
+        # Only the shard that changed is rewritten, and empty ones go away.
+        def saves():
+            return shards._read_meta()['shards']
+
+        before = saves()
+        copy.add_post(dict(DUMMY_JSON, id=150, tags='tag_3 new'))
+        copy.add_post({'id': 1000})
+        copy.cache.last_change = 42
+        copy.save()
+        after = saves()
+        assert [shard for shard in before
+                if before[shard] != after.get(shard)] == ['1', '10']
+        assert not os.path.exists(shards._shard_path(10))
+
+        # Posts can be read without loading the whole cache.
+        assert shards.get(150).tags == {'tag_3', 'new'}
+        assert [post.id for post in shards.posts()] == list(copy.cache.ids)
+        assert len(shards._resident) == 2
+
+        # A shard that's missing doesn't match META, so the index is rebuilt.
+        os.remove(shards._shard_path(0))
+        copy = post_data.Dataset()
+        assert copy.tag_index.query('tag_3') == [
+            post.id for post in copy.cache if 'tag_3' in post.tags]
+        assert copy.cache.last_change == 42
+
+    def test_sharded_table(self, tmp_path, monkeypatch, dataset):
+        monkeypatch.setattr(cache_file.ShardedCache, 'SHARD_SIZE', 100)
+        monkeypatch.chdir(tmp_path)
+        dataset.save()
+
+        lazy = post_data.Dataset(max_resident_shards=1)
+        table = lazy.cache
+        assert isinstance(table, cache_file.ShardedTable)
+        assert len(lazy.shards._resident) == 1
+        assert list(table.ids) == list(dataset.cache.ids)
+        assert [post.to_json() for post in table] == \
+            [post.to_json() for post in dataset.cache]
+        assert lazy.tag_index.query('tag_3 rating:s') == \
+            dataset.tag_index.query('tag_3 rating:s')
+
+        # Ranking reads through the shards, one at a time.
+        nbc = naive_bayes.NaiveBayesClassifier.from_dataset(dataset)
+        rows = [0, 5, 150, 120, len(table) - 1]
+        assert (list(nbc.predict_table(table, rows))
+                == list(nbc.predict_table(dataset.cache, rows)))
+        getter = post_getters.PostGetter(lazy, nbc)
+        expected = post_getters.PostGetter(dataset, nbc)
+        assert ([getter.get_best()[1].id for _ in range(5)]
+                == [expected.get_best()[1].id for _ in range(5)])
+        assert len(lazy.shards._resident) == 1
+
+        # Changed shards stay in memory until they're saved.
+        lazy.add_post(dict(DUMMY_JSON, id=150, tags='tag_3 new'))
+        lazy.add_post(dict(DUMMY_JSON, id=2500, tags='tag_3 new'))
+        lazy.add_post({'id': 1000})
+        assert table.get(150).tags == {'tag_3', 'new'}
+        assert lazy.tag_index.query('new') == [150, 2500]
+        assert 1000 not in table and table.highest_id == 2500
+        lazy.save()
+
+        copy = post_data.Dataset()
+        assert list(copy.cache.ids) == list(table.ids)
+        assert copy.cache.get(2500).features == table.get(2500).features
+        assert copy.tag_index.query('new') == [150, 2500]
+        assert not os.path.exists(lazy.shards._shard_path(10))
+
+    def test_not_a_cache_file(self, tmp_path):
+        path = tmp_path / 'cache.hhc'
+        path.write_bytes(b'BZh91AY&SY')
+
+        with pytest.raises(ValueError):
+            cache_file.load(str(path), post_data.PostTable())
+
+
+class TestHttpServer:
+    PAGE = bytes('<p>' + 'Hypnohub ' * 200 + '</p>', 'utf8')
+
+    @pytest.fixture
+    def server(self):
+        handler = http_server.AhtoRequestHandler(('127.0.0.1', 0))
+        handler.FILE_DIR = os.path.abspath(os.path.join(
+            os.path.dirname(__file__), '..', 'http_server'))
+
+        def page(dh):
+            dh.send_response(200)
+            dh.send_header('Content-type', 'text/html')
+            dh.end_headers()
+            dh.wfile.write(self.PAGE)
+
+        handler.PATHS = {'/page': [['GET'], page]}
+        thread = threading.Thread(target=handler.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        yield handler
+        handler.server.shutdown()
+        handler.server.server_close()
+
+    def test_negotiate(self):
+        assert compression.negotiate('gzip, deflate, br') == 'gzip'
+        assert compression.negotiate('gzip;q=0, deflate') == 'deflate'
+        assert compression.negotiate('deflate;q=0.5, gzip;q=0.2') \
+            == 'deflate'
+        assert compression.negotiate('*') == 'gzip'
+        assert compression.negotiate('identity, *;q=0') is None
+        assert compression.negotiate('br') is None
+        assert compression.negotiate(None) is None
+
+    def test_keep_alive_and_compression(self, server):
+        conn = http.client.HTTPConnection(*server.server.server_address)
+
+        def get(path, accept_encoding=None):
+            headers = {}
+            if accept_encoding is not None:
+                headers['Accept-Encoding'] = accept_encoding
+
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+            assert int(response.getheader('Content-Length')) == len(body)
+            return response, body
+
+        response, body = get('/page', 'gzip')
+        assert response.getheader('Content-Encoding') == 'gzip'
+        assert gzip.decompress(body) == self.PAGE
+        sock = conn.sock
+
+        response, body = get('/page')
+        assert response.getheader('Content-Encoding') is None
+        assert body == self.PAGE
+
+        with open(os.path.join(server.FILE_DIR, 'main.css'), 'rb') as f:
+            css = f.read()
+
+        for _ in range(2):
+            response, body = get('/main.css', 'deflate')
+            assert zlib.decompress(body) == css
+
+        assert len(server.compressed_bodies) == 1
 
-            spv = dataset.get_id(k)
+        # Every response so far went over the same connection.
+        assert conn.sock is sock
 
-            assert spv.id == k == int(v['id'])
+        response, body = get('/nope', 'gzip')
+        assert response.status == 404
+        conn.close()